@@ -0,0 +1,453 @@
+import collections
+import heapq
+import os
+import sys
+import threading
+import time
+import urlparse
+
+from . import index
+from . import metrics
+from . import utils
+
+log = utils.get_logger()
+
+try:
+    # noinspection PyUnresolvedReferences
+    from django.conf import settings
+except:  # debug env
+    from graphite import settings
+
+DEFAULT_METADATA_CACHE_SIZE = 1000
+
+# seconds, by endpoint
+DEFAULT_METADATA_TTL = {'entities': 300,
+                        'metrics': 300,
+                        'entity': 300,
+                        'metric': 300,
+                        'entity-metrics': 120,
+                        'entity-and-tags': 60}
+
+# refresher defaults: most used urls kept fresh, parallel requests,
+# requests per second, fraction of ttl before expiration to reload
+DEFAULT_REFRESH_TOP = 100
+DEFAULT_REFRESH_CONCURRENCY = 2
+DEFAULT_REFRESH_RATE = 5
+DEFAULT_REFRESH_AHEAD = 0.25
+# seconds between refresher scans and between halvings of use counts
+_REFRESH_TICK = 1
+_USAGE_DECAY_INTERVAL = 60
+# urls used once are not worth reloading
+_REFRESH_MIN_USES = 2
+
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+_refresher = None
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+
+
+class _Flight(object):
+    """load in progress, shared by concurrent callers of the same key"""
+
+    __slots__ = ('event', 'value', 'exc_info')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+
+class TtlLruCache(object):
+    """thread-safe cache with per-entry ttl and lru eviction
+
+    concurrent misses of the same key are collapsed into a single load
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: `int` max number of entries
+        """
+
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        #: key -> (expires, value), least recently used first
+        self._entries = collections.OrderedDict()
+        #: key -> :class:`._Flight`
+        self._flights = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def get(self, key, ttl, load):
+        """return cached value or call load() once for all waiting callers
+
+        :param key: hashable
+        :param ttl: `Number` seconds
+        :param load: `.Function` () -> value
+        :return: value, should not be modified
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.exc_info is not None:
+                raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+            return flight.value
+
+        try:
+            flight.value = load()
+        except Exception:
+            flight.exc_info = sys.exc_info()
+            raise
+        else:
+            self.put(key, flight.value, ttl)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+        return flight.value
+
+    def lookup(self, key, default=None):
+        """return cached value without loading it
+
+        :param key: hashable
+        :return: value | default if key is missing or expired
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def expires(self, key):
+        """
+        :param key: hashable
+        :return: `float` expiration time of cached value | None if missing,
+            does not count as lookup
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def invalidate(self, key=None):
+        """
+        :param key: hashable | None to clear cache
+        """
+
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.shared
+            return {'size': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'shared': self.shared,
+                    'evictions': self.evictions,
+                    'hit_ratio': float(self.hits + self.shared) / lookups if lookups else 0.0}
+
+
+def metadata_endpoint(url):
+    """
+    :param url: `str` atsd api url
+    :return: `str` endpoint name used for ttl lookup
+    """
+
+    path = urlparse.urlsplit(url).path
+    parts = path[path.find('/api/v1/') + len('/api/v1/'):].strip('/').split('/')
+
+    if len(parts) == 1:
+        return parts[0]
+    elif len(parts) == 2:
+        return 'entity' if parts[0] == 'entities' else 'metric'
+    elif parts[0] == 'entities':
+        return 'entity-metrics'
+    return parts[-1]
+
+
+def metadata_cache():
+    """process-wide cache of metadata responses,
+    configured with ATSD_CONF metadata_cache_size and metadata_cache_ttl
+
+    :return: :class:`.TtlLruCache`
+    """
+
+    global _metadata_cache
+
+    if _metadata_cache is None:
+        with _metadata_cache_lock:
+            if _metadata_cache is None:
+                size = settings.ATSD_CONF.get('metadata_cache_size',
+                                              DEFAULT_METADATA_CACHE_SIZE)
+                _metadata_cache = TtlLruCache(size)
+
+    return _metadata_cache
+
+
+metrics.register_cache('metadata', lambda: metadata_cache().stats())
+
+
+def metadata_ttl(endpoint):
+    """
+    :param endpoint: `str` name returned by :func:`.metadata_endpoint`
+    :return: `Number` seconds, 0 disables caching
+    """
+
+    ttl = DEFAULT_METADATA_TTL.get(endpoint, 60)
+    return settings.ATSD_CONF.get('metadata_cache_ttl', {}).get(endpoint, ttl)
+
+
+def _load_metadata(transport, url):
+    response = transport.get(url)
+    log.info('request_url = %s, status = %s', 'MetadataCache', url, response.status_code)
+
+    if response.status_code != 200:
+        raise RuntimeError('server response status_code={:d} {:s}'
+                           .format(response.status_code, response.text))
+
+    return response.json()
+
+
+class MetadataRefresher(object):
+    """background thread reloading cached metadata of the most used urls
+    shortly before it expires, so browsing users do not wait for it
+
+    at most concurrency reloads run at once and at most rate start per second
+    """
+
+    def __init__(self, cache, top=DEFAULT_REFRESH_TOP,
+                 concurrency=DEFAULT_REFRESH_CONCURRENCY, rate=DEFAULT_REFRESH_RATE,
+                 ahead=DEFAULT_REFRESH_AHEAD):
+        """
+        :param cache: :class:`.TtlLruCache` of metadata responses
+        :param top: `int` number of most used urls kept fresh
+        :param concurrency: `int` max reloads in progress
+        :param rate: `Number` max reloads started per second
+        :param ahead: `float` fraction of ttl before expiration when reload starts
+        """
+
+        self.cache = cache
+        self.top = top
+        self.concurrency = concurrency
+        self.rate = rate
+        self.ahead = ahead
+
+        self._lock = threading.Lock()
+        #: url -> [uses, ttl, transport]
+        self._usage = {}
+        #: urls being reloaded
+        self._pending = set()
+        self._decayed = time.time()
+        self._budget = 0
+
+        self.reloads = 0
+        self.failures = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='MetadataRefresher')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def touch(self, transport, url, ttl):
+        """count use of url, called on every cached lookup"""
+
+        with self._lock:
+            usage = self._usage.get(url)
+            if usage is None:
+                self._usage[url] = [1, ttl, transport]
+            else:
+                usage[0] += 1
+
+    def _decay(self, now):
+        """halve use counts, forget urls not used since a few halvings"""
+
+        if now - self._decayed < _USAGE_DECAY_INTERVAL:
+            return
+
+        with self._lock:
+            self._decayed = now
+            for url, usage in self._usage.items():
+                usage[0] //= 2
+                if usage[0] == 0 and url not in self._pending:
+                    del self._usage[url]
+
+    def due(self, now):
+        """
+        :return: `list` of (url, ttl, transport) of the most used urls
+            expiring within ahead * ttl, most used first, not limited by budget
+        """
+
+        with self._lock:
+            popular = heapq.nlargest(self.top, self._usage.items(), key=lambda item: item[1][0])
+            pending = set(self._pending)
+
+        due = []
+        for url, (uses, ttl, transport) in popular:
+            if uses < _REFRESH_MIN_USES or url in pending:
+                continue
+
+            expires = self.cache.expires(url)
+            if expires is None or expires - now <= ttl * self.ahead:
+                due.append((url, ttl, transport))
+
+        return due
+
+    def _run(self):
+        while not self._stop.wait(_REFRESH_TICK):
+            try:
+                self.scan(time.time())
+            except Exception as e:
+                log.exception('refresh scan failed: %s', self, e)
+
+    def scan(self, now):
+        """start reloads of due urls within concurrency and rate budget
+
+        :return: `int` reloads started
+        """
+
+        self._decay(now)
+
+        # unused rate budget is kept for one second at most
+        self._budget = min(self._budget + self.rate * _REFRESH_TICK, max(self.rate, 1))
+
+        started = 0
+        for url, ttl, transport in self.due(now):
+            with self._lock:
+                if self._budget < 1 or len(self._pending) >= self.concurrency:
+                    break
+                self._budget -= 1
+                self._pending.add(url)
+
+            thread = threading.Thread(target=self._reload, args=(transport, url, ttl),
+                                      name='MetadataRefresher-reload')
+            thread.daemon = True
+            thread.start()
+            started += 1
+
+        return started
+
+    def _reload(self, transport, url, ttl):
+        try:
+            self.cache.put(url, _load_metadata(transport, url), ttl)
+            self.reloads += 1
+            metrics.METADATA_RELOADS.inc(1, 'ok')
+        except Exception as e:
+            self.failures += 1
+            metrics.METADATA_RELOADS.inc(1, 'failed')
+            log.warning('reload of %s failed: %s', self, url, e, sample=10)
+        finally:
+            with self._lock:
+                self._pending.discard(url)
+
+    def stats(self):
+        with self._lock:
+            return {'tracked': len(self._usage),
+                    'pending': len(self._pending),
+                    'reloads': self.reloads,
+                    'failures': self.failures}
+
+
+def metadata_refresher():
+    """process-wide refresher of metadata cache, enabled with ATSD_CONF
+    metadata_refresh and configured with metadata_refresh_top,
+    metadata_refresh_concurrency, metadata_refresh_rate, metadata_refresh_ahead
+
+    :return: started :class:`.MetadataRefresher` | None if disabled
+    """
+
+    global _refresher, _refresher_pid
+
+    conf = settings.ATSD_CONF
+    if not conf.get('metadata_refresh', False):
+        return None
+
+    pid = os.getpid()
+
+    if _refresher is None or _refresher_pid != pid:
+        with _refresher_lock:
+            # threads are not inherited over fork
+            if _refresher is None or _refresher_pid != pid:
+                _refresher = MetadataRefresher(
+                    metadata_cache(),
+                    conf.get('metadata_refresh_top', DEFAULT_REFRESH_TOP),
+                    conf.get('metadata_refresh_concurrency', DEFAULT_REFRESH_CONCURRENCY),
+                    conf.get('metadata_refresh_rate', DEFAULT_REFRESH_RATE),
+                    conf.get('metadata_refresh_ahead', DEFAULT_REFRESH_AHEAD)).start()
+                _refresher_pid = pid
+
+    return _refresher
+
+
+def get_metadata(transport, url, indexed=None):
+    """cached GET of atsd meta api, answered from metadata index if possible
+
+    :param transport: :class:`.Transport`
+    :param url: `str` absolute url
+    :param indexed: `tuple` of :class:`.MetadataIndex` lookup method and its
+        arguments equivalent to url | None
+    :return: parsed json response, should not be modified
+    :raises RuntimeError: server response not 200
+    """
+
+    if indexed is not None:
+        response = index.lookup(*indexed)
+        if response is not None:
+            return response
+
+    ttl = metadata_ttl(metadata_endpoint(url))
+
+    if ttl <= 0:
+        return _load_metadata(transport, url)
+
+    refresher = metadata_refresher()
+    if refresher is not None:
+        refresher.touch(transport, url, ttl)
+
+    return metadata_cache().get(url, ttl, lambda: _load_metadata(transport, url))
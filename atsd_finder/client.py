@@ -1,10 +1,19 @@
 import requests
 import urlparse
 import json
+import itertools
+import os
+import re
+import sys
+import threading
 import time
-from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
+from . import metrics
 from . import utils
+from . import transport
+from .series_cache import series_cache, without_step_interpolation, fill_step
+from .cache import TtlLruCache, metadata_ttl, DEFAULT_METADATA_CACHE_SIZE
 
 log = utils.get_logger()
 
@@ -27,29 +36,269 @@ NON_GROUP_STATS = ('FIRST',
                    'THRESHOLD_PERCENT')
 
 
-class _FetchTimer(object):
+# bytes read from socket at once in streaming mode
+STREAM_CHUNK_SIZE = 64 * 1024
 
-    def __init__(self):
-        self.waiting_fetches = 0
-        self.time = None  # datetime
+_ARRAY_START_RE = re.compile(r'"series"\s*:\s*\[')
+_SEPARATORS = ' \t\r\n,'
 
-    def inc_fetches(self):
-        if self.time is None:
-            self.time = datetime.now()
 
-        self.waiting_fetches += 1
+def _iter_series(chunks):
+    """incrementally decode {"series": [...]} response,
+    yield each element of series array as soon as it is received
 
-    def dec_fetches(self):
-        if self.waiting_fetches == 0:
-            raise RuntimeError('_FetchTimer.waiting_fetches < 0')
+    decoding of incomplete element is retried when unparsed data doubles,
+    so parsing work stays linear in response size and buffer holds
+    at most twice the largest element
 
-        self.waiting_fetches -= 1
+    :param chunks: iterable of `str`
+    :return: `generator` of `dict`
+    :raises ValueError: response is truncated or malformed
+    """
+
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    pending = []
+    pending_size = 0
+    attempt_size = 0
+    started = False
+
+    # None marks end of response
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is not None:
+            pending.append(chunk)
+            pending_size += len(chunk)
+
+            if len(buf) - pos + pending_size < attempt_size:
+                continue
+
+        buf = buf[pos:] + ''.join(pending)
+        pos = 0
+        pending = []
+        pending_size = 0
+
+        if not started:
+            match = _ARRAY_START_RE.search(buf)
+            if match is None:
+                continue
+            started = True
+            pos = match.end()
+
+        while True:
+            while pos < len(buf) and buf[pos] in _SEPARATORS:
+                pos += 1
+
+            if pos == len(buf):
+                attempt_size = 0
+                break
+
+            if buf[pos] == ']':
+                return
+
+            try:
+                element, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                attempt_size = 2 * (len(buf) - pos)
+                break
+
+            yield element
+
+    raise ValueError('incomplete series response')
+
+
+# seconds in one unit of group interval
+_UNIT_SECONDS = {'MILLISECOND': 0.001,
+                 'SECOND': 1,
+                 'MINUTE': 60,
+                 'HOUR': 60 * 60,
+                 'DAY': 24 * 60 * 60,
+                 'WEEK': 7 * 24 * 60 * 60,
+                 'MONTH': 30 * 24 * 60 * 60,
+                 'QUARTER': 91 * 24 * 60 * 60,
+                 'YEAR': 365 * 24 * 60 * 60}
+
+DEFAULT_DISPATCH_THREADS = 4
+DEFAULT_CHUNK_QUERIES = 500
+DEFAULT_CHUNK_POINTS = 1000000
+DEFAULT_CHUNK_LATENCY = 2.0
+# seconds between raw samples assumed for point estimation
+DEFAULT_RAW_STEP = 15
+# max sibling queries merged into one
+DEFAULT_MERGE_QUERIES = 100
+# seconds a render waits for series
+DEFAULT_RENDER_TIMEOUT = 60
+
+
+class DeadlineExceeded(RuntimeError):
+    """series response did not arrive before render deadline"""
+
+
+def _describe(query):
+    """
+    :param query: series query json
+    :return: `unicode` short query identity for log
+    """
+
+    tags = ','.join(k + '=' + v[0] if len(v) == 1 else k + '=' + '|'.join(v)
+                    for k, v in sorted(query.get('tags', {}).items()))
+    entity = query['entity'] if 'entity' in query else '|'.join(query.get('entities', []))
+
+    return query['metric'] + '/' + entity + ('[' + tags + ']' if tags else '')
 
-        if self.waiting_fetches == 0:
-            fetch_duration = datetime.now() - self.time
-            self.time = None
 
-            log.info('fetch duration=' + str(fetch_duration), self)
+def render_deadline(request_context, client):
+    """deadline shared by all fetches of one render, render_timeout setting
+    after first fetch, stored in graphite-web render context or, if there is
+    no context, in client until all its fetches are finished
+
+    :param request_context: `dict` | None
+    :param client: :class:`.AtsdClient`
+    :return: `Number` seconds | None if render is not limited
+    """
+
+    timeout = settings.ATSD_CONF.get('render_timeout', DEFAULT_RENDER_TIMEOUT)
+    if not timeout:
+        return None
+
+    if request_context is not None:
+        return request_context.setdefault('atsdDeadline', time.time() + timeout)
+
+    # no fetch in progress, so this one starts a new render
+    if client.deadline is None or not client.waiting_fetches:
+        client.deadline = time.time() + timeout
+
+    return client.deadline
+
+_pool = None
+_pool_pid = None
+_sizer = None
+_dispatch_lock = threading.Lock()
+
+
+def _estimate_points(query):
+    """
+    :param query: series query json
+    :return: `Number` expected samples in response
+    """
+
+    duration = (query['endTime'] - query['startTime']) / 1000.0
+
+    if 'group' in query:
+        interval = query['group']['interval']
+        step = interval['count'] * _UNIT_SECONDS.get(interval['unit'], 1)
+    else:
+        step = settings.ATSD_CONF.get('raw_step', DEFAULT_RAW_STEP)
+
+    # merged query returns a series per listed entity and tag value
+    series = len(query.get('entities', ())) or 1
+    for values in query.get('tags', {}).values():
+        series *= len(values) or 1
+
+    return series * (max(1.0, duration / step) if step > 0 else 1.0)
+
+
+class _ChunkSizer(object):
+    """split batch into chunks limited by number of queries and estimated points,
+    points limit follows observed throughput, so a chunk takes about target latency
+    """
+
+    def __init__(self, max_queries, max_points, target_latency):
+        """
+        :param max_queries: `int`
+        :param max_points: `Number` initial points limit
+        :param target_latency: `Number` seconds
+        """
+
+        self.max_queries = max_queries
+        self.target_latency = target_latency
+        #: `Number` current points limit
+        self.max_points = float(max_points)
+
+        self._initial_points = float(max_points)
+        self._lock = threading.Lock()
+
+    def split(self, queries):
+        """
+        :param queries: `list` of json
+        :return: `list` of `list` of json
+        """
+
+        max_points = self.max_points
+
+        chunks = []
+        chunk = []
+        points = 0
+
+        for query in queries:
+            estimate = _estimate_points(query)
+
+            if chunk and (len(chunk) >= self.max_queries or points + estimate > max_points):
+                chunks.append(chunk)
+                chunk = []
+                points = 0
+
+            chunk.append(query)
+            points += estimate
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+    def observe(self, queries, latency):
+        """adapt points limit to latency of completed chunk
+
+        :param queries: `list` of json
+        :param latency: `Number` seconds
+        """
+
+        points = sum(_estimate_points(query) for query in queries)
+        wanted = points * self.target_latency / max(latency, 0.001)
+
+        # keep in 1/16 .. 16 of configured limit, smooth changes
+        wanted = min(max(wanted, self._initial_points / 16), self._initial_points * 16)
+
+        with self._lock:
+            self.max_points = 0.7 * self.max_points + 0.3 * wanted
+
+
+def _chunk_sizer():
+    """
+    :return: process-wide :class:`._ChunkSizer`
+    """
+
+    global _sizer
+
+    if _sizer is None:
+        conf = settings.ATSD_CONF
+        with _dispatch_lock:
+            if _sizer is None:
+                _sizer = _ChunkSizer(conf.get('chunk_queries', DEFAULT_CHUNK_QUERIES),
+                                     conf.get('chunk_points', DEFAULT_CHUNK_POINTS),
+                                     conf.get('chunk_latency', DEFAULT_CHUNK_LATENCY))
+
+    return _sizer
+
+
+def _dispatch_pool():
+    """
+    :return: process-wide :class:`ThreadPool` sending batch chunks
+    """
+
+    global _pool, _pool_pid
+
+    pid = os.getpid()
+
+    if _pool is None or _pool_pid != pid:
+        with _dispatch_lock:
+            # threads are not inherited over fork
+            if _pool is None or _pool_pid != pid:
+                _pool = ThreadPool(settings.ATSD_CONF.get('dispatch_threads',
+                                                          DEFAULT_DISPATCH_THREADS))
+                _pool_pid = pid
+
+    return _pool
 
 
 def _get_retention_interval(metric):
@@ -58,6 +307,197 @@ def _get_retention_interval(metric):
     return days * 24 * 60 * 60
 
 
+class _Retention(object):
+    """cached metric or entity properties"""
+
+    __slots__ = ('retention', 'last_insert_time', 'received')
+
+    def __init__(self, item):
+        """
+        :param item: metric or entity json
+        """
+
+        #: `Number` seconds, 0 if data is stored forever
+        self.retention = _get_retention_interval(item) if 'retentionInterval' in item else 0
+        #: `Number` seconds | None
+        self.last_insert_time = item['lastInsertTime'] / 1000.0 \
+            if item.get('lastInsertTime') else None
+        #: `Number` seconds, when server reported these values
+        self.received = time.time()
+
+
+class RetentionCache(object):
+    """retention interval and last insert time of metrics and entities
+
+    names are registered when instances are created and requested in bulk,
+    one `name in (...)` request per kind for all names not cached yet
+    """
+
+    # names per request, keeps url short
+    BATCH_SIZE = 100
+
+    _MISSING = object()
+
+    def __init__(self, size):
+        """
+        :param size: `int` max cached names of each kind
+        """
+
+        self._metrics = TtlLruCache(size)
+        self._entities = TtlLruCache(size)
+
+        self._lock = threading.Lock()
+        self._pending_metrics = set()
+        self._pending_entities = set()
+
+    def want(self, metric_name, entity_name):
+        """register names for next :meth:`.resolve`"""
+
+        with self._lock:
+            self._pending_metrics.add(metric_name)
+            if not _is_pattern(entity_name):
+                self._pending_entities.add(entity_name)
+
+    def resolve(self, client):
+        """request all pending names which are not cached
+
+        :param client: :class:`.AtsdClient`
+        """
+
+        with self._lock:
+            metrics = self._pending_metrics
+            entities = self._pending_entities
+            self._pending_metrics = set()
+            self._pending_entities = set()
+
+        self._request(client, 'metrics', self._metrics,
+                      [m for m in metrics if self._metrics.lookup(m, self._MISSING) is self._MISSING])
+        self._request(client, 'entities', self._entities,
+                      [e for e in entities if self._entities.lookup(e, self._MISSING) is self._MISSING])
+
+    def metric(self, name):
+        """
+        :return: :class:`._Retention` | None if unknown or not cached
+        """
+
+        return self._metrics.lookup(name)
+
+    def entity(self, name):
+        """
+        :return: :class:`._Retention` | None if unknown or not cached
+        """
+
+        return self._entities.lookup(name)
+
+    def stats(self):
+        """
+        :return: (metrics, entities) :meth:`.TtlLruCache.stats`
+        """
+
+        return self._metrics.stats(), self._entities.stats()
+
+    def is_cached(self, metric_name, entity_name):
+        return self._metrics.lookup(metric_name, self._MISSING) is not self._MISSING \
+            and (_is_pattern(entity_name)
+                 or self._entities.lookup(entity_name, self._MISSING) is not self._MISSING)
+
+    @classmethod
+    def _request(cls, client, kind, cache, names):
+        """
+        :param kind: `str` 'metrics' | 'entities'
+        :param cache: :class:`.TtlLruCache`
+        :param names: `list` of `str`
+        """
+
+        if not names:
+            return
+
+        ttl = metadata_ttl(kind[:-1] if kind == 'metrics' else 'entity')
+
+        # expression could not contain quoted names, request them one by one
+        plain = [name for name in names if "'" not in name]
+        quoted = [name for name in names if "'" in name]
+
+        found = {}
+
+        for i in xrange(0, len(plain), cls.BATCH_SIZE):
+            batch = plain[i:i + cls.BATCH_SIZE]
+            expression = "name in ('" + "','".join(batch) + "')"
+            try:
+                items = client.request('GET', kind, params={'expression': expression})
+            except RuntimeError as e:
+                log.exception('retention request failed: %s', cls.__name__, e)
+                continue
+
+            for item in items:
+                found[item['name']] = _Retention(item)
+
+            # names are case insensitive on server
+            lower = dict((name.lower(), name) for name in batch)
+            for item in items:
+                name = lower.get(item['name'].lower())
+                if name is not None:
+                    found[name] = found[item['name']]
+
+            for name in batch:
+                found.setdefault(name, None)
+
+        for name in quoted:
+            try:
+                found[name] = _Retention(client.request('GET', kind + '/' + utils.quote(name)))
+            except RuntimeError:  # server response != 200
+                found[name] = None
+
+        for name, retention in found.items():
+            cache.put(name, retention, ttl)
+
+        log.info('retentions: %s requested=%d found=%d', cls.__name__,
+                 kind, len(names), sum(1 for r in found.values() if r is not None))
+
+
+def _is_pattern(name):
+    return '*' in name or '?' in name
+
+
+_retention_caches = {}
+
+
+def _retention_stats():
+    """
+    :return: `dict` hits, misses, hit_ratio of all retention caches
+    """
+
+    hits = misses = 0
+    for cache in _retention_caches.values():
+        for stats in cache.stats():
+            hits += stats['hits'] + stats['shared']
+            misses += stats['misses']
+
+    lookups = hits + misses
+    return {'hits': hits,
+            'misses': misses,
+            'hit_ratio': float(hits) / lookups if lookups else 0.0}
+
+
+metrics.register_cache('retention', _retention_stats)
+
+
+def retention_cache():
+    """
+    :return: process-wide :class:`.RetentionCache` for current atsd url
+    """
+
+    url = settings.ATSD_CONF['url']
+
+    with _dispatch_lock:
+        cache = _retention_caches.get(url)
+        if cache is None:
+            size = settings.ATSD_CONF.get('metadata_cache_size', DEFAULT_METADATA_CACHE_SIZE)
+            cache = _retention_caches[url] = RetentionCache(size)
+
+    return cache
+
+
 class Instance(object):
     """
     series unique identifier
@@ -77,112 +517,200 @@ class Instance(object):
         #: :class:`.AtsdClient`
         self._client = client
 
+        # retention of all leaves is requested at once
+        client.retentions.want(metric_name, entity_name)
+
+    def _retention(self):
+        """
+        :return: (metric, entity) :class:`._Retention` | None, from cache only
+        """
+
+        retentions = self._client.retentions
+        return retentions.metric(self.metric_name), retentions.entity(self.entity_name)
+
     def get_retention_interval(self):
         """
         :return: (start_time, end_time) in seconds
         """
 
-        try:
-            # find in cached retentions
-            retention = self._client.metric_retentions[self.metric_name]
-            now = time.time()
-            if retention == 0:
-                start_time = 0
-            else:
-                start_time = now - retention
+        retentions = self._client.retentions
+        if not retentions.is_cached(self.metric_name, self.entity_name):
+            retentions.want(self.metric_name, self.entity_name)
+            retentions.resolve(self._client)
 
-            # log.info('default retention_interval=('
-            #          + strf_timestamp(start_time) + ','
-            #          + strf_timestamp(now) + ')', self)
+        metric, entity = self._retention()
 
-            return start_time, now
+        if metric is None:
+            return 0, time.time()
 
-        except KeyError:
-            metric = self._get_metric()
-            try:
-                entity = self._get_entity()
-            except RuntimeError:  # server response != 200
-                end_time = metric['lastInsertTime'] / 1000
-            else:
-                end_time = max(metric['lastInsertTime'], entity['lastInsertTime']) / 1000
+        insert_times = [r.last_insert_time for r in (metric, entity)
+                        if r is not None and r.last_insert_time is not None]
+        end_time = max(insert_times) if insert_times else time.time()
+
+        # atsd store retentionInterval in days
+        start_time = (end_time - metric.retention) if metric.retention else 0
+
+        # log.info('retention_interval=('
+        #          + strf_timestamp(start_time) + ','
+        #          + strf_timestamp(end_time) + ')', self)
+
+        return start_time, end_time
+
+    def has_no_data(self, start_time, end_time):
+        """check cached metadata, without requests
+
+        window has no data if it ends before retention interval, or it starts
+        after last insert time and ends before that time was reported
+        (later inserts are not known)
+
+        :param start_time: `Number` seconds
+        :param end_time: `Number` seconds
+        :return: `bool`
+        """
 
-            # atsd store retentionInterval in days
-            retention = metric['retentionInterval'] * 24 * 60 * 60
-            start_time = (end_time - retention) if retention else 0
+        metric, entity = self._retention()
 
-            # log.info('retention_interval=('
-            #          + strf_timestamp(start_time) + ','
-            #          + strf_timestamp(end_time) + ')', self)
+        if metric is None:
+            return False
+
+        if metric.retention and end_time < time.time() - metric.retention:
+            return True
 
-            return start_time, end_time
+        latest = metric
+        if entity is not None and entity.last_insert_time is not None \
+                and (latest.last_insert_time is None
+                     or entity.last_insert_time > latest.last_insert_time):
+            latest = entity
 
-    def fetch_series(self, start_time, end_time, aggregator, format_series):
+        return latest.last_insert_time is not None \
+            and start_time > latest.last_insert_time \
+            and end_time <= latest.received
+
+    def render_deadline(self, request_context):
+        """
+        :param request_context: `dict` graphite-web render context | None
+        :return: `Number` seconds | None, see :func:`.render_deadline`
+        """
+
+        return render_deadline(request_context, self._client)
+
+    def fetch_series(self, start_time, end_time, aggregator, format_series,
+                     deadline=None, format_late=None):
         """send query
 
         :param format_series: `.Function` [{t, v}] -> (start, end, step), [values]
         :param start_time: `Number` seconds
         :param end_time: `Number` seconds
         :param aggregator: :class:`.Aggregator` | None
+        :param deadline: `Number` seconds | None
+        :param format_late: `.Function` () -> (start, end, step), [values]
+            result if deadline is missed, :class:`.DeadlineExceeded` is raised if None
         :return: :class: `.FetchInProgress` <(start, end, step), [values]>
         """
 
-        self._client.fetch_timer.inc_fetches()
+        if self.has_no_data(start_time, end_time):
+            log.debug('no data in requested interval: %s', self, self.path)
+            return FetchInProgress(lambda: format_series([]))
+
+        self._client.start_fetch()
 
-        future = self._client.query_series(self, start_time, end_time, aggregator)
+        # series is formatted as soon as its response is received
+        future = self._client.query_series(self, start_time, end_time, aggregator,
+                                           format_series, deadline)
 
         def get_formatted_series():
             """get real values and regularize them
 
             :return: time_info, values
             """
-            resp = future.waitForResults()
-            series = resp['data']
-
-            formatted_series = format_series(series)
-
-            self._client.fetch_timer.dec_fetches()
-
-            return formatted_series
+            try:
+                return future.waitForResults()
+            except DeadlineExceeded as e:
+                log.warning('%s: %s', self, e, self.path, sample=10)
+                if format_late is None:
+                    raise
+                return format_late()
+            finally:
+                self._client.finish_fetch()
 
         return FetchInProgress(get_formatted_series)
 
-    def _get_metric(self):
-        """make meta api request
-
-        :return: parsed json response
-        """
-
-        return self._client.request('GET',
-                                    'metrics/' + utils.quote(self.metric_name))
 
-    def _get_entity(self):
-        """make meta api request
+class _Failure(object):
+    """exception raised while requesting or formatting response,
+    re-raised when response is popped
+    """
 
-        :return: parsed json response
-        """
+    __slots__ = ('exc_info',)
 
-        return self._client.request('GET',
-                                    'entities/' + utils.quote(self.entity_name))
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
 
 
 class QueryCollection(object):
     """store queries and responses for them
     each query has unique id, stored in requestId attr
 
+    response of query with formatter is replaced with formatted value
+    on arrival, so raw series are not kept until query is popped
+
+    query identical to one still waiting for response is not sent,
+    it gets the same response formatted with its own formatter
+
+    responses are added by dispatch threads, so all access is synchronized
     """
 
     def __init__(self):
+        self._condition = threading.Condition()
         self._queries = {}
         self._responses = {}
+        #: id -> `.Function` [{t, v}] -> formatted series
+        self._formatters = {}
+        #: ids of queries sent to server
+        self._dispatched = set()
+        #: ids of queries whose request is complete
+        self._finished = set()
         self._counter = 0
 
+        #: query json key -> id of query sent for it, while response is awaited
+        self._by_key = {}
+        #: id -> query json key
+        self._keys = {}
+        #: id of sent query -> `list` of ids of identical queries
+        self._followers = {}
+        #: id of identical query -> id of sent query
+        self._aliases = {}
+        #: id of cancelled sent query -> id of follower promoted to get its response
+        self._successors = {}
+        self._saved = 0
+
     def get_waiting_queries(self):
-        waiting_queries = []
-        for id_ in self._queries:
-            if id_ not in self._responses:
-                waiting_queries.append(self._queries[id_])
+        """return queries not sent yet and mark them as sent
 
-        return waiting_queries
+        :return: `list` of json
+        """
+
+        with self._condition:
+            waiting_queries = []
+            for id_ in self._queries:
+                if id_ not in self._dispatched and id_ not in self._aliases:
+                    waiting_queries.append(self._queries[id_])
+                    self._dispatched.add(id_)
+
+            return waiting_queries
+
+    def is_dispatched(self, query):
+        with self._condition:
+            id_ = query['requestId']
+            return self._aliases.get(id_, id_) in self._dispatched
+
+    def stats(self):
+        """
+        :return: {queries: `int` added, saved: `int` not sent as duplicates}
+        """
+
+        with self._condition:
+            return {'queries': self._counter, 'saved': self._saved}
 
     def add_response(self, response):
         """add response for existing query
@@ -192,38 +720,135 @@ class QueryCollection(object):
         try:
             id_ = response['requestId']
         except KeyError:
-            log.info('response without requestId: ' + unicode(response), self)
+            log.warning('response without requestId: %s', self, response, sample=100)
             return False
 
-        if id_ in self._queries:
-            self._responses[id_] = response
-            return True
+        with self._condition:
+            id_ = self._successor(id_)
+            known = id_ in self._queries
+            # no more followers once response is here
+            self._release_key(id_)
+            ids = [id_] + self._followers.get(id_, [])
+            formatters = [self._formatters.get(i) for i in ids]
 
-        log.info('no query for response: ' + unicode(response), self)
-        return False
+        if not known:
+            log.warning('no query for response: %s', self, response, sample=100)
+            return False
 
-    def add_query(self, query):
+        responses = []
+        for formatter in formatters:
+            if formatter is None:
+                responses.append(response)
+                continue
+            try:
+                responses.append(formatter(response['data']))
+            except Exception:
+                responses.append(_Failure(sys.exc_info()))
+
+        with self._condition:
+            for i, formatted in zip(ids, responses):
+                # query could be cancelled while response was formatted
+                if i in self._queries:
+                    self._responses[i] = formatted
+            self._condition.notify_all()
+
+        return True
+
+    def finish(self, queries, exc_info=None):
+        """mark request for queries as complete
+
+        :param queries: `list` of json
+        :param exc_info: `tuple` request failure | None
+        """
+
+        with self._condition:
+            for query in queries:
+                primary = self._successor(query['requestId'], True)
+                self._release_key(primary)
+                for id_ in [primary] + self._followers.pop(primary, []):
+                    if id_ not in self._queries:
+                        # cancelled after deadline
+                        continue
+                    self._finished.add(id_)
+                    self._dispatched.add(id_)
+                    self._aliases.pop(id_, None)
+                    if exc_info is not None and id_ not in self._responses:
+                        self._responses[id_] = _Failure(exc_info)
+
+            self._condition.notify_all()
+
+    def add_query(self, query, formatter=None):
         """
         :param query:  json
+        :param formatter: `.Function` [{t, v}] -> formatted series | None
         :returns: unique id for query
         """
 
-        self._counter += 1
-        id_ = str(self._counter)
+        query.pop('requestId', None)
+        key = json.dumps(query, sort_keys=True)
+
+        with self._condition:
+            self._counter += 1
+            id_ = str(self._counter)
+
+            query['requestId'] = id_
 
-        query['requestId'] = id_
+            self._queries[id_] = query
 
-        self._queries[id_] = query
+            if formatter is not None:
+                self._formatters[id_] = formatter
+
+            primary = self._by_key.get(key)
+            if primary is not None:
+                self._aliases[id_] = primary
+                self._followers.setdefault(primary, []).append(id_)
+                self._saved += 1
+            else:
+                self._by_key[key] = id_
+                self._keys[id_] = key
 
         # log.info('add query total=' + str(len(self._queries)), self)
 
         return id_
 
+    def wait_response(self, query, deadline=None):
+        """wait until query request is complete and pop response
+
+        query is dropped if deadline passes first, it is not sent if
+        still waiting and its late response is ignored
+
+        :param query: dispatched query json
+        :param deadline: `Number` seconds | None
+        :return: response, formatted if query has formatter, or None
+        :raises KeyError: if no such query
+        :raises DeadlineExceeded: no response before deadline
+        """
+
+        id_ = query['requestId']
+
+        with self._condition:
+            while id_ not in self._responses and id_ not in self._finished:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._cancel(id_)
+                    raise DeadlineExceeded('deadline missed by query ' + _describe(query))
+                self._condition.wait(remaining)
+
+            if id_ not in self._responses:
+                self._forget(id_)
+                return None
+
+        return self.pop_response(query)
+
     def pop_response(self, query):
         """return and remove query entry, or return None if no response exists
 
         :param query: json
-        :return: response or None
+        :return: response, formatted if query has formatter, or None
         :raises KeyError: if no such query
         """
 
@@ -232,45 +857,291 @@ class QueryCollection(object):
         except KeyError:
             raise KeyError('no such query to get response')
 
-        if id_ in self._responses:
-            resp = self._responses[id_]
-            del self._responses[id_]
-            del self._queries[id_]
+        with self._condition:
+            if id_ not in self._responses:
+                return None
 
-            # log.info('pop response total=' + str(len(self._responses)), self)
-            return resp
+            resp = self._responses.pop(id_)
+            self._forget(id_)
+
+        # log.info('pop response total=' + str(len(self._responses)), self)
+
+        if isinstance(resp, _Failure):
+            raise resp.exc_info[0], resp.exc_info[1], resp.exc_info[2]
+
+        return resp
+
+    def _release_key(self, id_):
+        key = self._keys.pop(id_, None)
+        if key is not None and self._by_key.get(key) == id_:
+            del self._by_key[key]
+
+    def _successor(self, id_, pop=False):
+        """
+        :param id_: `str` id of sent query
+        :return: `str` id of query which gets its response
+        """
+
+        while id_ in self._successors:
+            id_ = self._successors.pop(id_) if pop else self._successors[id_]
+        return id_
+
+    def _cancel(self, id_):
+        primary = self._aliases.pop(id_, None)
+        if primary is not None and id_ in self._followers.get(primary, ()):
+            self._followers[primary].remove(id_)
+
+        # identical queries of other renders still wait, the first one takes over
+        followers = self._followers.pop(id_, None)
+        if followers:
+            successor = followers[0]
+            del self._aliases[successor]
+            for follower in followers[1:]:
+                self._aliases[follower] = successor
+            if len(followers) > 1:
+                self._followers[successor] = followers[1:]
+
+            key = self._keys.pop(id_, None)
+            if key is not None:
+                self._keys[successor] = key
+                if self._by_key.get(key) == id_:
+                    self._by_key[key] = successor
+
+            if id_ in self._dispatched:
+                self._dispatched.add(successor)
+                self._successors[id_] = successor
+
+        self._forget(id_)
+
+    def _forget(self, id_):
+        self._queries.pop(id_, None)
+        self._formatters.pop(id_, None)
+        self._dispatched.discard(id_)
+        self._finished.discard(id_)
+        self._release_key(id_)
+
+
+# query fields planner knows how to merge, others are sent as is
+_MERGEABLE_FIELDS = frozenset(('requestId', 'startTime', 'endTime', 'entity', 'metric',
+                               'tags', 'group', 'aggregate'))
+
+
+class _MergedQuery(object):
+    """sibling queries sent as one, they differ only by entity or by value of one tag
+
+    member filters are identical except the merged field, so each returned
+    series is routed to members by that field
+    """
+
+    __slots__ = ('query', 'members', 'tag', '_routes')
+
+    def __init__(self, members, tag=None):
+        """
+        :param members: `list` of query json
+        :param tag: `str` name of merged tag | None if entities are merged
+        """
+
+        #: `list` of json
+        self.members = members
+        #: `str` | None
+        self.tag = tag
+
+        query = dict((k, v) for k, v in members[0].items() if k != 'requestId')
+        self._routes = {}
+
+        if tag is None:
+            values = [m['entity'] for m in members]
+            del query['entity']
+            query['entities'] = values
+        else:
+            values = [m['tags'][tag][0] for m in members]
+            query['tags'] = dict(query['tags'])
+            query['tags'][tag] = values
+
+        for member, value in zip(members, values):
+            self._routes.setdefault(self._route_key(value), []).append(member['requestId'])
+
+        query['requestId'] = 'm' + members[0]['requestId']
+        #: json sent to server
+        self.query = query
+
+    def _route_key(self, value):
+        # names are case insensitive on server
+        return value.lower() if self.tag is None else value
+
+    def split(self, series):
+        """
+        :param series: response json
+        :return: `list` of requestId of member queries series belongs to
+        """
+
+        if self.tag is None:
+            value = series.get('entity')
         else:
-            return None
+            tags = dict((k.lower(), v) for k, v in (series.get('tags') or {}).items())
+            value = tags.get(self.tag.lower())
+
+        if value is None:
+            return []
+
+        return self._routes.get(self._route_key(value), [])
+
+
+def _is_mergeable(query):
+    """
+    :return: `bool` query selects one series, so it could be merged with siblings
+    """
+
+    if not _MERGEABLE_FIELDS.issuperset(query) or 'entity' not in query:
+        return False
+
+    if _is_pattern(query['entity']):
+        return False
+
+    for values in query.get('tags', {}).values():
+        if len(values) != 1 or _is_pattern(values[0]):
+            return False
+
+    return True
+
+
+def _plan_queries(queries, max_members):
+    """merge sibling queries, the ones differing only by entity first,
+    then the ones differing only by value of one tag
+
+    :param queries: `list` of json
+    :param max_members: `int` max queries merged into one, 0 disables merging
+    :return: `list` of json to send, {requestId: :class:`._MergedQuery`}
+    """
+
+    if max_members < 2:
+        return list(queries), {}
+
+    # position of first member -> merged query
+    merged = {}
+    single = []
+
+    def merge(groups, tag):
+        for members in groups:
+            for i in xrange(0, len(members), max_members):
+                part = members[i:i + max_members]
+                if len(part) > 1:
+                    merged[part[0][0]] = _MergedQuery([q for _, q in part], tag)
+                else:
+                    single.extend(part)
+
+    def sibling_groups(candidates, field):
+        groups = {}
+        order = []
+        for position, query in candidates:
+            key = dict(query)
+            del key['requestId']
+            if field is None:
+                key.pop('entity')
+            else:
+                key['tags'] = dict(key['tags'])
+                del key['tags'][field]
+            key = json.dumps(key, sort_keys=True)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append((position, query))
+        return [groups[key] for key in order]
+
+    candidates = [(i, q) for i, q in enumerate(queries) if _is_mergeable(q)]
+    plain = [(i, q) for i, q in enumerate(queries) if not _is_mergeable(q)]
+
+    merge(sibling_groups(candidates, None), None)
+
+    # queries left alone are tried once more for each tag name
+    names = sorted(set(name for _, q in single for name in q['tags']))
+    for name in names:
+        candidates = [(i, q) for i, q in single if name in q['tags']]
+        single = [(i, q) for i, q in single if name not in q['tags']]
+        merge(sibling_groups(candidates, name), name)
+
+    planned = sorted(plain + single + [(i, m.query) for i, m in merged.items()],
+                     key=lambda item: item[0])
+
+    return ([q for _, q in planned],
+            dict((m.query['requestId'], m) for m in merged.values()))
 
 
 class AtsdClient(object):
     def __init__(self):
-        log.info('init', self)
+        log.debug('init', self)
 
-        #: :class:`.Session`
-        self._session = requests.Session()
-        self._session.auth = (settings.ATSD_CONF['username'],
-                              settings.ATSD_CONF['password'])
+        #: :class:`.Transport` shared by all clients
+        self._transport = transport.get_transport()
         #: `str` api path
         self._context = urlparse.urljoin(settings.ATSD_CONF['url'], 'api/v1/')
 
         self._query_storage = QueryCollection()
 
-        #: metric_name: `str` -> retention_interval sec: `Number`
-        self.metric_retentions = {}
+        #: `bool` decode batch response series by series
+        self._stream_series = settings.ATSD_CONF.get('stream_series', True)
+        #: `int` max sibling queries merged into one
+        self._merge_queries = settings.ATSD_CONF.get('merge_queries', DEFAULT_MERGE_QUERIES)
+
+        #: :class:`.RetentionCache` shared by clients
+        self.retentions = retention_cache()
+
+        #: `Number` seconds, render deadline if readers have no render context
+        self.deadline = None
+
+        #: `int` fetches of readers waiting for results
+        self.waiting_fetches = 0
+        #: `Number` seconds, when the first waiting fetch started | None
+        self._fetch_start = None
+
+    def start_fetch(self):
+        if not self.waiting_fetches:
+            self._fetch_start = time.time()
+
+        self.waiting_fetches += 1
+
+    def finish_fetch(self):
+        """the last waiting fetch ends the render, its duration is observed
+        and context-less deadline is cleared
+        """
+
+        if self.waiting_fetches == 0:
+            raise RuntimeError('AtsdClient.waiting_fetches < 0')
+
+        self.waiting_fetches -= 1
 
-        self.fetch_timer = _FetchTimer()
+        if not self.waiting_fetches:
+            metrics.FETCH_DURATION.observe(time.time() - self._fetch_start)
+            metrics.registry.maybe_write()
+            self._fetch_start = None
+            self.deadline = None
 
-    def request(self, method, path, data=None, params=None):
+    def request(self, method, path, data=None, params=None, timeout=None):
         """
         :param params: `dict` query parameters
         :param method: `str`
         :param path: `str` url after 'api/v1'
         :param data: `dict` or `list` json body of request
+        :param timeout: `Number` seconds to wait for response data | None for transport default
         :return: `dict` or `list` response.json()
         :raises RuntimeError: server response not 200
         """
 
+        response = self._send(method, path, data, params, timeout=timeout)
+
+        log.info('request: duration = %s, response-size = %d, %s', self,
+                 response.elapsed, len(response.content), response.transfer)
+
+        return response.json()
+
+    def _send(self, method, path, data=None, params=None, stream=False, timeout=None):
+        """
+        :param stream: `bool` do not read response body
+        :param timeout: `Number` seconds to wait for response data | None for transport default
+        :return: :class:`requests.Response`
+        :raises RuntimeError: server response not 200
+        """
+
         request = requests.Request(
             method=method,
             url=urlparse.urljoin(self._context, path),
@@ -285,8 +1156,12 @@ class AtsdClient(object):
         # print '>>>params:', request.params
         # print '============================='
 
-        prepared_request = self._session.prepare_request(request)
-        response = self._session.send(prepared_request)
+        prepared_request = self._transport.session.prepare_request(request)
+        if timeout is None:
+            response = self._transport.send(prepared_request, stream=stream)
+        else:
+            response = self._transport.send(prepared_request, stream=stream,
+                                            timeout=(self._transport.timeout[0], timeout))
 
         # print '===========response=========='
         # print '>>>status:', response.status_code
@@ -294,23 +1169,23 @@ class AtsdClient(object):
         # print '>>>content:', response.text
         # print '============================='
 
-        log.info('request: duration = ' + str(response.elapsed)
-                 + ', response-size = ' + str(len(response.content)),
-                 self)
-
         if response.status_code != 200:
             raise RuntimeError('server response status_code={:d} {:s}'
                                .format(response.status_code, response.text))
 
-        return response.json()
+        return response
 
-    def query_series(self, instance, start_time, end_time, aggregator):
+    def query_series(self, instance, start_time, end_time, aggregator,
+                     format_series=None, deadline=None):
         """
         :param instance: :class:`.Instance`
         :param start_time: `Number` seconds
         :param end_time: `Number` seconds
         :param aggregator: :class:`.Aggregator` | None
-        :return: :class: `.FetchInProgress` <series json>
+        :param format_series: `.Function` [{t, v}] -> formatted series | None
+        :param deadline: `Number` seconds | None, result raises
+            :class:`.DeadlineExceeded` if response is not received before
+        :return: :class: `.FetchInProgress` <formatted series | series json>
         """
 
         # if aggregator and aggregator.unit == 'SECOND':
@@ -341,8 +1216,70 @@ class AtsdClient(object):
             else:
                 query['group'] = aggregator.json()
 
-        self._query_storage.add_query(query)
-        return FetchInProgress(lambda: self._get_response(query))
+        cache = series_cache()
+        if cache is not None:
+            cache_query, fill = without_step_interpolation(query)
+            segments = cache.plan(cache_query)
+
+            # nothing cached and nothing to cache: plain query
+            if segments is not None and (len(segments) > 1
+                                         or segments[0][0] == 'cached'
+                                         or segments[0][3]):
+                return self._query_cached(cache_query, segments, cache, format_series,
+                                          deadline, fill)
+
+        self._query_storage.add_query(query, format_series)
+        return FetchInProgress(lambda: self._get_response(query, deadline))
+
+    def _query_cached(self, query, segments, cache, format_series, deadline=None, fill=None):
+        """request only ranges missing in series cache
+
+        :param query: series query json
+        :param segments: `list` planned by :meth:`.SeriesCache.plan`
+        :param cache: :class:`.SeriesCache`
+        :param format_series: `.Function` [{t, v}] -> formatted series | None
+        :param deadline: `Number` seconds | None
+        :param fill: `Number` seconds between periods filled with previous value | None
+        :return: :class: `.FetchInProgress` <formatted series | series json>
+        """
+
+        parts = []
+        for segment in segments:
+            if segment[0] == 'cached':
+                parts.append(segment)
+            else:
+                _, start, end, blocks = segment
+                sub_query = dict(query, startTime=start, endTime=end)
+                self._query_storage.add_query(sub_query)
+                parts.append(('request', sub_query, blocks))
+
+        def get_series():
+            data = []
+
+            for part in parts:
+                if part[0] == 'cached':
+                    data.extend({'t': t, 'v': v} for t, v in zip(part[1], part[2]))
+                    continue
+
+                _, sub_query, blocks = part
+                response = self._get_response(sub_query, deadline)
+
+                if response is not None:
+                    cache.store(blocks, response['data'])
+                    data.extend(response['data'])
+
+            if fill:
+                data = fill_step(data, fill)
+
+            if format_series is not None:
+                return format_series(data)
+
+            return {'entity': query['entity'],
+                    'metric': query['metric'],
+                    'tags': dict((k, v[0]) for k, v in query['tags'].items()),
+                    'data': data}
+
+        return FetchInProgress(get_series)
 
     @staticmethod
     def query_graphite_metrics(query, series, limit):
@@ -379,60 +1316,193 @@ class AtsdClient(object):
         return resp
 
     def _update_intervals(self, graphite_resp):
-        """update self.metric_intervals
+        """request retention of all leaf series with one batch
 
         :param graphite_resp: `json` atsd /graphite query response
         """
-        metric_names = set()
+
         for metric in graphite_resp['metrics']:
             if metric['is_leaf'] == 1:
-                m = metric['series']['metric']
-                metric_names.add(m)
-
-        # TODO: request retention interval
-
-        # expression = utils.quote("name in ('" + "','".join(metric_names) + "')")
-        #
-        # log.info('request metrics, expression=' + expression, self)
-        # metrics = self.request('GET', 'metrics?expression=' + expression)
-        # log.info('update intervals for metrics {0}'
-        #          .format([m['name'] for m in metrics]), self)
+                series = metric['series']
+                self.retentions.want(series['metric'], series['entity'])
 
-        for metric in metric_names:
-            self.metric_retentions[metric] = 0
+        self.retentions.resolve(self)
 
-    def _get_response(self, query):
+    def _get_response(self, query, deadline=None):
         """search response in _query_storage if not found make request
 
         :param query: json
+        :param deadline: `Number` seconds | None
         :return: json
         :raises KeyError: no such query in storage
+        :raises DeadlineExceeded: no response before deadline
         """
 
-        response = self._query_storage.pop_response(query)
+        if not self._query_storage.is_dispatched(query):
+            self._request_series(deadline)
 
-        if response is None:
-            self._request_series()
-            return self._query_storage.pop_response(query)
+        return self._query_storage.wait_response(query, deadline)
 
-        return response
+    def _request_series(self, deadline=None):
+        """split queries in storage into chunks and send them concurrently,
+        responses of each chunk are added to storage as they arrive
 
-    def _request_series(self):
-        """create batch request with queries in storage,
-        add responses to storage
+        :param deadline: `Number` seconds | None, chunks not received
+            before are abandoned
         """
         queries = self._query_storage.get_waiting_queries()
+        if not queries:
+            return
+
+        planned, merged = _plan_queries(queries, self._merge_queries)
+
+        metrics.BATCH_QUERIES.observe(len(queries), 'added')
+        metrics.BATCH_QUERIES.observe(len(planned), 'sent')
+
+        sizer = _chunk_sizer()
+        chunks = sizer.split(planned)
+
+        log.info('batch request: %d queries sent as %d in %d chunks, duplicates saved = %d',
+                 self, len(queries), len(planned), len(chunks),
+                 self._query_storage.stats()['saved'])
+
+        if len(chunks) == 1:
+            self._request_chunk(chunks[0], sizer, merged, deadline)
+            return
+
+        pool = _dispatch_pool()
+        for chunk in chunks:
+            pool.apply_async(self._request_chunk, (chunk, sizer, merged, deadline))
+
+    def _request_chunk(self, queries, sizer, merged, deadline=None):
+        """send one batch request, failure is stored as response of each query
+
+        :param queries: `list` of json
+        :param sizer: :class:`._ChunkSizer`
+        :param merged: {requestId: :class:`._MergedQuery`}
+        :param deadline: `Number` seconds | None
+        """
+
+        start = time.time()
+
+        members = []
+        for query in queries:
+            merged_query = merged.get(query['requestId'])
+            if merged_query is None:
+                members.append(query)
+            else:
+                members.extend(merged_query.members)
+
+        try:
+            if deadline is not None and start >= deadline:
+                raise DeadlineExceeded('deadline missed before request')
+            self._post_series(queries, merged, deadline)
+        except DeadlineExceeded as e:
+            log.warning('batch %s, %d queries: %s', self, e, len(members),
+                        ', '.join(_describe(query) for query in queries))
+            self._query_storage.finish(members, sys.exc_info())
+            return
+        except Exception:
+            log.exception('batch request failed: %d queries', self, len(members))
+            self._query_storage.finish(members, sys.exc_info())
+            return
+
+        self._query_storage.finish(members)
+        sizer.observe(queries, time.time() - start)
+
+    def _add_response(self, resp, merged):
+        """store series, series of merged query is stored for each member it belongs to
+
+        :param resp: series json
+        :param merged: {requestId: :class:`._MergedQuery`}
+        """
+
+        metrics.SERIES_POINTS.observe(len(resp.get('data', ())))
+
+        merged_query = merged.get(resp.get('requestId'))
+        if merged_query is None:
+            self._query_storage.add_response(resp)
+            return
+
+        ids = merged_query.split(resp)
+        if not ids:
+            log.warning('no merged query member for series: entity=%s tags=%s', self,
+                        resp.get('entity'), resp.get('tags'), sample=100)
+
+        for id_ in ids:
+            self._query_storage.add_response(dict(resp, requestId=id_))
+
+    def _post_series(self, queries, merged, deadline=None):
+        """
+        :param queries: `list` of json
+        :param merged: {requestId: :class:`._MergedQuery`}
+        :param deadline: `Number` seconds | None
+        :raises DeadlineExceeded: response is not complete before deadline
+        """
+
         data = {'queries': queries}
 
+        timeout = None
+        if deadline is not None:
+            # server must start to respond in time, the rest is checked while reading
+            timeout = max(deadline - time.time(), 0.001)
+
         # with open('/tmp/graphite-last-query.txt', 'w') as f:
         #     f.write(json.dumps(queries))
 
-        log.info('batch request: ' + str(len(queries)) + ' queries', self)
-        responses = self.request('POST', 'series', data)['series']
-        log.info('batch response: ' + str(len(responses)) + ' series', self)
+        if self._stream_series:
+            try:
+                response = self._send('POST', 'series', data, stream=True, timeout=timeout)
+            except requests.RequestException:
+                self._check_deadline(deadline, 'waiting for response')
+                raise
+            size = [0]
+
+            def chunks():
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    size[0] += len(chunk)
+                    yield chunk
+
+            received = 0
+            try:
+                for resp in _iter_series(chunks()):
+                    self._add_response(resp, merged)
+                    received += 1
+                    self._check_deadline(deadline, 'after ' + str(received) + ' series')
+            except requests.RequestException:
+                # read timeout
+                self._check_deadline(deadline, 'after ' + str(received) + ' series')
+                raise
+            finally:
+                self._transport.received(response, size[0])
+                response.close()
+                metrics.BATCH_SERIES.observe(received)
+
+            log.info('batch response: %d series, duration = %s, %s', self,
+                     received, response.elapsed, response.transfer)
+            return
+
+        try:
+            responses = self.request('POST', 'series', data, timeout=timeout)['series']
+        except requests.RequestException:
+            self._check_deadline(deadline, 'waiting for response')
+            raise
+        log.info('batch response: %d series', self, len(responses))
+        metrics.BATCH_SERIES.observe(len(responses))
 
         # with open('/tmp/graphite-last-response.txt', 'w') as f:
         #     f.write(json.dumps(responses))
 
         for resp in responses:
-            self._query_storage.add_response(resp)
+            self._add_response(resp, merged)
+
+    @staticmethod
+    def _check_deadline(deadline, stage):
+        """
+        :param deadline: `Number` seconds | None
+        :param stage: `str` request stage for message
+        :raises DeadlineExceeded: deadline has passed
+        """
+
+        if deadline is not None and time.time() >= deadline:
+            raise DeadlineExceeded('deadline missed ' + stage)
@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 
-import requests
-import json
-import fnmatch
 import re
 
 from graphite.local_settings import ATSD_CONF
+from . import metrics
 from . import utils
+from . import transport
+from .cache import get_metadata
+from .pattern import GraphitePattern, narrow_like
 from .utils import quote, metric_quote, unquote
 from .client import AtsdClient, Instance
 
@@ -28,7 +29,7 @@ class AtsdFinder(object):
         self.log_info('init')
 
         self.url_base = ATSD_CONF['url'] + '/api/v1'
-        self.auth = (ATSD_CONF['username'], ATSD_CONF['password'])
+        self.transport = transport.get_transport()
 
         try:
             self.entity_folders = ATSD_CONF['entity_folders']
@@ -66,12 +67,16 @@ class AtsdFinder(object):
             
         self.aggregators = {v: k for k, v in self.aggregators.items()}
 
-    def log_info(self, message):
-    
-        log.info(message, self)
-    
+    def log_debug(self, message, *args):
+
+        log.debug(message, self, *args)
+
+    def log_info(self, message, *args):
+
+        log.info(message, self, *args)
+
     def log_exc(self, message):
-    
+
         log.exception(message, self)
     
     def get_info(self, pattern):
@@ -88,7 +93,7 @@ class AtsdFinder(object):
             info['valid'] = False
             return info
         
-        self.log_info('tokens = ' + unicode(tokens))
+        self.log_debug('tokens = %s', tokens)
         
         info['tokens'] = len(tokens)
 
@@ -148,7 +153,7 @@ class AtsdFinder(object):
 
                 i += 4
 
-                self.log_info('detail token: ' + tokens[i])
+                self.log_debug('detail token: %s', tokens[i])
 
                 if tokens[i] == 'detail':
                     info['detail'] = True
@@ -165,34 +170,35 @@ class AtsdFinder(object):
 
     def find_nodes(self, query):
 
+        return metrics.timed_find(self, query.pattern, self._find_nodes(query))
+
+    def _find_nodes(self, query):
+
         try:
     
-            self.log_info('query = ' + query.pattern)
+            self.log_info('query = %s', query.pattern)
             
             if len(query.pattern) == 0:
                 raise StopIteration
             
-            pattern_match = query.pattern
-            
-            if query.pattern[-1] == '*':
-            
+            matcher = GraphitePattern(query.pattern)
+
+            if not matcher.is_literal(-1):
+
                 leaf_request = False
-                
-                if len(query.pattern) == 1 or query.pattern[-2] == '.':
-                    pattern = query.pattern[:-2]
+
+                if '.' in query.pattern:
+                    pattern = query.pattern.rsplit('.', 1)[0]
                 else:
-                    if '.' in query.pattern:
-                        pattern = query.pattern.rsplit('.', 1)[0]
-                    else:
-                        pattern = ''
-                
+                    pattern = ''
+
             else:
             
                 leaf_request = True
                 pattern = query.pattern
             
             info = self.get_info(pattern)
-            self.log_info(json.dumps(info))
+            self.log_debug('info = %s', info)
             
             if not info['valid']:
                 
@@ -204,7 +210,7 @@ class AtsdFinder(object):
 
                 for root in self.roots:
                     
-                    if fnmatch.fnmatch(root, pattern_match):
+                    if matcher.match(root):
                         # self.log_info('path = ' + root)
                         yield BranchNode(metric_quote(root))
             
@@ -215,7 +221,7 @@ class AtsdFinder(object):
                         
                         path = pattern + '.' + metric_quote(folder)
                         
-                        if fnmatch.fnmatch(path, pattern_match):
+                        if matcher.match(path):
                             # self.log_info('path = ' + path)
                             yield BranchNode(path)
 
@@ -224,7 +230,7 @@ class AtsdFinder(object):
 
                         path = pattern + '.' + metric_quote(folder)
                         
-                        if fnmatch.fnmatch(path, pattern_match):
+                        if matcher.match(path):
                             # self.log_info('path = ' + path)
                             yield BranchNode(path)
 
@@ -235,27 +241,35 @@ class AtsdFinder(object):
                 else:  # info['type'] == 'metrics':
                     folder = info['metric folder']
 
+                # literal start of requested names narrows server side listing
                 if folder[0] == "_":
                     other = True
-                    url = self.url_base + '/' + quote(info['type'])
+                    expression = narrow_like('*', matcher.prefix(-1))
                 else:
                     other = False
-                    url = self.url_base + '/' + quote(info['type']) + '?expression=name%20like%20%27' + quote(folder) + '*%27'
+                    expression = narrow_like(folder + '*', matcher.prefix(-1))
+
+                if expression is None:
+                    raise StopIteration
+
+                url = self.url_base + '/' + quote(info['type'])
+                if expression != '*':
+                    url += '?expression=name%20like%20%27' + quote(expression[:-1]) + '*%27'
 
-                self.log_info('request_url = ' + url + '')
+                self.log_info('request_url = %s', url)
 
-                response = requests.get(url, auth=self.auth)
+                response = get_metadata(self.transport, url, (info['type'], [expression]))
 
-                #self.log_info('response = ' + response.text)
-                self.log_info('status = ' + unicode(response.status_code))
+                for smth in response:
 
-                for smth in response.json():
+                    if not matcher.may_match(-1, smth['name']):
+                        continue
 
                     if not other:
                         
                         path = pattern + '.' + metric_quote(smth['name'])
                         
-                        if fnmatch.fnmatch(path, pattern_match):
+                        if matcher.match(path):
                             # self.log_info('path = ' + path)
                             yield BranchNode(path)
 
@@ -283,7 +297,7 @@ class AtsdFinder(object):
                             
                             path = pattern + '.' + metric_quote(smth['name'])
                             
-                            if fnmatch.fnmatch(path, pattern_match):
+                            if matcher.match(path):
                                 # self.log_info('path = ' + path)
                                 yield BranchNode(path)
 
@@ -292,42 +306,49 @@ class AtsdFinder(object):
                 if info['type'] == 'entities':
 
                     url = self.url_base + '/entities/' + quote(info['entity']) + '/metrics'
-                    self.log_info('request_url = ' + url)
 
-                    response = requests.get(url, auth=self.auth)
+                    expression = narrow_like('*', matcher.prefix(-1))
+                    if expression != '*':
+                        url += '?expression=name%20like%20%27' + quote(expression[:-1]) + '*%27'
 
-                    #self.log_info('response = ' + response.text)
-                    self.log_info('status = ' + unicode(response.status_code))
+                    self.log_info('request_url = %s', url)
+
+                    response = get_metadata(self.transport, url,
+                                            ('entity_metrics', info['entity'], [expression]))
+
+                    for metric in response:
+
+                        if not matcher.may_match(-1, metric['name']):
+                            continue
 
-                    for metric in response.json():
-                        
                         path = pattern + '.' + metric_quote( metric['name'])
                         
-                        if fnmatch.fnmatch(path, pattern_match):
+                        if matcher.match(path):
                             # self.log_info('path = ' + path)
                             yield BranchNode(path)
 
                 elif info['type'] == 'metrics':
 
                     url = self.url_base + '/metrics/' + quote(info['metric'])+ '/entity-and-tags'
-                    self.log_info('request_url = ' + url)
+                    self.log_info('request_url = %s', url)
 
-                    response = requests.get(url, auth=self.auth)
-
-                    #self.log_info('response = ' + response.text)
-                    self.log_info('status = ' + unicode(response.status_code))
+                    response = get_metadata(self.transport, url,
+                                            ('entity_and_tags', info['metric']))
 
                     entities = set()
 
-                    for entity in response.json():
+                    for entity in response:
 
                         entities.add(entity['entity'])
 
                     for entity in entities:
-                        
+
+                        if not matcher.may_match(-1, entity):
+                            continue
+
                         path = pattern + '.' + metric_quote(entity)
                         
-                        if fnmatch.fnmatch(path, pattern_match):
+                        if matcher.match(path):
                             # self.log_info('path = ' + path)
                             yield BranchNode(path)
 
@@ -339,16 +360,13 @@ class AtsdFinder(object):
                 tags = info['tags']
 
                 url = self.url_base + '/metrics/' + quote(metric) + '/entity-and-tags'
-                self.log_info('request_url = ' + url)
+                self.log_info('request_url = %s', url)
 
-                response = requests.get(url, auth=self.auth)
-
-                #self.log_info('response = ' + response.text)
-                self.log_info('status = ' + unicode(response.status_code))
+                response = get_metadata(self.transport, url, ('entity_and_tags', metric))
 
                 tag_combos = []
 
-                for combo in response.json():
+                for combo in response:
                     if combo['entity'] == entity:
                         tag_combos.append(combo['tags'])
 
@@ -393,7 +411,7 @@ class AtsdFinder(object):
                                 
                                     path = pattern + '.' + metric_quote(tag_name + ': ' + tag_combo[tag_name])
                                     
-                                    if fnmatch.fnmatch(path, pattern_match):
+                                    if matcher.match(path):
                                         # self.log_info('path = ' + path)
                                         yield BranchNode(path)
                                     
@@ -403,7 +421,7 @@ class AtsdFinder(object):
                     
                     path = pattern + '.' + metric_quote('detail')
                     
-                    if fnmatch.fnmatch(path, pattern_match):
+                    if matcher.match(path):
                         # self.log_info('path = ' + path)
                         instance = Instance(entity, metric, tags, path, client)
                         reader = AtsdReader(instance)
@@ -411,7 +429,7 @@ class AtsdFinder(object):
                     
                     path = pattern + '.' + metric_quote('stats')
                     
-                    if fnmatch.fnmatch(path, pattern_match):
+                    if matcher.match(path):
                         # self.log_info('path = ' + path)
                         yield BranchNode(path)
                     
@@ -419,7 +437,7 @@ class AtsdFinder(object):
             
                 if info['detail']:
                 
-                    if fnmatch.fnmatch(pattern, pattern_match):
+                    if matcher.match(pattern):
                 
                         entity = info['entity']
                         metric = info['metric']
@@ -436,7 +454,7 @@ class AtsdFinder(object):
                         
                         path = pattern + '.' + metric_quote(aggregator)
                         
-                        if fnmatch.fnmatch(path, pattern_match):
+                        if matcher.match(path):
                             # self.log_info('path = ' + path)
                             yield BranchNode(path)
                 
@@ -451,12 +469,12 @@ class AtsdFinder(object):
                 
                     path = pattern + '.' + metric_quote(period_name)
                     
-                    if fnmatch.fnmatch(path, pattern_match):
+                    if matcher.match(path):
                     
                         # self.log_info('path = ' + path)
                         
                         period = self.periods[self.period_names.index(period_name)]
-                        self.log_info('aggregator = ' + aggregator + ', period = ' + unicode(period))
+                        self.log_debug('aggregator = %s, period = %s', aggregator, period)
 
                         instance = Instance(entity, metric, tags, path, client)
                         if period != 0:
@@ -468,7 +486,7 @@ class AtsdFinder(object):
                     
             else:
             
-                if fnmatch.fnmatch(pattern, pattern_match):
+                if matcher.match(pattern):
             
                     entity = info['entity']
                     metric = info['metric']
@@ -476,7 +494,7 @@ class AtsdFinder(object):
                     
                     aggregator = info['aggregator'].upper()
                     period = info['period']
-                    self.log_info('aggregator = ' + aggregator + ', period = ' + unicode(period))
+                    self.log_debug('aggregator = %s, period = %s', aggregator, period)
 
                     instance = Instance(entity, metric, tags, pattern, client)
                     if period != 0:
@@ -485,7 +503,10 @@ class AtsdFinder(object):
                         reader = AtsdReader(instance)
                     
                     yield LeafNode(pattern, reader)
-                    
+
+            # one request for retention of all returned leaves
+            client.retentions.resolve(client)
+
         except StandardError as e:
         
             self.log_exc(unicode(e))
\ No newline at end of file
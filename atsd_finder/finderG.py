@@ -4,6 +4,7 @@ import time
 
 from .reader import AtsdReader, EmptyReader
 from .client import AtsdClient
+from . import metrics
 from . import utils
 
 from graphite.node import BranchNode, LeafNode
@@ -49,7 +50,11 @@ class AtsdFinderG(object):
         :return: `generator`<Node>
         """
 
-        log.info('query = ' + unicode(query.__dict__), self)
+        return metrics.timed_find(self, query.pattern, self._find_nodes(query))
+
+    def _find_nodes(self, query):
+
+        log.info('query = %s', self, query.__dict__)
 
         try:
 
@@ -60,13 +65,13 @@ class AtsdFinderG(object):
             elif query.startTime is None:
 
                 if '*' in query.pattern[:-1] or (len(query.pattern) > 1 and query.pattern[-2] != '.'):
-                    log.info('auto-complete query', self)
+                    log.debug('auto-complete query', self)
                     limit = 100
                 else:
                     limit = None
 
                 response = AtsdClient.query_graphite_metrics(query.pattern, False, limit)
-                log.info('response', self)
+                log.debug('response', self)
 
                 limit = float('inf') if limit is None else limit
 
@@ -82,12 +87,12 @@ class AtsdFinderG(object):
                     else:
                         yield self._make_leaf(metric['path'])
 
-                log.info('tree ready in ' + ('%.2f' % (time.time() - start_time)) + 's', self)
+                log.info('tree ready in %.2fs', self, time.time() - start_time)
 
             else:
 
                 response = AtsdClient.query_graphite_metrics(query.pattern, True, None)
-                log.info('response', self)
+                log.debug('response', self)
 
                 start_time = time.time()
 
@@ -98,7 +103,7 @@ class AtsdFinderG(object):
                     else:
                         yield self._make_leaf(metric['path'], metric['instance'])
 
-                log.info('tree ready in ' + ('%.2f' % (time.time() - start_time)) + 's', self)
+                log.info('tree ready in %.2fs', self, time.time() - start_time)
 
         except StandardError as e:
 
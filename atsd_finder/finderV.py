@@ -1,21 +1,250 @@
 # -*- coding: utf-8 -*-
 
-import requests
-import json
+import collections
 import fnmatch
-import copy
 
 from graphite.local_settings import ATSD_CONF
 from graphite.node import BranchNode, LeafNode
 
+from . import metrics
 from . import utils
+from . import transport
+from .cache import get_metadata
+from .pattern import GraphitePattern, narrow_like
 from .utils import quote, metric_quote, unquote
-from .reader import AtsdReader, Aggregator
+from .reader import AtsdReader, Aggregator, INTERVAL_UNITS
 from .client import AtsdClient, Instance
 
 
 log = utils.get_logger()
 
+# value of a level or of a collection item is a list of
+_STRING_TYPES = ('view', 'const', 'entity', 'metric', 'tag')
+# {key: label} dicts
+_LABELED_TYPES = ('entity folder', 'metric folder', 'aggregator')
+# {label, count, unit} dicts, count 0 for none
+_TIME_TYPES = ('period', 'interval')
+
+#: variables set by `global` or `local` list of a level:
+#: fields `dict` type -> first value, tags `dict` merged tag values
+_Scope = collections.namedtuple('_Scope', 'fields tags')
+
+#: compiled level or collection item: value is `tuple` of strings,
+#: of (key, label) or of (label, time `dict` | None), labels `dict`
+#: label -> key or time of the first item with the label
+_Desc = collections.namedtuple('_Desc', 'type value labels is_leaf prefix label_prefix '
+                                        'global_scope local_scope')
+
+#: compiled view level, descs are collection items or the level itself,
+#: by_prefix and leaf_by_prefix `dict` prefix -> first (leaf) desc with it
+_Level = collections.namedtuple('_Level', 'collection descs by_prefix leaf_by_prefix '
+                                          'global_scope local_scope')
+
+
+def _check(condition, where, message):
+    if not condition:
+        raise ValueError(where + ': ' + message)
+
+
+def _compile_scope(scope, where):
+    """
+    :param scope: `list` of {type, value: `list`} | None
+    :return: :class:`._Scope` | None
+    """
+
+    if scope is None:
+        return None
+
+    _check(isinstance(scope, list), where, 'variables should be a list')
+
+    fields = {}
+    tags = {}
+
+    for var in scope:
+        _check(isinstance(var, dict) and 'type' in var, where, 'variable without type')
+        _check(isinstance(var.get('value'), list) and var['value'], where,
+               'value of variable ' + var['type'] + ' should be a non-empty list')
+
+        value = var['value'][0]
+
+        if var['type'] == 'tag':
+            _check(isinstance(value, dict), where, 'tag variable should be {name: value}')
+            tags.update(value)
+        else:
+            fields[var['type']] = value
+
+    return _Scope(fields, tags)
+
+
+def _compile_desc(desc, where):
+    """
+    :param desc: `dict` view level or collection item
+    :return: :class:`._Desc`
+    """
+
+    _check(isinstance(desc, dict), where, 'should be a dict')
+
+    token_type = desc.get('type')
+    value = desc.get('value')
+    labels = {}
+
+    _check(isinstance(value, list), where, 'value should be a list')
+
+    if token_type in _STRING_TYPES:
+        _check(all(isinstance(v, basestring) for v in value), where,
+               'value of ' + token_type + ' should be a list of strings')
+        value = tuple(value)
+
+    elif token_type in _LABELED_TYPES:
+        _check(all(isinstance(v, dict) and len(v) == 1 for v in value), where,
+               'value of ' + token_type + ' should be a list of {key: label}')
+        value = tuple(v.items()[0] for v in value)
+        for key, label in reversed(value):
+            labels[label] = key
+
+    elif token_type in _TIME_TYPES:
+        times = []
+        for time_dict in value:
+            _check(isinstance(time_dict, dict) and 'label' in time_dict and 'count' in time_dict,
+                   where, 'value of ' + token_type + ' should be a list of {label, count, unit}')
+            if time_dict['count'] == 0:
+                times.append((time_dict['label'], None))
+                continue
+
+            unit = time_dict.get('unit')
+            _check(isinstance(unit, basestring) and unit.upper() in INTERVAL_UNITS, where,
+                   token_type + ' ' + time_dict['label'] + ' has unknown unit ' + unicode(unit))
+            # copy, config of the user is never changed
+            times.append((time_dict['label'], dict(time_dict, unit=unit.upper())))
+        value = tuple(times)
+        for label, time_dict in reversed(value):
+            labels[label] = time_dict
+
+    else:
+        raise ValueError(where + ': unknown type ' + unicode(token_type))
+
+    prefix = desc.get('prefix', '')
+    _check(isinstance(prefix, basestring), where, 'prefix should be a string')
+
+    return _Desc(token_type, value, labels, bool(desc.get('is leaf', False)), prefix,
+                 '[' + prefix + '] ' if 'prefix' in desc else '',
+                 _compile_scope(desc.get('global'), where + ' global'),
+                 _compile_scope(desc.get('local'), where + ' local'))
+
+
+def _compile_level(level, where):
+    """
+    :param level: `dict` view level
+    :return: :class:`._Level`
+    """
+
+    _check(isinstance(level, dict), where, 'should be a dict')
+
+    if level.get('type') != 'collection':
+        desc = _compile_desc(level, where)
+        return _Level(False, (desc,), {}, {}, desc.global_scope, desc.local_scope)
+
+    _check(isinstance(level.get('value'), list), where, 'value of collection should be a list')
+
+    descs = tuple(_compile_desc(item, where + ' item ' + unicode(i))
+                  for i, item in enumerate(level['value']))
+
+    by_prefix = {}
+    leaf_by_prefix = {}
+    for desc in reversed(descs):
+        by_prefix[desc.prefix] = desc
+        if desc.is_leaf:
+            leaf_by_prefix[desc.prefix] = desc
+
+    return _Level(True, descs, by_prefix, leaf_by_prefix,
+                  _compile_scope(level.get('global'), where + ' global'),
+                  _compile_scope(level.get('local'), where + ' local'))
+
+
+def compile_view(name, levels):
+    """validate view config and compile it for lookups by token
+
+    :param name: `str` view name
+    :param levels: `list` of `dict` view levels from ATSD_CONF views
+    :return: `tuple` of :class:`._Level`
+    :raises ValueError: invalid view config
+    """
+
+    where = 'view ' + name
+    _check(isinstance(levels, list), where, 'should be a list of levels')
+
+    return tuple(_compile_level(level, where + ' level ' + unicode(i))
+                 for i, level in enumerate(levels))
+
+
+def _apply(fields, scope):
+    """set scope variables in fields, tags `dict` is replaced, never changed"""
+
+    fields.update(scope.fields)
+
+    if scope.tags:
+        tags = dict(fields['tags'])
+        tags.update(scope.tags)
+        fields['tags'] = tags
+
+
+def _split_prefix(token):
+    """
+    :param token: `str` unquoted token, e.g. '[p] name'
+    :return: (`str` prefix, `str` name)
+    """
+
+    if token[:1] == '[' and ']' in token:
+        return token[1:token.find(']')], token[token.find(']') + 2:]
+
+    return '', token
+
+
+class _Info(object):
+    """immutable find state of a path: view, entity, metric, tags, etc.
+
+    changes return a new record sharing all unchanged values with this one
+    """
+
+    __slots__ = ('_fields',)
+
+    def __init__(self, fields):
+        self._fields = fields
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __getitem__(self, key):
+        return self._fields[key]
+
+    def __repr__(self):
+        return repr(self._fields)
+
+    def get(self, key, default=None):
+        return self._fields.get(key, default)
+
+    def set(self, key, value):
+        fields = self._fields.copy()
+        fields[key] = value
+        return _Info(fields)
+
+    def apply(self, scope):
+        """
+        :param scope: :class:`._Scope` | None
+        """
+
+        if scope is None:
+            return self
+
+        fields = self._fields.copy()
+        _apply(fields, scope)
+        return _Info(fields)
+
+    def with_tags(self, tags):
+        fields = self._fields.copy()
+        fields['tags'] = dict(fields['tags'], **tags)
+        return _Info(fields)
+
 
 class AtsdFinderV(object):
 
@@ -26,22 +255,38 @@ class AtsdFinderV(object):
         self.log_info('init')
 
         self.url_base = ATSD_CONF['url'] + '/api/v1'
-        self.auth = (ATSD_CONF['username'], ATSD_CONF['password'])
+        self.transport = transport.get_transport()
 
         try:
-            self.views =  ATSD_CONF['views']
+            views = ATSD_CONF['views']
         except:
-            self.views = {}
+            views = {}
+
+        #: name -> `tuple` of :class:`._Level`
+        self.views = {}
+
+        for name, levels in views.items():
+            try:
+                self.views[name] = compile_view(name, levels)
+            except ValueError as e:
+                log.warning('skipped invalid %s', self, e)
 
-    def log_info(self, message):
+    def log_debug(self, message, *args):
 
-        log.info(message, self)
+        log.debug(message, self, *args)
+
+    def log_info(self, message, *args):
+
+        log.info(message, self, *args)
 
     def log_exc(self, message):
 
         log.exception(message, self)
 
     def get_info(self, pattern, leaf_request):
+        """
+        :return: :class:`._Info`
+        """
 
         info = {
             'valid': True,
@@ -54,20 +299,20 @@ class AtsdFinderV(object):
             tokens[:] = [unquote(token) for token in tokens] if pattern != '' else []
         except:
             info['valid'] = False
-            return info
+            return _Info(info)
 
-        self.log_info('tokens = ' + unicode(tokens))
+        self.log_debug('tokens = %s', tokens)
 
         info['tokens'] = len(tokens)
 
         if len(tokens) == 0:
-            return info
+            return _Info(info)
 
-        try:
-            view = self.views[tokens[0]]
-        except:
+        view = self.views.get(tokens[0])
+
+        if view is None:
             info['valid'] = False
-            return info
+            return _Info(info)
 
         info['view'] = tokens[0]
 
@@ -75,132 +320,94 @@ class AtsdFinderV(object):
 
             level = view[i]
 
-            if 'global' in level:
-                info = self.extract_var(info, level['global'])
-
-            token_type = level['type']
-            token_desc = level['value']
+            if level.global_scope is not None:
+                _apply(info, level.global_scope)
 
             if len(token) == 0:
                 continue
 
-            if token[0] == '[' and ']' in token:
-                prefix = token[token.find('[') + 1:token.find(']')]
-                token = token[token.find(']') + 2:]
-            else:
-                prefix = ''
+            prefix, token = _split_prefix(token)
 
-            if token_type == 'collection':
+            if level.collection:
 
-                for desc in level['value']:
+                desc = level.by_prefix.get(prefix)
 
-                    is_leaf = desc['is leaf'] if 'is leaf' in desc else False
-                    desc_prefix = desc['prefix'] if 'prefix' in desc else ''
+                if desc is None:
+                    continue
 
-                    if (is_leaf == leaf_request or i != info['tokens'] - 1) \
-                            and prefix == desc_prefix:
+                if desc.global_scope is not None:
+                    _apply(info, desc.global_scope)
 
-                        if 'global' in desc:
-                            info = self.extract_var(info, desc['global'])
+            else:
 
-                        token_type = desc['type']
-                        token_desc = desc['value']
+                desc = level.descs[0]
 
-                        break
+            token_type = desc.type
 
             if token_type in ['view', 'entity', 'metric']:
 
                 info[token_type] = token
 
-            elif token_type in ['entity folder', 'metric folder', 'aggregator']:
-
-                for cell in token_desc:
-
-                    if token == cell.values()[0]:
-
-                        info[token_type] = cell.keys()[0]
-                        break
-
             elif token_type == 'tag':
 
                 tag_values = token.split(', ')
+                tags = dict(info['tags'])
 
-                for j, tag_name in enumerate(token_desc):
-
-                    tag_value = tag_values[j]
-                    info['tags'][tag_name] = tag_value
-
-            elif token_type in ['period', 'interval']:
+                for j, tag_name in enumerate(desc.value):
+                    tags[tag_name] = tag_values[j]
 
-                for time_dict in token_desc:
+                info['tags'] = tags
 
-                    if token == time_dict['label']:
+            elif token in desc.labels:
 
-                        if time_dict['count'] != 0:
-                            info[token_type] = time_dict
-                        else:
-                            info[token_type] = None
-
-                        break
+                info[token_type] = desc.labels[token]
 
         if leaf_request:
 
-            token = tokens[-1]
             level = view[len(tokens) - 2]
+            prefix = _split_prefix(tokens[-1])[0]
 
-            if token[0] == '[' and ']' in token:
-                prefix = token[token.find('[') + 1:token.find(']')]
-            else:
-                prefix = ''
-
-            if 'local' in level:
-                info = self.extract_var(info, level['local'])
-
-            if level['type'] == 'collection':
+            if level.local_scope is not None:
+                _apply(info, level.local_scope)
 
-                for desc in level['value']:
+            if level.collection:
 
-                    is_leaf = desc['is leaf'] if 'is leaf' in desc else False
-                    desc_prefix = desc['prefix'] if 'prefix' in desc else ''
+                desc = level.leaf_by_prefix.get(prefix)
 
-                    if is_leaf and prefix == desc_prefix:
+                if desc is not None and desc.local_scope is not None:
+                    _apply(info, desc.local_scope)
 
-                        if 'local' in desc:
-                            info = self.extract_var(info, desc['local'])
+        return _Info(info)
 
-                        break
+    @staticmethod
+    def narrow_folders(folders, name_prefix):
+        """narrow `like` expressions of listed names to literal prefix of query
 
-        return info
+        :param folders: `list` of `str` like patterns
+        :param name_prefix: `unicode` | None if no name could match
+        :return: `list` of `str`, empty if listing could be skipped
+        """
 
-    def extract_var(self, info, scope):
+        if name_prefix is None:
+            return []
 
-        for token in scope:
+        narrowed = []
+        for folder in folders:
+            folder = narrow_like(folder, name_prefix)
+            if folder is not None and folder not in narrowed:
+                narrowed.append(folder)
 
-            token_type = token['type']
-            token_value = token['value'][0]
-
-            if token_type != 'tag':
-
-                info[token_type] = token_value
-
-            else:
-
-                for tag_name in token_value:
-                    tag_value = token_value[tag_name]
-                    info['tags'][tag_name] = tag_value
-
-        self.log_info(unicode(info) + ' ' + unicode(scope))
-        return info
+        return narrowed
 
     def make_branch(self, path):
 
-        self.log_info('Branch path = ' + path)
+        self.log_debug('Branch path = %s', path)
 
         return BranchNode(path)
 
     def make_leaf(self, path, info):
 
-        self.log_info('Leaf path = ' + path)
+        self.log_debug('Leaf path = %s', path)
 
         entity = info['entity'] if 'entity' in info else '*'
         metric = info['metric']
@@ -221,26 +428,27 @@ class AtsdFinderV(object):
 
     def find_nodes(self, query):
 
+        return metrics.timed_find(self, query.pattern, self._find_nodes(query))
+
+    def _find_nodes(self, query):
+
         try:
 
-            self.log_info('query = ' + query.pattern)
+            self.log_info('query = %s', query.pattern)
 
             if len(query.pattern) == 0:
                 raise StopIteration
 
-            pattern_match = query.pattern
+            matcher = GraphitePattern(query.pattern)
 
-            if query.pattern[-1] == '*':
+            if not matcher.is_literal(-1):
 
                 leaf_request = False
 
-                if len(query.pattern) == 1 or query.pattern[-2] == '.':
-                    pattern = query.pattern[:-2]
+                if '.' in query.pattern:
+                    pattern = query.pattern.rsplit('.', 1)[0]
                 else:
-                    if '.' in query.pattern:
-                        pattern = query.pattern.rsplit('.', 1)[0]
-                    else:
-                        pattern = ''
+                    pattern = ''
 
             else:
 
@@ -248,7 +456,7 @@ class AtsdFinderV(object):
                 pattern = query.pattern
 
             g_info = self.get_info(pattern, leaf_request)
-            self.log_info('initial info = ' + json.dumps(g_info))
+            self.log_debug('initial info = %s', g_info)
 
             if not g_info['valid']:
                 raise StopIteration
@@ -259,7 +467,7 @@ class AtsdFinderV(object):
 
                     path = metric_quote(view_name)
 
-                    if fnmatch.fnmatch(path, pattern_match):
+                    if matcher.match(path):
                         yield self.make_branch(path)
 
             else:
@@ -276,40 +484,20 @@ class AtsdFinderV(object):
                 elif ind < length and not leaf_request:
 
                     level = view[g_info['tokens'] - 1]
-                    self.log_info('level = ' + unicode(level))
-
-                    level_type = level['type']
-                    level_value = level['value']
-
-                    if 'global' in level:
-                        g_info = self.extract_var(g_info, level['global'])
+                    self.log_debug('level = %s', level)
 
-                    self.log_info('global info = ' + json.dumps(g_info))
+                    g_info = g_info.apply(level.global_scope)
+                    self.log_debug('global info = %s', g_info)
 
-                    tokens = []
+                    for desc in level.descs:
 
-                    if level_type == 'collection':
-                        for token in level_value:
-                            tokens.append(token)
-                    else:
-                        tokens.append(level)
+                        info = g_info.apply(desc.local_scope)
+                        self.log_debug('local info = %s', info)
 
-                    self.log_info('descs = ' + unicode(tokens))
-
-                    for token in tokens:
-
-                        info = copy.deepcopy(g_info)
-
-                        if 'local' in token:
-                            info = self.extract_var(info, token['local'])
-
-                        self.log_info('local info = ' + unicode(info))
-
-                        token_type = token['type']
-                        token_value = token['value']
-                        is_leaf = token['is leaf'] if 'is leaf' in token else False
-
-                        prefix = '[' + token['prefix'] + '] ' if 'prefix' in token else ''
+                        token_type = desc.type
+                        token_value = desc.value
+                        is_leaf = desc.is_leaf
+                        prefix = desc.label_prefix
 
                         if token_type == 'const':
 
@@ -317,7 +505,7 @@ class AtsdFinderV(object):
 
                                 path = pattern + '.' + metric_quote(prefix + string)
 
-                                if fnmatch.fnmatch(path, pattern_match):
+                                if matcher.match(path):
 
                                     if not is_leaf:
                                         yield self.make_branch(path)
@@ -326,16 +514,14 @@ class AtsdFinderV(object):
 
                         elif token_type in ['entity folder', 'metric folder']:
 
-                            for folder_dict in token_value:
-
-                                folder = folder_dict.keys()[0]
+                            for folder, label in token_value:
 
                                 if token_type not in info \
                                         or token_type in info and fnmatch.fnmatch(folder, info[token_type]):
 
-                                    path = pattern + '.' + metric_quote(prefix + folder_dict[folder])
+                                    path = pattern + '.' + metric_quote(prefix + label)
 
-                                    if fnmatch.fnmatch(path, pattern_match):
+                                    if matcher.match(path):
 
                                         if not is_leaf:
                                             yield self.make_branch(path)
@@ -366,33 +552,39 @@ class AtsdFinderV(object):
 
                             if not is_leaf and not 'metric' in info:
 
+                                folders = self.narrow_folders(folders, matcher.name_prefix(-1, prefix))
+                                if not folders:
+                                    continue
+
                                 expressions = ['name%20like%20%27' + quote(folder) + '%27' for folder in folders]
                                 tail = '?expression=' + '%20or%20'.join(expressions)
 
                                 url = self.url_base + '/entities' + tail
-                                self.log_info('request_url = ' + url)
+                                self.log_info('request_url = %s', url)
+
+                                response = get_metadata(self.transport, url, ('entities', folders))
 
-                                response = requests.get(url, auth=self.auth)
-                                self.log_info('status = ' + unicode(response.status_code))
+                                for entity in response:
 
-                                for entity in response.json():
+                                    if not matcher.may_match(-1, prefix + entity['name']):
+                                        continue
 
                                     path = pattern + '.' + metric_quote(prefix + entity['name'])
 
-                                    if fnmatch.fnmatch(path, pattern_match):
+                                    if matcher.match(path):
                                         yield self.make_branch(path)
 
                             elif 'metric' in info:
 
                                 url = self.url_base + '/metrics/' + quote(info['metric']) + '/entity-and-tags'
-                                self.log_info('request_url = ' + url)
+                                self.log_info('request_url = %s', url)
 
-                                response = requests.get(url, auth=self.auth)
-                                self.log_info('status = ' + unicode(response.status_code))
+                                response = get_metadata(self.transport, url,
+                                                        ('entity_and_tags', info['metric']))
 
                                 entities = set()
 
-                                for combo in response.json():
+                                for combo in response:
 
                                     entities.add(combo['entity'])
 
@@ -405,18 +597,17 @@ class AtsdFinderV(object):
                                             matches = True
                                             break
 
-                                    if not matches:
+                                    if not matches or not matcher.may_match(-1, prefix + entity):
                                         continue
 
                                     path = pattern + '.' + metric_quote(prefix + entity)
 
-                                    if fnmatch.fnmatch(path, pattern_match):
+                                    if matcher.match(path):
 
                                         if not is_leaf:
                                             yield self.make_branch(path)
                                         else:
-                                            info['entity'] = entity
-                                            yield self.make_leaf(path, info)
+                                            yield self.make_leaf(path, info.set('entity', entity))
 
                         elif token_type == 'metric':
 
@@ -440,45 +631,52 @@ class AtsdFinderV(object):
                             if '*' in folders:
                                 folders = ['*']
 
+                            folders = self.narrow_folders(folders, matcher.name_prefix(-1, prefix))
+                            if not folders:
+                                continue
+
                             expressions = ['name%20like%20%27' + quote(folder) + '%27' for folder in folders]
                             tail = '?expression=' + '%20or%20'.join(expressions)
 
                             if 'entity' not in info:
                                 url = self.url_base + '/metrics'
+                                indexed = ('metrics', folders)
                             else:
                                 url = self.url_base + '/entities/' + quote(info['entity']) + '/metrics'
+                                indexed = ('entity_metrics', info['entity'], folders)
 
                             url += tail
-                            self.log_info('request_url = ' + url)
+                            self.log_info('request_url = %s', url)
+
+                            response = get_metadata(self.transport, url, indexed)
 
-                            response = requests.get(url, auth=self.auth)
-                            self.log_info('status = ' + unicode(response.status_code))
+                            for metric in response:
 
-                            for metric in response.json():
+                                if not matcher.may_match(-1, prefix + metric['name']):
+                                    continue
 
                                 path = pattern + '.' + metric_quote(prefix + metric['name'])
 
-                                if fnmatch.fnmatch(path, pattern_match):
+                                if matcher.match(path):
 
                                     if not is_leaf:
                                         yield self.make_branch(path)
                                     else:
-                                        info['metric'] = metric['name']
-                                        yield self.make_leaf(path, info)
+                                        yield self.make_leaf(path, info.set('metric', metric['name']))
 
                         elif token_type == 'tag':
 
                             if 'metric' in info:
 
                                 url = self.url_base + '/metrics/' + quote(info['metric']) + '/entity-and-tags'
-                                self.log_info('request_url = ' + url)
+                                self.log_info('request_url = %s', url)
 
-                                response = requests.get(url, auth=self.auth)
-                                self.log_info('status = ' + unicode(response.status_code))
+                                response = get_metadata(self.transport, url,
+                                                        ('entity_and_tags', info['metric']))
 
                                 tag_combos = []
 
-                                for combo in response.json():
+                                for combo in response:
 
                                     tags = combo['tags']
 
@@ -515,68 +713,60 @@ class AtsdFinderV(object):
 
                                         path = pattern + '.' + metric_quote(prefix + ', '.join(tag_values))
 
-                                        if fnmatch.fnmatch(path, pattern_match):
+                                        if matcher.match(path):
 
                                             if not is_leaf:
                                                 yield self.make_branch(path)
                                             else:
-                                                t_info = copy.deepcopy(info)
-                                                t_info['tags'].update(tag_combo)
-                                                yield self.make_leaf(path, t_info)
+                                                yield self.make_leaf(path, info.with_tags(tag_combo))
 
                         elif token_type == 'aggregator':
 
-                            for aggregator_dict in token_value:
+                            for aggregator, label in token_value:
 
-                                aggregator = aggregator_dict.keys()[0]
+                                path = pattern + '.' + metric_quote(prefix + label)
 
-                                path = pattern + '.' + metric_quote(prefix + aggregator_dict[aggregator])
-
-                                if fnmatch.fnmatch(path, pattern_match):
+                                if matcher.match(path):
 
                                     if not is_leaf:
                                         yield self.make_branch(path)
                                     elif 'metric' in info:
-                                        info['aggregator'] = aggregator
-                                        yield self.make_leaf(path, info)
+                                        yield self.make_leaf(path, info.set('aggregator', aggregator))
 
                         elif token_type == 'period':
 
-                            for period in token_value:
-
-                                period_label = period['label']
+                            for period_label, period in token_value:
 
                                 path = pattern + '.' + metric_quote(prefix + period_label)
 
-                                if fnmatch.fnmatch(path, pattern_match):
+                                if matcher.match(path):
 
                                     if not is_leaf:
                                         yield self.make_branch(path)
                                     elif 'metric' in info:
-                                        info['period'] = period if period['count'] != 0 else None
-                                        yield self.make_leaf(path, info)
+                                        yield self.make_leaf(path, info.set('period', period))
 
                         elif token_type == 'interval':
 
-                            for interval in token_value:
-
-                                interval_label = interval['label']
+                            for interval_label, interval in token_value:
 
                                 path = pattern + '.' + metric_quote(prefix + interval_label)
 
-                                if fnmatch.fnmatch(path, pattern_match):
+                                if matcher.match(path):
 
                                     if not is_leaf:
                                         yield self.make_branch(path)
                                     elif 'metric' in info:
-                                        info['interval'] = interval if interval['count'] != 0 else None
-                                        yield self.make_leaf(path, info)
+                                        yield self.make_leaf(path, info.set('interval', interval))
 
                 elif leaf_request:
 
                     if 'metric' in g_info:
                         yield self.make_leaf(pattern, g_info)
 
+            # one request for retention of all returned leaves
+            self._client.retentions.resolve(self._client)
+
         except StandardError as e:
 
             self.log_exc(unicode(e))
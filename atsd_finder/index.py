@@ -0,0 +1,333 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from . import metrics
+from . import utils
+from .utils import quote
+
+log = utils.get_logger()
+
+try:
+    # noinspection PyUnresolvedReferences
+    from django.conf import settings
+except:  # debug env
+    from graphite import settings
+
+# seconds since last refresh after which index is not used
+DEFAULT_INDEX_MAX_AGE = 600
+# seconds between checks of index refresh time by a reader
+_STATE_CHECK_INTERVAL = 1
+
+_SCHEMA = ('CREATE TABLE IF NOT EXISTS entities ('
+           'name TEXT PRIMARY KEY, last_insert INTEGER, generation INTEGER)',
+           'CREATE TABLE IF NOT EXISTS metrics ('
+           'name TEXT PRIMARY KEY, last_insert INTEGER, generation INTEGER)',
+           'CREATE TABLE IF NOT EXISTS series ('
+           'metric TEXT, entity TEXT, tags TEXT, last_insert INTEGER, generation INTEGER, '
+           'PRIMARY KEY (metric, entity, tags))',
+           'CREATE INDEX IF NOT EXISTS series_entity ON series (entity, metric)',
+           'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)')
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _text(value):
+    return value.decode('utf8') if isinstance(value, str) else value
+
+
+def _glob(pattern):
+    """
+    :param pattern: `str` atsd like pattern, `*` and `?` wildcards
+    :return: `unicode` equivalent sqlite glob pattern
+    """
+
+    return _text(pattern).lower().replace('[', '[[]').replace(']', '[]]')
+
+
+def _insert_time(item):
+    """
+    :param item: `dict` entity, metric or series json
+    :return: `int` milliseconds | None
+    """
+
+    value = item.get('lastInsertTime')
+    return int(value) if isinstance(value, (int, long, float)) else None
+
+
+def _format_date(ms):
+    """
+    :param ms: `int` milliseconds
+    :return: `str` iso 8601 date accepted by minInsertDate
+    """
+
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ms // 1000)) + '.%03dZ' % (ms % 1000)
+
+
+class MetadataIndex(object):
+    """sqlite file of entities, metrics and series tags
+
+    written by a single refresher, see bin/metadata_index.py, and read by
+    all graphite-web workers, refresh requests only names inserted since
+    the greatest lastInsertTime of the previous one
+
+    lookups return responses in the shape of the atsd api they replace,
+    or None if the file is missing, older than max_age or has no answer
+    """
+
+    def __init__(self, path, max_age=DEFAULT_INDEX_MAX_AGE):
+        """
+        :param path: `str` index file
+        :param max_age: `Number` seconds since refresh the index is trusted
+        """
+
+        self.path = path
+        self.max_age = max_age
+
+        self._local = threading.local()
+        self._checked = 0
+        self._fresh = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self, create=False):
+        """
+        :return: thread's `sqlite3.Connection` | None if file is missing
+        """
+
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            if not create and not os.path.exists(self.path):
+                return None
+
+            db = sqlite3.connect(self.path, timeout=30)
+            if create:
+                db.execute('PRAGMA journal_mode = WAL')
+                for statement in _SCHEMA:
+                    db.execute(statement)
+                db.commit()
+            self._local.db = db
+
+        return db
+
+    def _state(self, db, key, default=None):
+        row = db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def _usable(self):
+        """
+        :return: `sqlite3.Connection` if index was refreshed within max_age | None
+        """
+
+        try:
+            db = self._connection()
+            if db is None:
+                return None
+
+            now = time.time()
+            if now - self._checked >= _STATE_CHECK_INTERVAL:
+                refreshed = self._state(db, 'refreshed', 0)
+                self._fresh = now - refreshed < self.max_age
+                self._checked = now
+
+            return db if self._fresh else None
+
+        except sqlite3.Error as e:
+            log.warning('index %s is not readable: %s', self, self.path, e, sample=100)
+            return None
+
+    def _answer(self, result):
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def _names(self, db, query, args, patterns):
+        names = set()
+        for pattern in patterns:
+            for row in db.execute(query, args + (_glob(pattern),)):
+                names.add(row[0])
+        return [{'name': name} for name in sorted(names)]
+
+    def entities(self, patterns):
+        """
+        :param patterns: `list` of `str` like patterns of names
+        :return: [{name}] like /entities | None
+        """
+
+        db = self._usable()
+        if db is None:
+            return self._answer(None)
+
+        return self._answer(self._names(db, 'SELECT name FROM entities WHERE name GLOB ?',
+                                        (), patterns))
+
+    def metrics(self, patterns):
+        """
+        :param patterns: `list` of `str` like patterns of names
+        :return: [{name}] like /metrics | None
+        """
+
+        db = self._usable()
+        if db is None:
+            return self._answer(None)
+
+        return self._answer(self._names(db, 'SELECT name FROM metrics WHERE name GLOB ?',
+                                        (), patterns))
+
+    def entity_metrics(self, entity, patterns):
+        """
+        :param entity: `str` entity name
+        :param patterns: `list` of `str` like patterns of metric names
+        :return: [{name}] like /entities/{entity}/metrics | None if entity is unknown
+        """
+
+        db = self._usable()
+        if db is None:
+            return self._answer(None)
+
+        entity = _text(entity).lower()
+        if db.execute('SELECT 1 FROM entities WHERE name = ?', (entity,)).fetchone() is None:
+            return self._answer(None)
+
+        return self._answer(self._names(db, 'SELECT DISTINCT metric FROM series '
+                                            'WHERE entity = ? AND metric GLOB ?',
+                                        (entity,), patterns))
+
+    def entity_and_tags(self, metric):
+        """
+        :param metric: `str` metric name
+        :return: [{entity, tags}] like /metrics/{metric}/entity-and-tags | None if metric is unknown
+        """
+
+        db = self._usable()
+        if db is None:
+            return self._answer(None)
+
+        metric = _text(metric).lower()
+        if db.execute('SELECT 1 FROM metrics WHERE name = ?', (metric,)).fetchone() is None:
+            return self._answer(None)
+
+        rows = db.execute('SELECT entity, tags FROM series WHERE metric = ?', (metric,))
+        return self._answer([{'entity': entity, 'tags': json.loads(tags)}
+                             for entity, tags in rows])
+
+    def refresh(self, transport, url_base, full=False):
+        """request entities and metrics inserted since previous refresh,
+        and series of those metrics, and store them in one transaction
+
+        full refresh requests everything and removes entities, metrics
+        and series which are no longer returned
+
+        :param transport: :class:`.Transport`
+        :param url_base: `str` atsd url ending with /api/v1
+        :param full: `bool`
+        :return: `dict` entities, metrics, series: `int` updated rows
+        """
+
+        db = self._connection(create=True)
+
+        watermark = None if full else self._state(db, 'watermark')
+        generation = self._state(db, 'generation', 0) + 1
+        params = {} if watermark is None else {'minInsertDate': _format_date(watermark)}
+        highest = watermark or 0
+
+        entities = self._request(transport, url_base + '/entities', params)
+        metric_list = self._request(transport, url_base + '/metrics', params)
+        series = 0
+
+        with db:
+            for item in entities:
+                highest = max(highest, _insert_time(item))
+                db.execute('INSERT OR REPLACE INTO entities VALUES (?, ?, ?)',
+                           (item['name'].lower(), _insert_time(item), generation))
+
+            for item in metric_list:
+                highest = max(highest, _insert_time(item))
+                name = item['name'].lower()
+                db.execute('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?)',
+                           (name, _insert_time(item), generation))
+
+                combos = self._request(transport,
+                                       url_base + '/metrics/' + quote(name) + '/entity-and-tags',
+                                       params)
+                for combo in combos:
+                    db.execute('INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)',
+                               (name, combo['entity'].lower(),
+                                json.dumps(combo['tags'], sort_keys=True),
+                                _insert_time(combo), generation))
+                series += len(combos)
+
+            if watermark is None:
+                for table in ('entities', 'metrics', 'series'):
+                    db.execute('DELETE FROM ' + table + ' WHERE generation < ?', (generation,))
+
+            for key, value in (('watermark', highest or None),
+                               ('generation', generation),
+                               ('refreshed', time.time())):
+                db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+        self._checked = 0
+
+        updated = {'entities': len(entities), 'metrics': len(metric_list), 'series': series}
+        log.info('refreshed %s: %s', self, self.path, updated)
+        return updated
+
+    @staticmethod
+    def _request(transport, url, params):
+        response = transport.get(url, params=params)
+
+        if response.status_code != 200:
+            raise RuntimeError('server response status_code={:d} {:s}'
+                               .format(response.status_code, response.text))
+
+        return response.json()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0}
+
+
+def get_index():
+    """process-wide index configured with ATSD_CONF metadata_index and
+    metadata_index_max_age
+
+    :return: :class:`.MetadataIndex` | None if not configured
+    """
+
+    global _index
+
+    path = settings.ATSD_CONF.get('metadata_index')
+    if not path:
+        return None
+
+    if _index is None or _index.path != path:
+        with _index_lock:
+            if _index is None or _index.path != path:
+                _index = MetadataIndex(path, settings.ATSD_CONF.get('metadata_index_max_age',
+                                                                    DEFAULT_INDEX_MAX_AGE))
+
+    return _index
+
+
+def lookup(method, *args):
+    """
+    :param method: `str` lookup method of :class:`.MetadataIndex`
+    :return: response json | None if index is disabled or has no answer
+    """
+
+    index = get_index()
+    if index is None:
+        return None
+
+    return getattr(index, method)(*args)
+
+
+metrics.register_cache('index', lambda: get_index() and get_index().stats())
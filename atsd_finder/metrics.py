@@ -0,0 +1,368 @@
+import bisect
+import os
+import threading
+import time
+
+from . import utils
+
+log = utils.get_logger()
+
+try:
+    # noinspection PyUnresolvedReferences
+    from django.conf import settings
+except:  # debug env
+    from graphite import settings
+
+DEFAULT_METRICS_INTERVAL = 10
+
+# seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+# queries, series or points
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+                25000, 100000, 1000000)
+
+
+class Counter(object):
+    """monotonic value per label values"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param name: `str`
+        :param help: `str`
+        :param labels: `tuple` of `str` label names
+        """
+
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+        self._lock = threading.Lock()
+        #: label values `tuple` -> `Number`
+        self._values = {}
+
+    def inc(self, value=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def collect(self):
+        """
+        :return: {label values `tuple`: `Number`}
+        """
+
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram(object):
+    """count of observed values by upper bucket bound, their sum and count,
+    per label values
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: `tuple` of `Number` sorted upper bounds, +Inf is implied
+        """
+
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        #: label values `tuple` -> [counts per bucket + 1, sum]
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, *label_values):
+        """
+        :return: context manager observing seconds spent in its block
+        """
+
+        return _Timer(self, label_values)
+
+    def collect(self):
+        """
+        :return: {label values `tuple`: {buckets: [(bound, cumulative count)],
+            sum: `Number`, count: `int`}}
+        """
+
+        with self._lock:
+            values = dict((k, (list(v[0]), v[1])) for k, v in self._values.items())
+
+        result = {}
+        for label_values, (counts, total) in values.items():
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                buckets.append((bound, cumulative))
+            result[label_values] = {'buckets': buckets, 'sum': total, 'count': cumulative}
+
+        return result
+
+
+class Gauge(object):
+    """values read from callback when collected, costs nothing until then"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels, callback):
+        """
+        :param callback: `.Function` () -> {label values `tuple`: `Number`}
+        """
+
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._callback = callback
+
+    def collect(self):
+        try:
+            return self._callback()
+        except Exception as e:
+            log.exception('metric %s callback failed: %s', 'Metrics', self.name, e)
+            return {}
+
+
+class _Timer(object):
+
+    __slots__ = ('_histogram', '_labels', '_start')
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.time() - self._start, *self._labels)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #: `list` of metrics in registration order
+        self._metrics = []
+        #: name -> metric
+        self._names = {}
+        self._written = 0
+
+    def register(self, metric):
+        """
+        :param metric: :class:`.Counter` | :class:`.Histogram` | :class:`.Gauge`
+        :return: metric registered under its name before, or the given one
+        """
+
+        with self._lock:
+            if metric.name in self._names:
+                return self._names[metric.name]
+            self._names[metric.name] = metric
+            self._metrics.append(metric)
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, labels, callback):
+        return self.register(Gauge(name, help, labels, callback))
+
+    def snapshot(self):
+        """
+        :return: {name: {type, help, labels, values: {label values `tuple`: value}}}
+        """
+
+        with self._lock:
+            metrics = list(self._metrics)
+
+        return dict((m.name, {'type': m.type,
+                              'help': m.help,
+                              'labels': m.labels,
+                              'values': m.collect()})
+                    for m in metrics)
+
+    def exposition(self):
+        """
+        :return: `str` prometheus text format
+        """
+
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP ' + metric.name + ' ' + metric.help)
+            lines.append('# TYPE ' + metric.name + ' ' + metric.type)
+
+            for label_values, value in sorted(metric.collect().items()):
+                pairs = zip(metric.labels, label_values)
+
+                if metric.type != 'histogram':
+                    lines.append(metric.name + _format_labels(pairs) + ' ' + _format_value(value))
+                    continue
+
+                for bound, count in value['buckets']:
+                    le = '+Inf' if bound == float('inf') else _format_value(bound)
+                    lines.append(metric.name + '_bucket' + _format_labels(pairs + [('le', le)])
+                                 + ' ' + str(count))
+                lines.append(metric.name + '_sum' + _format_labels(pairs)
+                             + ' ' + _format_value(value['sum']))
+                lines.append(metric.name + '_count' + _format_labels(pairs)
+                             + ' ' + str(value['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def maybe_write(self):
+        """write exposition to ATSD_CONF metrics_file if metrics_interval has passed"""
+
+        conf = settings.ATSD_CONF
+        path = conf.get('metrics_file')
+        if not path:
+            return
+
+        now = time.time()
+        with self._lock:
+            if now - self._written < conf.get('metrics_interval', DEFAULT_METRICS_INTERVAL):
+                return
+            self._written = now
+
+        try:
+            write_file(path, self.exposition())
+        except (IOError, OSError) as e:
+            log.exception('could not write metrics to %s: %s', 'Metrics', path, e)
+
+
+def write_file(path, content):
+    """replace file atomically, so scraper never reads a partial one"""
+
+    temp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp, 'w') as f:
+        f.write(content)
+    os.rename(temp, path)
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(name + '="' + unicode(value).replace('\\', '\\\\')
+                          .replace('"', '\\"').replace('\n', '\\n') + '"'
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+_caches = {}
+
+
+def register_cache(name, stats):
+    """report hits and misses of a cache
+
+    :param name: `str` cache label
+    :param stats: `.Function` () -> `dict` with hits, misses, hit_ratio | None if disabled
+    """
+
+    _caches[name] = stats
+
+
+def _cache_values(key):
+    values = {}
+    for name, stats in _caches.items():
+        cache_stats = stats()
+        if cache_stats is not None:
+            values[(name,)] = cache_stats[key]
+    return values
+
+
+def timed_find(finder, pattern, nodes):
+    """record time spent producing nodes of find_nodes generator
+
+    :param finder: finder instance
+    :param pattern: `str` graphite query pattern
+    :param nodes: `generator` of nodes
+    :return: `generator` of nodes
+    """
+
+    labels = (type(finder).__name__, str(pattern.count('.') + 1 if pattern else 0))
+    spent = 0
+    found = 0
+
+    try:
+        while True:
+            start = time.time()
+            try:
+                node = next(nodes)
+            finally:
+                spent += time.time() - start
+            found += 1
+            yield node
+    except StopIteration:
+        pass
+    finally:
+        FIND_DURATION.observe(spent, *labels)
+        FIND_NODES.inc(found, *labels)
+        registry.maybe_write()
+
+
+#: process-wide :class:`.Registry`
+registry = Registry()
+
+FIND_DURATION = registry.histogram('atsd_find_duration_seconds',
+                                   'time spent in find_nodes',
+                                   ('finder', 'depth'))
+FIND_NODES = registry.counter('atsd_find_nodes_total',
+                              'nodes returned by find_nodes',
+                              ('finder', 'depth'))
+HTTP_DURATION = registry.histogram('atsd_http_request_duration_seconds',
+                                   'time to response headers of atsd api requests',
+                                   ('endpoint',))
+HTTP_REQUESTS = registry.counter('atsd_http_requests_total',
+                                 'atsd api requests by response status, 0 if failed',
+                                 ('endpoint', 'status'))
+FETCH_DURATION = registry.histogram('atsd_fetch_duration_seconds',
+                                    'time from first fetch of a client to last result')
+BATCH_QUERIES = registry.histogram('atsd_batch_queries',
+                                   'queries of a batch before and after merging',
+                                   ('stage',), SIZE_BUCKETS)
+BATCH_SERIES = registry.histogram('atsd_batch_series',
+                                  'series received by one batch request',
+                                  (), SIZE_BUCKETS)
+SERIES_POINTS = registry.histogram('atsd_series_points',
+                                   'samples in one received series',
+                                   (), SIZE_BUCKETS)
+REGULARIZE_DURATION = registry.histogram('atsd_regularize_duration_seconds',
+                                         'time to regularize one series',
+                                         ('implementation',))
+METADATA_RELOADS = registry.counter('atsd_metadata_reloads_total',
+                                   'metadata reloaded ahead of expiration by refresher',
+                                   ('result',))
+registry.gauge('atsd_cache_hits', 'cache lookups answered from cache', ('cache',),
+               lambda: _cache_values('hits'))
+registry.gauge('atsd_cache_misses', 'cache lookups loading value', ('cache',),
+               lambda: _cache_values('misses'))
+registry.gauge('atsd_cache_hit_ratio', 'hits of all cache lookups', ('cache',),
+               lambda: _cache_values('hit_ratio'))
@@ -0,0 +1,217 @@
+import re
+
+from .utils import unquote
+
+# characters which start wildcard part of token
+_WILDCARDS = '*?[{'
+
+
+def _translate(token):
+    """translate graphite glob token to regex,
+    supports `*`, `?`, `[...]`, `[!...]` and `{a,b}` alternation
+
+    :param token: `str` one dot-free token of pattern
+    :return: `str` regex without anchors
+    """
+
+    i, n = 0, len(token)
+    res = ''
+
+    while i < n:
+        c = token[i]
+        i += 1
+
+        if c == '*':
+            res += '.*'
+
+        elif c == '?':
+            res += '.'
+
+        elif c == '[':
+            j = i
+            if j < n and token[j] == '!':
+                j += 1
+            if j < n and token[j] == ']':
+                j += 1
+            while j < n and token[j] != ']':
+                j += 1
+
+            if j >= n:
+                res += '\\['
+            else:
+                stuff = token[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] == '!':
+                    stuff = '^' + stuff[1:]
+                elif stuff[0] == '^':
+                    stuff = '\\' + stuff
+                res += '[' + stuff + ']'
+
+        elif c == '{':
+            depth = 1
+            j = i
+            alternatives = []
+            start = i
+            while j < n and depth:
+                if token[j] == '{':
+                    depth += 1
+                elif token[j] == '}':
+                    depth -= 1
+                elif token[j] == ',' and depth == 1:
+                    alternatives.append(token[start:j])
+                    start = j + 1
+                j += 1
+
+            if depth:
+                res += '\\{'
+            else:
+                alternatives.append(token[start:j - 1])
+                res += '(?:' + '|'.join(_translate(a) for a in alternatives) + ')'
+                i = j
+
+        else:
+            res += re.escape(c)
+
+    return res
+
+
+def _literal_prefix(token):
+    """
+    :param token: `str` quoted pattern token
+    :return: `unicode` unquoted part before the first wildcard
+    """
+
+    end = len(token)
+    for c in _WILDCARDS:
+        position = token.find(c)
+        if position != -1:
+            end = min(end, position)
+
+    prefix = token[:end]
+
+    # incomplete escape sequence could not be unquoted
+    percent = prefix.rfind('%', max(0, len(prefix) - 2))
+    if percent != -1:
+        prefix = prefix[:percent]
+
+    # bytes of character cut by wildcard are dropped
+    return unquote(prefix).decode('utf8', 'ignore')
+
+
+class GraphitePattern(object):
+    """graphite find pattern compiled once per query
+
+    path matches if it has the same number of tokens and each token matches,
+    which for paths built by finders is the same as fnmatch on the whole path
+    """
+
+    __slots__ = ('pattern', 'tokens', '_matchers', '_prefixes')
+
+    def __init__(self, pattern):
+        """
+        :param pattern: `str` quoted dot separated pattern
+        """
+
+        #: `str`
+        self.pattern = pattern
+        #: `list` of `str` quoted tokens
+        self.tokens = pattern.split('.')
+
+        self._matchers = [re.compile('(?:' + _translate(t) + ')\\Z', re.S).match
+                          for t in self.tokens]
+        self._prefixes = [_literal_prefix(t) for t in self.tokens]
+
+    def match(self, path):
+        """
+        :param path: `str` quoted dot separated path
+        :return: `bool`
+        """
+
+        tokens = path.split('.')
+
+        if len(tokens) != len(self.tokens):
+            return False
+
+        for matcher, token in zip(self._matchers, tokens):
+            if matcher(token) is None:
+                return False
+
+        return True
+
+    def match_token(self, index, token):
+        """
+        :param index: `int` token position, negative from the end
+        :param token: `str` quoted token
+        :return: `bool`
+        """
+
+        return self._matchers[index](token) is not None
+
+    def prefix(self, index):
+        """
+        :param index: `int` token position, negative from the end
+        :return: `unicode` unquoted literal prefix of token
+        """
+
+        return self._prefixes[index]
+
+    def is_literal(self, index):
+        """
+        :param index: `int` token position, negative from the end
+        :return: `bool` token has no wildcards
+        """
+
+        token = self.tokens[index]
+        return not any(c in token for c in _WILDCARDS)
+
+    def may_match(self, index, name):
+        """cheap check of unquoted name before quoting and full match
+
+        :param index: `int` token position, negative from the end
+        :param name: `unicode` unquoted name
+        :return: `bool` False if name could not match token
+        """
+
+        return name.startswith(self._prefixes[index])
+
+    def name_prefix(self, index, label=''):
+        """literal prefix of names listed for token, path token is label + name
+
+        :param index: `int` token position, negative from the end
+        :param label: `unicode` unquoted constant part before name
+        :return: `unicode` | None if no name could match token
+        """
+
+        prefix = self._prefixes[index]
+
+        if prefix.startswith(label):
+            return prefix[len(label):]
+
+        if label.startswith(prefix):
+            return ''
+
+        return None
+
+
+def narrow_like(expression, prefix):
+    """narrow atsd `like` pattern with literal prefix of wanted names
+
+    :param expression: `str` like pattern, e.g. 'a*'
+    :param prefix: `unicode` unquoted literal prefix
+    :return: `str` narrowed pattern | None if no name matches both
+    """
+
+    if not prefix or any(c in prefix for c in "'*?\\"):
+        return expression
+
+    literal = expression.rstrip('*')
+    if '*' in literal or '?' in literal or literal + '*' != expression:
+        return expression
+
+    if prefix.startswith(literal):
+        return prefix + '*'
+
+    if literal.startswith(prefix):
+        return expression
+
+    return None
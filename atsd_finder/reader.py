@@ -1,16 +1,27 @@
 import ConfigParser
 import fnmatch
+import math
 import re
 import os
+import time
 import datetime
 import calendar
 import pytz
 
+from . import metrics
 from . import utils
 from graphite.intervals import Interval, IntervalSet
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 log = utils.get_logger()
 
+# shorter series are regularized in pure python, array setup costs more
+NUMPY_MIN_SAMPLES = 256
+
 try:
     # noinspection PyUnresolvedReferences
     from django.conf import settings
@@ -72,11 +83,15 @@ def _time_minus_days(ts, days):
     resdt_local = tz_local.localize(resdt_naive)
     resdt_utc = resdt_local.astimezone(tz_utc)
 
-    log.info(str(dt_local) + ' - ' + str(days) + 'days = ' + str(resdt_local), 'AtsdReader')
+    log.debug('%s - %sdays = %s', 'AtsdReader', dt_local, days, resdt_local)
 
     return calendar.timegm(resdt_utc.timetuple())
 
 
+# units accepted by _time_minus_interval
+INTERVAL_UNITS = ('MILLISECOND', 'SECOND', 'MINUTE', 'HOUR', 'DAY', 'WEEK', 'MONTH', 'QUARTER', 'YEAR')
+
+
 def _time_minus_interval(end_time, interval):
     """substract given interval from end_time
 
@@ -147,6 +162,35 @@ def _round_step(step):
     return step
 
 
+# round group periods in seconds for point limited fetch
+GROUP_STEPS = (1, 2, 5, 10, 30, 60, 2 * 60, 5 * 60, 10 * 60, 30 * 60,
+               60 * 60, 2 * 60 * 60, 6 * 60 * 60, 12 * 60 * 60,
+               24 * 60 * 60, 7 * 24 * 60 * 60, 28 * 24 * 60 * 60)
+
+DEFAULT_GROUP_TYPE = 'AVG'
+
+
+def _group_step(start_time, end_time, max_points):
+    """smallest round period returning at most max_points for interval,
+    depends on interval length only, so all series of a render share it
+
+    :param start_time: `Number` seconds
+    :param end_time: `Number` seconds
+    :param max_points: `int`
+    :return: `Number` seconds
+    """
+
+    # unaligned interval ends in partial periods, one more point
+    wanted = float(end_time - start_time) / max(max_points - 1, 1)
+
+    for step in GROUP_STEPS:
+        if step >= wanted:
+            return step
+
+    # longer than the largest round period: whole number of them
+    return GROUP_STEPS[-1] * int(-(-wanted // GROUP_STEPS[-1]))
+
+
 def _median_delta(values):
     """get array of delta, find median value
     values should be sorted
@@ -172,6 +216,18 @@ def _regularize(series, step=None):
     :return: time_info, values
     """
 
+    if numpy is not None and len(series) >= NUMPY_MIN_SAMPLES:
+        with metrics.REGULARIZE_DURATION.time('numpy'):
+            return _regularize_numpy(series, step)
+
+    with metrics.REGULARIZE_DURATION.time('python'):
+        return _regularize_python(series, step)
+
+
+def _regularize_python(series, step=None):
+    """reference implementation of :func:`._regularize`
+    """
+
     # for sample in series:
     #     print(sample)
     times = [sample['t'] / 1000.0 for sample in series]
@@ -215,6 +271,62 @@ def _regularize(series, step=None):
     return time_info, values
 
 
+def _regularize_numpy(series, step=None):
+    """vectorized :func:`._regularize_python`, gives the same result
+
+    python version walks slots and takes next sample if it is closer than step
+    to the slot. For sample k let [lo_k, hi_k] be the slots close enough to it,
+    then the sample goes to slot s_k = max(lo_k, s_(k-1) + 1), which unrolls to
+    s_k = k + max(lo_j - j, j <= k). Placement stops at the first sample
+    with s_k > hi_k: python version never moves past it.
+    """
+
+    count = len(series)
+    times = numpy.fromiter((sample['t'] for sample in series),
+                           numpy.float64, count) / 1000.0
+
+    if step is None:
+        deltas = numpy.diff(times)
+        middle = len(deltas) // 2
+        step = float(numpy.partition(deltas, middle)[middle])
+        step = _round_step(step)
+
+    # round to divisible by step
+    start_time = ((series[0]['t'] / 1000.0) // step) * step
+    end_time = ((series[-1]['t'] / 1000.0) // step + 1) * step
+
+    number_points = int(round((end_time - start_time) / step))
+
+    # slots around sample which may satisfy |time - slot_time| < step
+    estimate = numpy.floor((times - start_time) / step).astype(numpy.int64)
+    candidates = estimate[:, None] + numpy.arange(-1, 3)
+    close = (numpy.abs(times[:, None] - (start_time + candidates * step)) < step) \
+        & (candidates >= 0)
+
+    has_close = close.any(axis=1)
+    lo = numpy.where(close, candidates, numpy.iinfo(numpy.int64).max).min(axis=1)
+    hi = numpy.where(close, candidates, -1).max(axis=1)
+
+    index = numpy.arange(count)
+    slots = index + numpy.maximum.accumulate(numpy.where(has_close, lo - index, 0))
+    placed = has_close & (slots <= hi)
+
+    if not placed.all():
+        placed[numpy.argmin(placed):] = False
+
+    placed &= slots < number_points
+
+    values = numpy.empty(number_points, dtype=object)
+    values[slots[placed]] = numpy.array([sample['v'] for sample in series],
+                                        dtype=object)[placed]
+
+    time_info = (start_time,
+                 start_time + number_points * step,
+                 step)
+
+    return time_info, values.tolist()
+
+
 class Aggregator(object):
     __slots__ = ('type', 'count', 'unit', 'interpolate')
 
@@ -265,6 +377,103 @@ class Aggregator(object):
                                                               self.unit)
 
 
+def _parse_retentions(retentions):
+    """
+    :param retentions: `str` of form 'step:interval[:type], ...'
+    :return: `dict` interval `(count, unit)` -> `.Aggregator` | None
+    """
+
+    items = re.split('\s*,\s*', retentions)  # list of str
+
+    intervals = {}
+    for item in items:
+        tokens = item.split(':')
+
+        interval = _str_to_interval(tokens[1])
+        step_count, step_unit = _str_to_interval(tokens[0])
+        type = tokens[2].upper() if len(tokens) == 3 else 'AVG'
+
+        if step_count == 0:
+            intervals[interval] = None
+        else:
+            intervals[interval] = Aggregator(type, step_count, step_unit)
+
+    return intervals
+
+
+class _SchemaConfig(object):
+    """interval-schema.conf compiled into ordered (matcher, intervals) sections,
+    resolved intervals are memoized by path
+    """
+
+    # resolved paths kept at most
+    MEMO_SIZE = 100000
+
+    def __init__(self, conf_name):
+        """
+        :param conf_name: `str` config path
+        """
+
+        self.conf_name = conf_name
+        self.mtime = _mtime(conf_name)
+
+        config = ConfigParser.RawConfigParser()
+        config.read(conf_name)
+        log.info('sections=%s', 'IntervalSchema', config.sections())
+
+        #: `list` of (`.Function` path -> match | None, intervals `dict`)
+        self.sections = []
+
+        for section in config.sections():
+            try:
+                # intervals has form 'x:y, z:t'
+                intervals = _parse_retentions(config.get(section, 'retentions'))
+            except Exception as e:
+                log.exception('could not parse section %s in %s: %s', 'IntervalSchema',
+                              section, conf_name, e)
+                continue
+
+            if config.has_option(section, 'metric-pattern'):
+                metric_pattern = config.get(section, 'metric-pattern')
+                matcher = re.compile(fnmatch.translate(metric_pattern)).match
+            else:
+                matcher = None
+
+            self.sections.append((matcher, intervals))
+
+        self._memo = {}
+
+    def resolve(self, path):
+        """
+        :param path: `str` metric name
+        :return: intervals of the first matching section, should not be modified
+        """
+
+        try:
+            return self._memo[path]
+        except KeyError:
+            pass
+
+        intervals = {}
+        for matcher, section_intervals in self.sections:
+            if matcher is None or matcher(path):
+                intervals = section_intervals
+                break
+
+        if len(self._memo) >= self.MEMO_SIZE:
+            self._memo = {}
+        self._memo[path] = intervals
+
+        return intervals
+
+
+def _mtime(conf_name):
+    try:
+        return os.stat(conf_name).st_mtime
+    except OSError:
+        return None
+
+
 class IntervalSchema(object):
     # _map: interval `(count, unit)` -> `.Aggregator` | None
 
@@ -272,51 +481,42 @@ class IntervalSchema(object):
 
     CONF_NAME = os.path.join(settings.CONF_DIR, 'interval-schema.conf')
 
-    _config = ConfigParser.RawConfigParser()
-    _config.read(CONF_NAME)
-    log.info('sections=' + str(_config.sections()), 'IntervalSchema')
+    # seconds between config modification checks
+    RELOAD_CHECK_INTERVAL = 5
+
+    _compiled = _SchemaConfig(CONF_NAME)
+    _checked = time.time()
 
     def __init__(self, path):
         """
         :param path: `str` metric name
         """
 
-        def section_matches(section_):
+        self._map = IntervalSchema._config().resolve(path)
 
-            if self._config.has_option(section_, 'metric-pattern'):
-                metric_pattern = self._config.get(section_, 'metric-pattern')
-                return fnmatch.fnmatch(path, metric_pattern)
-            return True
-
-        for section in self._config.sections():
-            if section_matches(section):
-
-                try:
-                    # intervals has form 'x:y, z:t'
-                    intervals = self._config.get(section, 'retentions')  # str
-                    items = re.split('\s*,\s*', intervals)  # list of str
+    def is_defined(self):
+        """
+        :return: `bool` some section matches the path
+        """
 
-                    self._map = {}
-                    for item in items:
-                        tokens = item.split(':')
+        return bool(self._map)
 
-                        interval = _str_to_interval(tokens[1])
-                        step_count, step_unit = _str_to_interval(tokens[0])
-                        type = tokens[2].upper() if len(tokens) == 3 else 'AVG'
+    @staticmethod
+    def _config():
+        """compiled config, reloaded when file modification time changes
 
-                        if step_count == 0:
-                            self._map[interval] = None
-                        else:
-                            self._map[interval] = Aggregator(type, step_count, step_unit)
+        :return: :class:`._SchemaConfig`
+        """
 
-                    return
+        now = time.time()
+        if now - IntervalSchema._checked >= IntervalSchema.RELOAD_CHECK_INTERVAL:
+            IntervalSchema._checked = now
 
-                except Exception as e:
-                    log.exception('could not parse section {:s} in {:s}'
-                                  .format(section, IntervalSchema.CONF_NAME)
-                                  + unicode(e), self)
+            if _mtime(IntervalSchema.CONF_NAME) != IntervalSchema._compiled.mtime:
+                log.info('reload %s', 'IntervalSchema', IntervalSchema.CONF_NAME)
+                IntervalSchema._compiled = _SchemaConfig(IntervalSchema.CONF_NAME)
 
-        self._map = {}
+        return IntervalSchema._compiled
 
     def aggregator(self, end_time, start_time, interval):
         """find step for current interval using interval schema
@@ -386,22 +586,28 @@ class AtsdReader(object):
         self._interval_schema = IntervalSchema(instance.path)
 
         if default_interval:
-            default_interval['unit'] = default_interval['unit'].upper()
+            default_interval = dict(default_interval, unit=default_interval['unit'].upper())
         #: {unit: `str`, count: `Number`} | None
         self.default_interval = default_interval
 
-        log.info('init: entity=' + unicode(instance.entity_name)
-                 + ' metric=' + unicode(instance.metric_name)
-                 + ' tags=' + unicode(instance.tags)
-                 + ' aggregator=' + unicode(aggregator)
-                 + ' interval=' + unicode(default_interval),
-                 'AtsdReader:' + str(id(self)))
+        if log.enabled('debug'):
+            log.debug('init: entity=%s metric=%s tags=%s aggregator=%s interval=%s',
+                      'AtsdReader:' + str(id(self)), instance.entity_name,
+                      instance.metric_name, instance.tags, aggregator, default_interval)
 
-    def fetch(self, start_time, end_time):
+    def fetch(self, start_time, end_time, now=None, requestContext=None):
         """fetch time series
 
+        if no interval schema is defined for the path, data is grouped so
+        at most maxDataPoints of render context, or max_data_points setting,
+        are returned
+
+        series not received before render deadline is filled with None
+
         :param start_time: `Number` seconds
         :param end_time: `Number` seconds
+        :param now: `Number` seconds, unused
+        :param requestContext: `dict` graphite-web render context | None
         :return: :class:`.FetchInProgress`
         """
 
@@ -412,11 +618,15 @@ class AtsdReader(object):
         #          .format(strf_timestamp(start_time), strf_timestamp(end_time)),
         #          self)
 
+        deadline = self._instance.render_deadline(requestContext)
+
         if self.aggregator:
             aggregator = self.aggregator
-        else:
+        elif self._interval_schema.is_defined():
             aggregator = self._interval_schema.aggregator(end_time, start_time,
                                                           self.default_interval)
+        else:
+            aggregator = self._limit_points(start_time, end_time, requestContext)
 
         def format_series(series):
             """
@@ -446,16 +656,51 @@ class AtsdReader(object):
             else:
                 time_info, values = _regularize(series)
 
-            log.info('fetched {0} samples, interval={1} - {2}, step={3}sec'
-                     .format(len(series),
-                             utils.strf_timestamp(time_info[0]),
-                             utils.strf_timestamp(time_info[1]),
-                             time_info[2]),
-                     'AtsdReader:' + str(id(self)))
+            if log.enabled('debug'):
+                log.debug('fetched %d samples, interval=%s - %s, step=%ssec',
+                          'AtsdReader:' + str(id(self)), len(series),
+                          utils.strf_timestamp(time_info[0]),
+                          utils.strf_timestamp(time_info[1]),
+                          time_info[2])
 
             return time_info, values
 
-        return self._instance.fetch_series(start_time, end_time, aggregator, format_series)
+        def format_late():
+            """series not received before render deadline
+
+            :return: (start, end, step), [None, ...]
+            """
+
+            if aggregator and aggregator.unit == 'SECOND' and aggregator.type != 'DETAIL':
+                step = aggregator.count
+                start = (start_time // step) * step
+            else:
+                step = max(end_time - start_time, 1)
+                start = start_time
+
+            count = max(1, int(math.ceil((end_time - start) / float(step))))
+
+            return (start, start + count * step, step), [None] * count
+
+        return self._instance.fetch_series(start_time, end_time, aggregator, format_series,
+                                           deadline, format_late)
+
+    @staticmethod
+    def _limit_points(start_time, end_time, request_context):
+        """
+        :param request_context: `dict` | None
+        :return: :class:`.Aggregator` | None if points are not limited
+        """
+
+        max_points = (request_context or {}).get('maxDataPoints') \
+            or settings.ATSD_CONF.get('max_data_points')
+
+        if not max_points or end_time <= start_time:
+            return None
+
+        step = _group_step(start_time, end_time, int(max_points))
+
+        return Aggregator(settings.ATSD_CONF.get('group_type', DEFAULT_GROUP_TYPE), step)
 
     def get_intervals(self):
         """
@@ -0,0 +1,290 @@
+import bisect
+import collections
+import json
+import threading
+import time
+
+from . import metrics
+from . import utils
+
+log = utils.get_logger()
+
+try:
+    # noinspection PyUnresolvedReferences
+    from django.conf import settings
+except:  # debug env
+    from graphite import settings
+
+DEFAULT_BLOCK_SIZE = 60 * 60
+DEFAULT_SETTLE = 10 * 60
+
+# approximate memory of one cached sample: two floats in two tuples
+_SAMPLE_BYTES = 2 * (24 + 8)
+_BLOCK_BYTES = 200
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _wildcard(value):
+    return '*' in value or '?' in value
+
+
+def _block_step(query):
+    """group period of query in seconds, 0 for raw data,
+    None if query could not be split into blocks without changing result
+
+    group periods are split exactly only if they never cross block
+    boundaries (second unit, period divides 15 minutes, so calendar
+    alignment in any timezone matches) and no value is interpolated
+    from neighbour periods
+
+    :param query: series query json
+    :return: `Number` | None
+    """
+
+    if _wildcard(query['entity']):
+        return None
+
+    for values in query['tags'].values():
+        if len(values) != 1 or _wildcard(values[0]):
+            return None
+
+    step = 0
+    for key in ('group', 'aggregate'):
+        if key not in query:
+            continue
+
+        spec = query[key]
+        interval = spec['interval']
+
+        if interval['unit'] != 'SECOND' or spec.get('interpolate') != 'NONE':
+            return None
+
+        count = interval['count']
+        if count <= 0 or count != int(count) or 900 % int(count):
+            return None
+
+        step = max(step, int(count))
+
+    return step
+
+
+def without_step_interpolation(query):
+    """query whose empty periods could be filled after blocks are joined
+
+    atsd fills empty periods between non-empty ones with STEP interpolation,
+    so the same series is produced by requesting periods without interpolation
+    and filling joined blocks with :func:`.fill_step`, while interpolated blocks
+    would depend on values before block start
+
+    :param query: series query json
+    :return: (query json with interpolate NONE, `Number` fill step in seconds | None)
+        | (query, None) if interpolation could not be replaced
+    """
+
+    replaced = dict(query)
+    fill = None
+
+    for key in ('group', 'aggregate'):
+        if key not in query:
+            continue
+
+        spec = query[key]
+        interpolate = spec.get('interpolate', 'NONE')
+
+        if interpolate == 'STEP' and spec['interval']['unit'] == 'SECOND':
+            fill = max(fill, spec['interval']['count'])
+        elif interpolate != 'NONE':
+            return query, None
+
+        replaced[key] = dict(spec, interpolate='NONE')
+
+    return replaced, fill
+
+
+def fill_step(data, step):
+    """fill empty periods between samples with previous value
+
+    :param data: [{t, v}] sorted period samples
+    :param step: `Number` seconds between periods
+    :return: [{t, v}]
+    """
+
+    step = int(step * 1000)
+    filled = []
+
+    for sample in data:
+        if filled:
+            previous = filled[-1]
+            for t in xrange(previous['t'] + step, sample['t'], step):
+                filled.append({'t': t, 'v': previous['v']})
+        filled.append(sample)
+
+    return filled
+
+
+class SeriesCache(object):
+    """lru cache of settled time blocks of series, bounded by memory estimate
+
+    block is identified by series key and block index, series key includes
+    entity, metric, tags and group/aggregate settings
+    """
+
+    def __init__(self, max_bytes, block_size=DEFAULT_BLOCK_SIZE, settle=DEFAULT_SETTLE):
+        """
+        :param max_bytes: `int` memory budget
+        :param block_size: `int` seconds, rounded up to multiple of group period
+        :param settle: `Number` seconds, younger data is never cached
+        """
+
+        self.max_bytes = max_bytes
+        self.block_size = int(block_size)
+        self.settle = settle
+
+        self._lock = threading.Lock()
+        #: (series key, block index) -> (bytes, times, values)
+        self._blocks = collections.OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def plan(self, query):
+        """split query time range into cached blocks and ranges to request
+
+        :param query: series query json
+        :return: `list` of segments in time order: ('cached', times, values)
+            or ('request', start_ms, end_ms, [(block key, block start ms, block end ms)])
+            None if query could not be cached
+        """
+
+        step = _block_step(query)
+        if step is None:
+            return None
+
+        block = self.block_size
+        if step:
+            block = -(-block // step) * step
+        block *= 1000
+
+        series_key = (query['entity'],
+                      query['metric'],
+                      tuple(sorted((k, v[0]) for k, v in query['tags'].items())),
+                      json.dumps(query.get('group'), sort_keys=True),
+                      json.dumps(query.get('aggregate'), sort_keys=True),
+                      block)
+
+        start = query['startTime']
+        end = query['endTime']
+        settled = int((time.time() - self.settle) * 1000)
+
+        segments = []
+        pending = []
+        cursor = start
+
+        first = -(-start // block)
+        last = min(end, settled) // block
+
+        with self._lock:
+            for index in xrange(first, last):
+                key = (series_key, index)
+                entry = self._blocks.pop(key, None)
+
+                if entry is None:
+                    self.misses += 1
+                    pending.append((key, index * block, (index + 1) * block))
+                    continue
+
+                self._blocks[key] = entry
+                self.hits += 1
+
+                if cursor < index * block:
+                    segments.append(('request', cursor, index * block, pending))
+                segments.append(('cached', entry[1], entry[2]))
+                pending = []
+                cursor = (index + 1) * block
+
+        if cursor < end:
+            segments.append(('request', cursor, end, pending))
+
+        return segments
+
+    def store(self, blocks, data):
+        """put settled blocks of requested range
+
+        :param blocks: `list` of (block key, block start ms, block end ms)
+        :param data: [{t, v}] sorted response of range including blocks
+        """
+
+        if not blocks:
+            return
+
+        times = [sample['t'] for sample in data]
+
+        entries = []
+        for key, start, end in blocks:
+            lo = bisect.bisect_left(times, start)
+            hi = bisect.bisect_left(times, end)
+            block_times = tuple(times[lo:hi])
+            block_values = tuple(sample['v'] for sample in data[lo:hi])
+            size = _BLOCK_BYTES + _SAMPLE_BYTES * len(block_times)
+            entries.append((key, (size, block_times, block_values)))
+
+        with self._lock:
+            for key, entry in entries:
+                old = self._blocks.pop(key, None)
+                if old is not None:
+                    self._bytes -= old[0]
+                self._blocks[key] = entry
+                self._bytes += entry[0]
+
+            while self._bytes > self.max_bytes and self._blocks:
+                _, old = self._blocks.popitem(last=False)
+                self._bytes -= old[0]
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'blocks': len(self._blocks),
+                    'bytes': self._bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_ratio': float(self.hits) / lookups if lookups else 0.0}
+
+
+def series_cache():
+    """process-wide series cache, configured with ATSD_CONF
+    series_cache_bytes (0 disables cache), series_cache_block, series_cache_settle
+
+    :return: :class:`.SeriesCache` | None
+    """
+
+    global _cache
+
+    max_bytes = settings.ATSD_CONF.get('series_cache_bytes', 0)
+    if not max_bytes:
+        return None
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                conf = settings.ATSD_CONF
+                _cache = SeriesCache(max_bytes,
+                                     conf.get('series_cache_block', DEFAULT_BLOCK_SIZE),
+                                     conf.get('series_cache_settle', DEFAULT_SETTLE))
+                log.info('series cache bytes=%s block=%s', 'SeriesCache',
+                         max_bytes, _cache.block_size)
+
+    return _cache
+
+
+def _stats():
+    cache = series_cache()
+    return cache.stats() if cache is not None else None
+
+
+metrics.register_cache('series', _stats)
@@ -0,0 +1,277 @@
+import os
+import threading
+import time
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from . import utils
+from .cache import metadata_endpoint
+
+log = utils.get_logger()
+
+try:
+    # noinspection PyUnresolvedReferences
+    from django.conf import settings
+except:  # debug env
+    from graphite import settings
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_GZIP_LEVEL = 6
+
+_transports = {}
+_lock = threading.Lock()
+
+
+class Transfer(object):
+    """body sizes of one request, decoded and as sent over network"""
+
+    __slots__ = ('bytes_out', 'wire_out', 'bytes_in', 'wire_in')
+
+    def __init__(self, bytes_out=0, wire_out=0):
+        self.bytes_out = bytes_out
+        self.wire_out = wire_out
+        self.bytes_in = 0
+        self.wire_in = 0
+
+    def __str__(self):
+        return 'sent={0}/{1} received={2}/{3}'.format(self.bytes_out, self.wire_out,
+                                                      self.bytes_in, self.wire_in)
+
+
+def _gzip(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Transport(object):
+    """process-wide pooled http session for one atsd url
+
+    requests.Session with a bounded urllib3 pool is safe to share
+    between threads, so all clients and finders reuse its connections
+    """
+
+    def __init__(self, url, username, password, pool_size=DEFAULT_POOL_SIZE,
+                 keep_alive=True, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=None, gzip_min_size=None, gzip_responses=True):
+        """
+        :param url: `str` atsd url
+        :param pool_size: `int` max connections kept open
+        :param keep_alive: `bool` reuse connections between requests
+        :param connect_timeout: `Number` seconds | None
+        :param read_timeout: `Number` seconds | None
+        :param gzip_min_size: `int` bytes, larger request bodies are compressed,
+            None disables compression
+        :param gzip_responses: `bool` accept compressed responses
+        """
+
+        #: `str`
+        self.url = url
+        #: `tuple` (connect, read) seconds
+        self.timeout = (connect_timeout, read_timeout)
+        #: `int` process which owns the sockets
+        self.pid = os.getpid()
+
+        self._adapter = HTTPAdapter(pool_connections=1,
+                                    pool_maxsize=pool_size,
+                                    pool_block=True)
+
+        #: :class:`requests.Session`
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate' if gzip_responses else 'identity'
+
+        #: `int` | None
+        self.gzip_min_size = gzip_min_size
+
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._active = 0
+        self._transfer = Transfer()
+
+    def send(self, prepared_request, **kwargs):
+        """body sizes are stored in `transfer` attribute of response,
+        received sizes of streamed response are known once it is read,
+        see :meth:`.received`
+
+        :param prepared_request: :class:`requests.PreparedRequest`
+        :return: :class:`requests.Response`
+        """
+
+        kwargs.setdefault('timeout', self.timeout)
+
+        transfer = self._compress(prepared_request)
+
+        endpoint = metadata_endpoint(prepared_request.url)
+        start = time.time()
+        status = 0
+
+        with self._stats_lock:
+            self._requests += 1
+            self._active += 1
+        try:
+            response = self.session.send(prepared_request, **kwargs)
+            status = response.status_code
+        finally:
+            with self._stats_lock:
+                self._active -= 1
+            metrics.HTTP_DURATION.observe(time.time() - start, endpoint)
+            metrics.HTTP_REQUESTS.inc(1, endpoint, status)
+
+        response.transfer = transfer
+        self._count(transfer.bytes_out, transfer.wire_out, 0, 0)
+
+        if not kwargs.get('stream'):
+            self.received(response, len(response.content))
+
+        return response
+
+    def received(self, response, size):
+        """count response body once it is read
+
+        :param response: :class:`requests.Response` returned by :meth:`.send`
+        :param size: `int` decoded body bytes
+        """
+
+        transfer = response.transfer
+        transfer.bytes_in = size
+        # bytes read from socket before decoding
+        transfer.wire_in = response.raw.tell() if hasattr(response.raw, 'tell') else size
+
+        self._count(0, 0, transfer.bytes_in, transfer.wire_in)
+
+    def _compress(self, prepared_request):
+        """gzip request body larger than gzip_min_size
+
+        :param prepared_request: :class:`requests.PreparedRequest`
+        :return: :class:`.Transfer`
+        """
+
+        body = prepared_request.body
+        if not body:
+            return Transfer()
+
+        if isinstance(body, unicode):
+            body = body.encode('utf8')
+
+        size = len(body)
+
+        if self.gzip_min_size is None or size < self.gzip_min_size \
+                or 'Content-Encoding' in prepared_request.headers:
+            return Transfer(size, size)
+
+        compressed = _gzip(body, DEFAULT_GZIP_LEVEL)
+        prepared_request.body = compressed
+        prepared_request.headers['Content-Encoding'] = 'gzip'
+        prepared_request.headers['Content-Length'] = str(len(compressed))
+
+        return Transfer(size, len(compressed))
+
+    def _count(self, bytes_out, wire_out, bytes_in, wire_in):
+        with self._stats_lock:
+            self._transfer.bytes_out += bytes_out
+            self._transfer.wire_out += wire_out
+            self._transfer.bytes_in += bytes_in
+            self._transfer.wire_in += wire_in
+
+    def get(self, url, **kwargs):
+        """
+        :param url: `str` absolute url
+        :return: :class:`requests.Response`
+        """
+
+        request = requests.Request(method='GET', url=url, params=kwargs.pop('params', None))
+        return self.send(self.session.prepare_request(request), **kwargs)
+
+    def stats(self):
+        """
+        bytes are decoded body sizes, wire bytes are sizes sent over network
+
+        :return: `dict` requests, new_connections, reuse_ratio,
+            idle_connections, active_requests, bytes_out, wire_out,
+            bytes_in, wire_in
+        """
+
+        new_connections = 0
+        idle_connections = 0
+
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            new_connections += pool.num_connections
+            idle_connections += sum(1 for conn in list(pool.pool.queue)
+                                    if conn is not None and conn.sock is not None)
+
+        with self._stats_lock:
+            requests_ = self._requests
+            active = self._active
+            transfer = self._transfer
+
+            return {'requests': requests_,
+                    'new_connections': new_connections,
+                    'reuse_ratio': 1 - float(new_connections) / requests_ if requests_ else 0.0,
+                    'idle_connections': idle_connections,
+                    'active_requests': active,
+                    'bytes_out': transfer.bytes_out,
+                    'wire_out': transfer.wire_out,
+                    'bytes_in': transfer.bytes_in,
+                    'wire_in': transfer.wire_in}
+
+
+def get_transport(url=None):
+    """shared transport for url, configured with settings.ATSD_CONF:
+    pool_size, keep_alive, connect_timeout, read_timeout, gzip_min_size,
+    gzip_responses
+
+    :param url: `str` | None for ATSD_CONF['url']
+    :return: :class:`.Transport`
+    """
+
+    conf = settings.ATSD_CONF
+    if url is None:
+        url = conf['url']
+
+    key = (url, conf['username'])
+    pid = os.getpid()
+
+    transport = _transports.get(key)
+    if transport is not None and transport.pid == pid:
+        return transport
+
+    with _lock:
+        transport = _transports.get(key)
+        # sockets inherited from parent process must not be shared
+        if transport is None or transport.pid != pid:
+            transport = Transport(url,
+                                  conf['username'],
+                                  conf['password'],
+                                  conf.get('pool_size', DEFAULT_POOL_SIZE),
+                                  conf.get('keep_alive', True),
+                                  conf.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+                                  conf.get('read_timeout'),
+                                  conf.get('gzip_min_size'),
+                                  conf.get('gzip_responses', True))
+            _transports[key] = transport
+            log.info('new transport url=%s pool_size=%s', 'Transport',
+                     url, conf.get('pool_size', DEFAULT_POOL_SIZE))
+
+        return transport
+
+
+def stats():
+    """
+    :return: `dict` url -> :meth:`.Transport.stats`
+    """
+
+    return dict((key[0], transport.stats())
+                for key, transport in _transports.items()
+                if transport.pid == os.getpid())
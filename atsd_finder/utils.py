@@ -16,6 +16,19 @@ except:
     DEBUG = True
 
 
+try:
+    # noinspection PyUnresolvedReferences
+    from django.conf import settings
+except:  # debug env
+    from graphite import settings
+
+# same values as standard logging levels
+LOG_LEVELS = {'debug': 10,
+              'info': 20,
+              'warning': 30,
+              'error': 40}
+
+
 def _instance_name(inst):
     if inst is None:
         return ''
@@ -51,13 +64,101 @@ class ConsoleLogger(object):
         inst_name = _instance_name(inst)
         print('[' + inst_name + ' ' + PID + '] ' + msg)
 
+
+class Logger(object):
+    """leveled front of :class:`.GraphiteLogger` or :class:`.ConsoleLogger`
+
+    message is %-formatted with args only if its level is enabled, so call
+    sites pass format string and args instead of concatenated string::
+
+        log.debug('tokens = %s', self, tokens)
+
+    sample=n logs every n-th call with the same format string,
+    :meth:`.enabled` lets call sites skip building arguments
+    """
+
+    def __init__(self, backend, level='info'):
+        """
+        :param backend: :class:`.GraphiteLogger` | :class:`.ConsoleLogger`
+        :param level: `str` key of LOG_LEVELS
+        """
+
+        self._backend = backend
+        #: `int` least level logged
+        self.level = LOG_LEVELS[level]
+        #: format string -> `int` calls, for sampled call sites
+        self._calls = {}
+
+    def set_level(self, level):
+        """
+        :param level: `str` key of LOG_LEVELS
+        """
+
+        self.level = LOG_LEVELS[level]
+
+    def enabled(self, level):
+        """
+        :param level: `str` key of LOG_LEVELS
+        :return: `bool` message of level would be logged
+        """
+
+        return LOG_LEVELS[level] >= self.level
+
+    def debug(self, msg, inst=None, *args, **kwargs):
+        if self.level <= 10:
+            self._log(self._backend.info, msg, inst, args, kwargs.get('sample'))
+
+    def info(self, msg, inst=None, *args, **kwargs):
+        if self.level <= 20:
+            self._log(self._backend.info, msg, inst, args, kwargs.get('sample'))
+
+    def warning(self, msg, inst=None, *args, **kwargs):
+        if self.level <= 30:
+            self._log(self._backend.info, 'warning: ' + msg, inst, args, kwargs.get('sample'))
+
+    def exception(self, msg, inst=None, *args, **kwargs):
+        """log message with current exception"""
+
+        if self.level <= 40:
+            self._log(self._backend.exception, msg, inst, args, kwargs.get('sample'))
+
+    def _log(self, write, msg, inst, args, sample):
+        if sample > 1:
+            # races only skew sampling, calls are not locked
+            calls = self._calls.get(msg, 0)
+            self._calls[msg] = calls + 1
+            if calls % sample:
+                return
+
+        if args:
+            try:
+                msg = msg % args
+            except (TypeError, ValueError):
+                msg = msg + ' ' + unicode(args)
+
+        write(msg, inst)
+
+
+def _configured_level():
+    try:
+        level = settings.ATSD_CONF.get('log_level', 'info')
+    except Exception:  # settings are not configured yet
+        level = 'info'
+
+    return level if level in LOG_LEVELS else 'info'
+
+
 if DEBUG:
-    logger = ConsoleLogger()
+    logger = Logger(ConsoleLogger(), _configured_level())
 else:
-    logger = GraphiteLogger()
+    logger = Logger(GraphiteLogger(), _configured_level())
 
 
 def get_logger():
+    """
+    :return: process-wide :class:`.Logger`, level set by ATSD_CONF log_level
+    """
+
     return logger
 
 
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""end-to-end benchmark of finders and reader against a local fake ATSD
+
+must run inside graphite-web environment, e.g.
+    PYTHONPATH=/opt/graphite/webapp python bin/benchmark.py --series 10,1000,100000
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graphite.settings')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from graphite.local_settings import ATSD_CONF
+from graphite.storage import FindQuery
+
+import atsd_finder
+from atsd_finder.client import AtsdClient, Instance
+
+from fake_atsd import FakeAtsd, Dataset
+
+BENCH_VIEW = 'bench'
+
+
+def _percentile(values, p):
+    """nearest-rank percentile
+
+    :param values: sorted `list` of `Number`
+    :param p: `Number` 0..100
+    """
+
+    if not values:
+        return float('nan')
+    index = max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def _find(finder_class, pattern, start_time=None, end_time=None):
+    def run():
+        finder = finder_class()
+        return len(list(finder.find_nodes(FindQuery(pattern, start_time, end_time))))
+
+    return run
+
+
+def _fetch(dataset, count, time_range):
+    def run():
+        client = AtsdClient()
+        now = dataset.last_insert_time / 1000.0
+
+        readers = []
+        for metric in dataset.metrics:
+            for entity in dataset.entities:
+                for tags in dataset.tag_combos():
+                    if len(readers) == count:
+                        break
+                    path = '.'.join([metric, entity] + tags.values())
+                    readers.append(atsd_finder.AtsdReader(Instance(entity, metric,
+                                                                   tags, path, client)))
+
+        results = [reader.fetch(now - time_range, now) for reader in readers]
+        return sum(len(result.waitForResults()[1]) for result in results)
+
+    return run
+
+
+def scenarios(dataset, time_range):
+    metric = dataset.metrics[0]
+    entity = dataset.entities[0]
+    now = dataset.last_insert_time / 1000.0
+
+    return [
+        ('AtsdFinder entities', _find(atsd_finder.AtsdFinder, 'entities.e.*')),
+        ('AtsdFinder metric entities', _find(atsd_finder.AtsdFinder,
+                                             'metrics.m.' + metric + '.*')),
+        ('AtsdFinder tags', _find(atsd_finder.AtsdFinder,
+                                  'metrics.m.' + metric + '.' + entity + '.*')),
+        ('AtsdFinderV entities', _find(atsd_finder.AtsdFinderV,
+                                       BENCH_VIEW + '.' + metric + '.*')),
+        ('AtsdFinderV tags', _find(atsd_finder.AtsdFinderV,
+                                   BENCH_VIEW + '.' + metric + '.' + entity + '.*')),
+        ('AtsdFinderG browse', _find(atsd_finder.AtsdFinderG, metric + '.*')),
+        ('AtsdFinderG render', _find(atsd_finder.AtsdFinderG, metric + '.*.*',
+                                     now - time_range, now)),
+        ('AtsdReader.fetch', _fetch(dataset, dataset.series_count, time_range)),
+    ]
+
+
+def _run_scenario(run, iterations, queue):
+    durations = []
+    result = None
+
+    try:
+        for _ in xrange(iterations):
+            start = time.time()
+            result = run()
+            durations.append(time.time() - start)
+    except Exception as e:
+        queue.put((None, None, repr(e), 0))
+        return
+
+    # linux reports kilobytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    queue.put((durations, result, None, peak))
+
+
+def run_isolated(run, iterations):
+    """run scenario in forked process, so peak memory is measured per scenario
+
+    :return: durations, result, error, peak_mb
+    """
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_scenario, args=(run, iterations, queue))
+    process.start()
+    outcome = queue.get()
+    process.join()
+
+    return outcome
+
+
+def report(name, series, outcome, stats, iterations):
+    durations, result, error, peak = outcome
+
+    if error is not None:
+        print('%-28s %8d  ERROR %s' % (name, series, error))
+        return
+
+    durations = sorted(d * 1000 for d in durations)
+
+    requests = sum(v['requests'] for k, v in stats.items() if k != '_connections')
+    bytes_in = sum(v['bytes_in'] for k, v in stats.items() if k != '_connections')
+    bytes_out = sum(v['bytes_out'] for k, v in stats.items() if k != '_connections')
+
+    print('%-28s %8d %9.1f %9.1f %9.1f %9.1f %8.1f %8.1f %10d %12d %6d %8.1f %8d'
+          % (name, series,
+             _percentile(durations, 50),
+             _percentile(durations, 90),
+             _percentile(durations, 99),
+             durations[-1],
+             float(requests) / iterations,
+             float(stats['_connections']) / iterations,
+             bytes_in // iterations,
+             bytes_out // iterations,
+             len(stats) - 1,
+             peak,
+             result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark atsd_finder against a local fake ATSD.')
+    parser.add_argument('--series', default='10,100,1000,10000,100000',
+                        help='comma separated series counts (default: %(default)s)')
+    parser.add_argument('--metrics', type=int, default=10,
+                        help='number of metrics (default: %(default)s)')
+    parser.add_argument('--tag-values', type=int, default=1, dest='tag_values',
+                        help='values of the single tag, 0 for untagged series (default: %(default)s)')
+    parser.add_argument('--step', type=float, default=60,
+                        help='seconds between samples (default: %(default)s)')
+    parser.add_argument('--range', type=float, default=60 * 60, dest='time_range',
+                        help='fetch interval in seconds (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='injected server latency in seconds (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=5,
+                        help='iterations per scenario (default: %(default)s)')
+    parser.add_argument('--only', default=None,
+                        help='run only scenarios whose name contains this string')
+    args = parser.parse_args()
+
+    ATSD_CONF['username'] = ATSD_CONF.get('username', 'bench')
+    ATSD_CONF['password'] = ATSD_CONF.get('password', 'bench')
+    ATSD_CONF['views'] = {BENCH_VIEW: [
+        {'type': 'metric', 'value': ['*']},
+        {'type': 'entity', 'value': ['*']},
+        {'type': 'tag', 'value': [Dataset.TAG_NAME], 'is leaf': True},
+    ]}
+
+    print('%-28s %8s %9s %9s %9s %9s %8s %8s %10s %12s %6s %8s %8s'
+          % ('scenario', 'series', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'reqs',
+             'conns', 'bytes in', 'bytes out', 'endp', 'peak MB', 'result'))
+
+    for series in [int(s) for s in args.series.split(',')]:
+        dataset = Dataset(series, args.metrics, args.tag_values, args.step)
+        server = FakeAtsd(dataset, args.latency).start()
+        ATSD_CONF['url'] = server.url
+
+        try:
+            for name, run in scenarios(dataset, args.time_range):
+                if args.only and args.only not in name:
+                    continue
+
+                server.reset_stats()
+                outcome = run_isolated(run, args.iterations)
+                report(name, dataset.series_count, outcome, server.stats(), args.iterations)
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""build and refresh the metadata index read by atsd_finder workers
+
+must run inside graphite-web environment, e.g.
+    PYTHONPATH=/opt/graphite/webapp python bin/metadata_index.py --follow
+"""
+
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graphite.settings')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from graphite.local_settings import ATSD_CONF
+
+from atsd_finder import transport
+from atsd_finder.index import MetadataIndex
+
+
+def refresh(index, full):
+    start = time.time()
+    try:
+        updated = index.refresh(transport.get_transport(), ATSD_CONF['url'] + '/api/v1', full)
+    except Exception as e:
+        print('[ERROR] %s refresh failed: %s' % ('full' if full else 'incremental', e))
+        return False
+
+    print('[INFO] %s refresh: %d entities, %d metrics, %d series, %.1f s'
+          % ('full' if full else 'incremental', updated['entities'], updated['metrics'],
+             updated['series'], time.time() - start))
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and refresh the metadata index of atsd_finder.')
+    parser.add_argument('--path', default=ATSD_CONF.get('metadata_index'),
+                        help='index file (default: ATSD_CONF metadata_index)')
+    parser.add_argument('--full', action='store_true',
+                        help='request all entities and metrics and remove deleted ones, '
+                             'instead of only those inserted since the previous refresh')
+    parser.add_argument('--follow', action='store_true',
+                        help='keep refreshing every --interval seconds until interrupted')
+    parser.add_argument('--interval', type=float, default=60, metavar='SECONDS',
+                        help='seconds between incremental refreshes in --follow mode (default: %(default)s)')
+    parser.add_argument('--full-interval', type=float, default=24 * 60 * 60, dest='full_interval',
+                        metavar='SECONDS',
+                        help='seconds between full refreshes in --follow mode (default: %(default)s)')
+    args = parser.parse_args()
+
+    if not args.path:
+        parser.error('--path is required if ATSD_CONF metadata_index is not set')
+
+    index = MetadataIndex(args.path)
+
+    ok = refresh(index, args.full)
+    last_full = time.time()
+
+    while args.follow:
+        time.sleep(args.interval)
+        full = time.time() - last_full >= args.full_interval
+        if refresh(index, full) and full:
+            last_full = time.time()
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,48 @@
 #!/usr/bin/env python
 
 import argparse
+import base64
+import bisect
+import collections
+import errno
+import httplib
+import itertools
+import multiprocessing
+import operator
 import os
+import Queue
+import signal
 import struct
 import mmap
 import socket
+import sqlite3
+import sys
+import threading
+import time
 
 try:
     import whisper
 except ImportError:
     raise SystemExit('[ERROR] Please make sure whisper is installed properly')
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 __author__ = 'gregory'
 
+# files queued per worker, bounds memory of walk ahead of export
+QUEUE_DEPTH = 16
+DEFAULT_BUFFER_SIZE = 256 * 1024
+# points sent between checkpoints of one file
+CHECKPOINT_POINTS = 100000
+JOURNAL_SYNC_INTERVAL = 1.0
+
+if numpy is not None:
+    # whisper.pointFormat, big-endian unsigned timestamp and double, no padding
+    POINT_DTYPE = numpy.dtype([('t', '>u4'), ('v', '>f8')])
+
 
 def mmap_file(filename):
     fd = os.open(filename, os.O_RDONLY)
@@ -20,7 +50,34 @@ def mmap_file(filename):
     os.close(fd)
     return map
 
-def read_archives(map, count):
+def decode_points(map, offset, points):
+    """decode archive slots in one pass, skip empty slots
+
+    :return: `list` of (timestamp, value) sorted by timestamp,
+        of equal timestamps the first slot is kept
+    """
+    if numpy is not None:
+        slots = numpy.frombuffer(map, POINT_DTYPE, points, offset)
+        slots = slots[slots['t'] != 0]
+        timestamps, first = numpy.unique(slots['t'], return_index=True)
+        return zip(timestamps.tolist(), slots['v'][first].tolist())
+
+    unpacked = struct.unpack_from('!' + whisper.pointFormat[1:] * points, map, offset)
+    samples = [sample for sample in itertools.izip(unpacked[0::2], unpacked[1::2]) if sample[0] != 0]
+    # ring buffer is two sorted runs, stable sort keeps the first of equal slots
+    samples.sort(key=operator.itemgetter(0))
+    previous = None
+    unique = []
+    for sample in samples:
+        if sample[0] != previous:
+            unique.append(sample)
+            previous = sample[0]
+    return unique
+
+def read_archive_info(map):
+    """
+    :return: `list` of (offset, secondsPerPoint, points), finest archive first
+    """
     try:
         (aggregationType, maxRetention, xFilesFactor, archiveCount) = struct.unpack(whisper.metadataFormat,
                                                                                     map[:whisper.metadataSize])
@@ -28,74 +85,635 @@ def read_archives(map, count):
         raise whisper.CorruptWhisperFile("Unable to unpack header")
 
     archiveOffset = whisper.metadataSize
-    if count > archiveCount:
-        count = archiveCount
-
-    archSamples = []
-    for i in xrange(count):
+    archives = []
+    for i in xrange(archiveCount):
         try:
             (offset, secondsPerPoint, points) = struct.unpack(whisper.archiveInfoFormat, map[
                                                                                          archiveOffset:archiveOffset + whisper.archiveInfoSize])
         except:
             raise whisper.CorruptWhisperFile("Unable to read archive %d metadata" % i)
-        samples = []
-        for point in xrange(points):
-            (timestamp, value) = struct.unpack(whisper.pointFormat, map[offset:offset + whisper.pointSize])
-            if timestamp != 0:
-                samples.append((timestamp, value))
-            offset += whisper.pointSize
+        if offset + points * whisper.pointSize > len(map):
+            raise whisper.CorruptWhisperFile("Archive %d is truncated" % i)
 
         archiveOffset += whisper.archiveInfoSize
-        archSamples.append(samples)
+        archives.append((offset, secondsPerPoint, points))
+
+    return archives
+
+def read_archives(map, count):
+    return [decode_points(map, offset, points)
+            for (offset, secondsPerPoint, points) in read_archive_info(map)[:count]]
+
+def merge_archives(map):
+    """one timeline of all archives: the finest data where it exists, each
+    coarser archive only before the oldest point of finer ones
+
+    :return: `list` of (secondsPerPoint, samples), oldest segment first
+    """
+    segments = []
+    cutoff = None
+    for (offset, secondsPerPoint, points) in read_archive_info(map):
+        samples = decode_points(map, offset, points)
+        if cutoff is not None:
+            samples = samples[:bisect.bisect_left(samples, (cutoff,))]
+        if samples:
+            segments.append((secondsPerPoint, samples))
+            cutoff = samples[0][0]
+    segments.reverse()
+    return segments
+
+class TcpSender(object):
+    """graphite plaintext lines over one tcp connection, coalesced into
+    writes of at least bufferSize bytes"""
+
+    def __init__(self, address, bufferSize):
+        self.address = address
+        self.bufferSize = bufferSize
+        self.sock = None
+        self.buffer = []
+        self.buffered = 0
+
+    def format(self, metric, points):
+        return ["%s %s %s\n" % (metric, val, timestamp) for (timestamp, val) in points]
+
+    def send(self, metric, points):
+        """
+        :return: `int` bytes
+        """
+        lines = self.format(metric, points)
+        size = sum(len(line) for line in lines)
+        self.buffer.extend(lines)
+        self.buffered += size
+        if self.buffered >= self.bufferSize:
+            self.flush()
+        return size
+
+    def flush(self):
+        if not self.buffer:
+            return
+        payload = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.write(payload)
+
+    def write(self, payload):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address)
+        for start in xrange(0, len(payload), self.bufferSize):
+            self.sock.sendall(payload[start:start + self.bufferSize])
+
+    def close(self):
+        """drop buffered data and connection, next write reconnects"""
+        self.buffer = []
+        self.buffered = 0
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def command_field(text):
+    if any(c in text for c in ' ="\t'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
 
-    return archSamples
+class HttpSender(TcpSender):
+    """atsd series commands posted to /api/v1/command, one request per flush
 
-def send_data_samples_to_atsd(socket, metric, points):
-    for (timestamp, val) in points:
-        socket.sendall("%s %s %s\n" % (metric, val, timestamp))
+    graphite name a.b.c is sent as entity a, metric b.c unless entity is set
+    """
 
-def export_file(path, whisperRoot, socket):
+    def __init__(self, address, bufferSize, secure=False, user=None, password=None, entity=None):
+        TcpSender.__init__(self, address, bufferSize)
+        self.secure = secure
+        self.entity = entity
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if user is not None:
+            credentials = base64.b64encode('%s:%s' % (user, password or ''))
+            self.headers['Authorization'] = 'Basic ' + credentials
+
+    def format(self, metric, points):
+        if self.entity is not None:
+            entity = self.entity
+        else:
+            entity, _, metric = metric.partition('.')
+        prefix = 'series e:%s ' % command_field(entity)
+        name = command_field(metric)
+        return ["%ss:%s m:%s=%s\n" % (prefix, timestamp, name, val) for (timestamp, val) in points]
+
+    def write(self, payload):
+        if self.sock is None:
+            connection = httplib.HTTPSConnection if self.secure else httplib.HTTPConnection
+            self.sock = connection(*self.address)
+        self.sock.request('POST', '/api/v1/command', payload, self.headers)
+        response = self.sock.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError('server response status=%d %s' % (response.status, body[:200]))
+
+
+def make_sender(options):
+    """
+    :param options: `dict` address, bufferSize, protocol, user, password, entity
+    """
+    if options['protocol'] == 'tcp':
+        return TcpSender(options['address'], options['bufferSize'])
+    return HttpSender(options['address'], options['bufferSize'],
+                      options['protocol'] == 'https',
+                      options['user'], options['password'], options['entity'])
+
+def export_file(path, whisperRoot, sender, since=None, progress=None, merge=False, rollupName=None):
+    """send points newer than since, flushed in slices of CHECKPOINT_POINTS
+
+    :param progress: `.Function` (points, bytes, last timestamp) called after each flush
+    :param merge: `bool` send merged timeline of all archives instead of the finest one
+    :param rollupName: `str` | None format of metric name for coarse archives,
+        with {metric} and {seconds} fields
+    :return: (`int` points, `int` bytes sent)
+    """
     map = mmap_file(path)
-    samples, = read_archives(map, 1)
+    try:
+        if merge:
+            segments = merge_archives(map)
+        else:
+            segments = [(None, samples) for samples in read_archives(map, 1)]
+    finally:
+        map.close()
     (path_without_extension, _) = os.path.splitext(path)
     (_, metric) = path_without_extension.split(whisperRoot+"/")
     metric = metric.replace("/", ".")
-    send_data_samples_to_atsd(socket, metric, samples)
+    finest = segments[-1][0] if segments else None
+    total = 0
+    sent = 0
+    for (secondsPerPoint, samples) in segments:
+        if since is not None:
+            samples = samples[bisect.bisect_right(samples, (since, float('inf'))):]
+        name = metric
+        if rollupName is not None and secondsPerPoint != finest:
+            name = rollupName.format(metric=metric, seconds=secondsPerPoint)
+        for start in xrange(0, len(samples), CHECKPOINT_POINTS):
+            chunk = samples[start:start + CHECKPOINT_POINTS]
+            size = sender.send(name, chunk)
+            sender.flush()
+            sent += size
+            if progress is not None:
+                progress(len(chunk), size, chunk[-1][0])
+        total += len(samples)
+    return total, sent
+
+def iter_files(path, isRecursive):
+    if isRecursive and os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for filename in files:
+                if os.path.splitext(filename)[1] == ".wsp":
+                    yield os.path.join(root, filename)
+    else:
+        yield path
+
+
+def worker(index, senderOptions, exportOptions, tasks, results, stop):
+    """export (path, since) tasks from queue over own connection until None or stop
+
+    reports (index, path, status, points, bytes, detail) to results queue,
+    status is 'progress' (detail is last sent timestamp), 'done' (detail
+    is seconds spent), 'failed' or 'exit'
+    """
+
+    # parent handles interrupt and lets workers finish current file
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    sender = make_sender(senderOptions)
+    try:
+        while not stop.is_set():
+            try:
+                task = tasks.get(timeout=1)
+            except Queue.Empty:
+                continue
+
+            if task is None or stop.is_set():
+                break
+
+            path, since = task
+
+            def progress(points, sent, timestamp):
+                results.put((index, path, 'progress', points, sent, timestamp))
+
+            started = time.time()
+            try:
+                export_file(path, exportOptions['whisperRoot'], sender, since, progress,
+                            exportOptions['merge'], exportOptions['rollupName'])
+            except Exception as e:
+                # unflushed data of the file is dropped, reconnect for the next one
+                sender.close()
+                results.put((index, path, 'failed', 0, 0, str(e)))
+            else:
+                results.put((index, path, 'done', 0, 0, time.time() - started))
+    finally:
+        sender.close()
+        results.put((index, None, 'exit', 0, 0, None))
+
+
+class Journal(object):
+    """append-only checkpoint log, one record per line:
+    'D <path>' file is exported, 'P <timestamp> <path>' points up to timestamp are sent
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        #: path -> `int` last sent timestamp of unfinished file
+        self.progress = {}
+
+        #: `int` bytes of complete records, a torn write after them is cut off
+        valid = 0
+        if os.path.exists(path):
+            with open(path) as journal:
+                for line in journal:
+                    if not line.endswith('\n'):
+                        break  # torn write of interrupted run
+                    valid += len(line)
+                    record = line[:-1].split(' ', 2)
+                    if record[0] == 'D' and len(record) >= 2:
+                        filename = line[2:-1]
+                        self.done.add(filename)
+                        self.progress.pop(filename, None)
+                    elif record[0] == 'P' and len(record) == 3:
+                        self.progress[record[2]] = int(record[1])
+
+        self.file = open(path, 'a')
+        self.file.truncate(valid)
+        self.synced = time.time()
+
+    def start(self, path):
+        """
+        :return: (`bool` export file, `int` | None last sent timestamp)
+        """
+        if path in self.done:
+            return False, None
+        return True, self.progress.get(path)
+
+    def complete(self, path):
+        self.file.write('D %s\n' % path)
+        self.done.add(path)
+        self.progress.pop(path, None)
 
-parser = argparse.ArgumentParser(description='Migrate whisper data to Axibase Time Series Database.')
+    def advance(self, path, timestamp):
+        self.file.write('P %d %s\n' % (timestamp, path))
+        self.progress[path] = timestamp
 
-parser.add_argument('path', help='path to folder/file that will be exported to ATSD. Path must be specified either: directly to .wsp files (only if -R is not set) OR to folders containing the .wsp files (-R must be set). ~ symbol cannot be used.')
-parser.add_argument('hostname', help='ATSD hostname')
-parser.add_argument('port', help='ATSD listening port', type=int)
-parser.add_argument('--whisper-base', help='base path to which all metric names will be resolved (default: ".")', dest="whisperRoot", default=os.path.curdir, metavar="BASE")
-parser.add_argument('-R', action='store_true', help='export recursively all files in specified folder', dest="isRecursive")
+    def sync(self, force=False):
+        now = time.time()
+        if force or now - self.synced >= JOURNAL_SYNC_INTERVAL:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced = now
 
-args = parser.parse_args()
+    def close(self):
+        self.sync(True)
+        self.file.close()
 
-PATH = os.path.abspath(args.path)
-IS_RECURSIVE = args.isRecursive
-ADDRESS = (args.hostname, args.port)
-WHISPER_ROOT = os.path.abspath(args.whisperRoot)
 
-if not os.path.exists(PATH):
-    raise SystemExit('[ERROR] File "%s" does not exist!' % PATH)
-if not os.path.exists(WHISPER_ROOT):
-    raise SystemExit('[ERROR] Whisper root "%s" does not exist!' % WHISPER_ROOT)
-if not PATH.startswith(WHISPER_ROOT):
-    raise SystemExit('[ERROR] Wrong whisper root "%s" should be prefix of path "%s"!' % (WHISPER_ROOT, PATH))
+class StateStore(object):
+    """sqlite table of per-file mtime and watermark for incremental sync
 
+    file is exported again only if its mtime changed since it was finished,
+    and only points newer than the watermark (last sent timestamp) are sent
+    """
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect(ADDRESS)
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        #: path -> mtime seen when export started, stored when it is finished
+        self.started = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+                        'path TEXT PRIMARY KEY, mtime REAL, watermark INTEGER)')
+        self.db.commit()
+        self.synced = time.time()
 
-if IS_RECURSIVE and os.path.isdir(PATH):
-    for root, _, files in os.walk(PATH):
-        for filename in files:
-            if os.path.splitext(filename)[1] == ".wsp":
-                export_file(os.path.join(root, filename), WHISPER_ROOT, s)
-else:
-    if not os.path.isfile(PATH):
+    def start(self, path):
+        """
+        :return: (`bool` export file, `int` | None last sent timestamp)
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False, None  # removed since walk
+        with self.lock:
+            row = self.db.execute('SELECT mtime, watermark FROM files WHERE path = ?',
+                                  (path,)).fetchone()
+            if row is not None and row[0] == mtime:
+                return False, None
+            self.started[path] = mtime
+        return True, row[1] if row is not None else None
+
+    def advance(self, path, timestamp):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO files (path) VALUES (?)', (path,))
+            self.db.execute('UPDATE files SET watermark = ? WHERE path = ?', (timestamp, path))
+
+    def complete(self, path):
+        with self.lock:
+            mtime = self.started.pop(path, None)
+            self.db.execute('INSERT OR IGNORE INTO files (path) VALUES (?)', (path,))
+            self.db.execute('UPDATE files SET mtime = ? WHERE path = ?', (mtime, path))
+
+    def sync(self, force=False):
+        now = time.time()
+        if force or now - self.synced >= JOURNAL_SYNC_INTERVAL:
+            with self.lock:
+                self.db.commit()
+            self.synced = now
+
+    def close(self):
+        self.sync(True)
+        self.db.close()
+
+
+class WorkerStats(object):
+
+    def __init__(self):
+        self.files = 0
+        self.points = 0
+        self.bytes = 0
+        self.failed = 0
+        self.busy = 0.0
+
+    def add(self, other):
+        self.files += other.files
+        self.points += other.points
+        self.bytes += other.bytes
+        self.failed += other.failed
+        self.busy += other.busy
+
+    def format(self, elapsed):
+        elapsed = max(elapsed, 1e-6)
+        return '%d files, %d failed, %.1f files/s, %.0f points/s, %.0f bytes/s, %.0f%% busy' % (
+            self.files, self.failed, self.files / elapsed, self.points / elapsed,
+            self.bytes / elapsed, 100.0 * self.busy / elapsed)
+
+
+class Migration(object):
+    """pool of worker processes fed from walk of whisper tree"""
+
+    def __init__(self, files, senderOptions, exportOptions, jobs, reportInterval, checkpoint=None):
+        """
+        :param checkpoint: :class:`.Journal` | :class:`.StateStore` | None,
+            decides which files and points are exported
+        """
+        self.files = files
+        self.senderOptions = senderOptions
+        self.exportOptions = exportOptions
+        self.jobs = jobs
+        self.reportInterval = reportInterval
+        self.checkpoint = checkpoint
+        self.interrupted = False
+        self.skipped = 0
+
+        self.tasks = multiprocessing.Queue(jobs * QUEUE_DEPTH)
+        self.results = multiprocessing.Queue()
+        self.stop = multiprocessing.Event()
+
+        self.lock = threading.Lock()
+        #: path -> None, queued to workers and not reported yet
+        self.pending = collections.OrderedDict()
+        self.failed = []
+        self.walked = False
+
+        self.stats = [WorkerStats() for _ in xrange(jobs)]
+
+    def feed(self):
+        try:
+            for path in self.files:
+                since = None
+                if self.checkpoint is not None:
+                    export, since = self.checkpoint.start(path)
+                    if not export:
+                        self.skipped += 1
+                        continue
+                with self.lock:
+                    self.pending[path] = None
+                if not self.put((path, since)):
+                    return
+            self.walked = True
+            for _ in xrange(self.jobs):
+                if not self.put(None):
+                    return
+        except Exception as e:
+            sys.stderr.write('[ERROR] walk failed: %s\n' % e)
+            self.stop.set()
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.tasks.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def interrupt(self, signum, frame):
+        self.interrupted = True
+        if not self.stop.is_set():
+            sys.stderr.write('[INFO] stopping, waiting for workers to finish current files\n')
+        self.stop.set()
+
+    def report(self, elapsed):
+        for index, stats in enumerate(self.stats):
+            sys.stderr.write('[INFO] worker %d: %s\n' % (index + 1, stats.format(elapsed)))
+
+    def run(self):
+        """
+        :return: `bool` True if all files are exported
+        """
+
+        processes = [multiprocessing.Process(target=worker,
+                                             args=(index, self.senderOptions, self.exportOptions,
+                                                   self.tasks, self.results, self.stop))
+                     for index in xrange(self.jobs)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        signal.signal(signal.SIGINT, self.interrupt)
+        signal.signal(signal.SIGTERM, self.interrupt)
+
+        feeder = threading.Thread(target=self.feed)
+        feeder.daemon = True
+        feeder.start()
+
+        started = time.time()
+        lastReport = started
+        running = self.jobs
+
+        while running:
+            try:
+                index, path, status, points, sent, detail = self.results.get(timeout=0.5)
+            except Queue.Empty:
+                if not any(process.is_alive() for process in processes) and self.results.empty():
+                    break
+            except (IOError, OSError) as e:
+                if e.errno != errno.EINTR:
+                    raise
+            else:
+                stats = self.stats[index]
+                if status == 'exit':
+                    running -= 1
+                elif status == 'progress':
+                    stats.points += points
+                    stats.bytes += sent
+                    if self.checkpoint is not None:
+                        self.checkpoint.advance(path, detail)
+                elif status == 'done':
+                    stats.files += 1
+                    stats.busy += detail
+                    if self.checkpoint is not None:
+                        self.checkpoint.complete(path)
+                    with self.lock:
+                        self.pending.pop(path, None)
+                else:
+                    stats.failed += 1
+                    self.failed.append((path, detail))
+                    with self.lock:
+                        self.pending.pop(path, None)
+                    sys.stderr.write('[ERROR] worker %d failed to export "%s": %s\n'
+                                     % (index + 1, path, detail))
+
+            now = time.time()
+            if self.reportInterval and now - lastReport >= self.reportInterval:
+                self.report(now - started)
+                lastReport = now
+            if self.checkpoint is not None:
+                self.checkpoint.sync()
+
+        self.stop.set()
+        feeder.join()
+        for process in processes:
+            process.join()
+
+        # workers are gone, drain the rest of the queue so it could be closed
+        try:
+            while True:
+                self.tasks.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+        self.tasks.close()
+        self.tasks.join_thread()
+        if self.checkpoint is not None:
+            self.checkpoint.sync(True)
+
+        elapsed = time.time() - started
+        total = WorkerStats()
+        for stats in self.stats:
+            total.add(stats)
+
+        self.report(elapsed)
+        sys.stderr.write('[INFO] total: %s, %.1f s\n' % (total.format(elapsed), elapsed))
+        if self.skipped:
+            sys.stderr.write('[INFO] %d files skipped as already exported\n' % self.skipped)
+
+        with self.lock:
+            unfinished = list(self.pending)
+
+        if unfinished:
+            sys.stderr.write('[WARN] %d files unfinished:\n' % len(unfinished))
+            for path in unfinished:
+                sys.stderr.write('%s\n' % path)
+        if self.failed:
+            sys.stderr.write('[WARN] %d files failed:\n' % len(self.failed))
+            for path, detail in self.failed:
+                sys.stderr.write('%s\n' % path)
+        if not self.walked:
+            sys.stderr.write('[WARN] walk was interrupted, files not reached yet are not listed\n')
+
+        return not unfinished and not self.failed and self.walked
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate whisper data to Axibase Time Series Database.')
+
+    parser.add_argument('path', help='path to folder/file that will be exported to ATSD. Path must be specified either: directly to .wsp files (only if -R is not set) OR to folders containing the .wsp files (-R must be set). ~ symbol cannot be used.')
+    parser.add_argument('hostname', help='ATSD hostname')
+    parser.add_argument('port', help='ATSD listening port', type=int)
+    parser.add_argument('--whisper-base', help='base path to which all metric names will be resolved (default: ".")', dest="whisperRoot", default=os.path.curdir, metavar="BASE")
+    parser.add_argument('-R', action='store_true', help='export recursively all files in specified folder', dest="isRecursive")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes, each with own ATSD connection (default: 1)')
+    parser.add_argument('--archives', choices=['finest', 'merged'], default='finest', help='finest: only the finest archive, merged: the finest data where it exists and coarser archives only for time before it (default: finest)')
+    parser.add_argument('--rollup-name', dest="rollupName", metavar="FORMAT", help='metric name of points from coarser archives in merged mode, e.g. "{metric}.rollup_{seconds}s" (default: the same metric)')
+    parser.add_argument('--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE, dest="bufferSize", metavar="BYTES", help='bytes of lines coalesced into one write or http request (default: %d)' % DEFAULT_BUFFER_SIZE)
+    parser.add_argument('--protocol', choices=['tcp', 'http', 'https'], default='tcp', help='tcp: graphite plaintext lines to ATSD graphite port, http(s): series commands to /api/v1/command (default: tcp)')
+    parser.add_argument('--user', help='ATSD user for http(s) protocol')
+    parser.add_argument('--password', help='ATSD password for http(s) protocol, ATSD_PASSWORD environment variable is used if not set')
+    parser.add_argument('--entity', help='entity of all series for http(s) protocol, by default the first token of metric name is the entity and the rest is the metric')
+    parser.add_argument('--journal', metavar="FILE", help='checkpoint journal, files finished in a previous run with the same journal are skipped and unfinished files resume after the last sent point')
+    parser.add_argument('--state', metavar="FILE", help='sqlite state of exported files for incremental sync: unchanged files are skipped and only points newer than the last exported one are sent')
+    parser.add_argument('--follow', action='store_true', help='keep exporting new points of changed files every --interval seconds until interrupted, requires --state')
+    parser.add_argument('--interval', type=float, default=60, metavar="SECONDS", help='seconds between scans in --follow mode (default: 60)')
+    parser.add_argument('--report-interval', type=float, default=10, dest="reportInterval", metavar="SECONDS", help='seconds between per-worker throughput reports, 0 to report only at the end (default: 10)')
+
+    args = parser.parse_args()
+
+    PATH = os.path.abspath(args.path)
+    IS_RECURSIVE = args.isRecursive
+    ADDRESS = (args.hostname, args.port)
+    WHISPER_ROOT = os.path.abspath(args.whisperRoot)
+
+    if not os.path.exists(PATH):
+        raise SystemExit('[ERROR] File "%s" does not exist!' % PATH)
+    if not os.path.exists(WHISPER_ROOT):
+        raise SystemExit('[ERROR] Whisper root "%s" does not exist!' % WHISPER_ROOT)
+    if not PATH.startswith(WHISPER_ROOT):
+        raise SystemExit('[ERROR] Wrong whisper root "%s" should be prefix of path "%s"!' % (WHISPER_ROOT, PATH))
+    if not (IS_RECURSIVE and os.path.isdir(PATH)) and not os.path.isfile(PATH):
         raise SystemExit('[ERROR] "%s" is not a file! Maybe you need to specify -R?' % os.path.abspath(PATH))
-    export_file(PATH, WHISPER_ROOT, s)
+    if args.jobs < 1:
+        raise SystemExit('[ERROR] --jobs must be positive')
+    if args.rollupName is not None and args.archives != 'merged':
+        raise SystemExit('[ERROR] --rollup-name requires --archives merged')
+    if args.bufferSize < 1:
+        raise SystemExit('[ERROR] --buffer-size must be positive')
+
+    senderOptions = {'address': ADDRESS,
+                     'bufferSize': args.bufferSize,
+                     'protocol': args.protocol,
+                     'user': args.user,
+                     'password': args.password if args.password is not None else os.environ.get('ATSD_PASSWORD'),
+                     'entity': args.entity}
+    if args.journal and args.state:
+        raise SystemExit('[ERROR] --journal and --state could not be used together')
+    if args.follow and not args.state:
+        raise SystemExit('[ERROR] --follow requires --state')
+
+    exportOptions = {'whisperRoot': WHISPER_ROOT,
+                     'merge': args.archives == 'merged',
+                     'rollupName': args.rollupName}
+
+    if args.state:
+        checkpoint = StateStore(args.state)
+    elif args.journal:
+        checkpoint = Journal(args.journal)
+    else:
+        checkpoint = None
+
+    try:
+        while True:
+            scanned = time.time()
+            migration = Migration(iter_files(PATH, IS_RECURSIVE), senderOptions, exportOptions,
+                                  args.jobs, args.reportInterval, checkpoint)
+            success = migration.run()
+            if not args.follow or migration.interrupted:
+                break
+            while not migration.interrupted and time.time() - scanned < args.interval:
+                time.sleep(0.2)
+            if migration.interrupted:
+                break
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+    if not success:
+        sys.exit(1)
+
 
-s.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,653 @@
+# -*- coding: utf-8 -*-
+"""in-process ATSD stand-in for offline tests and benchmarks
+
+serves synthetic entities, metrics and series over the subset of api/v1
+used by the finders and the reader, counts points inserted by migrate.py
+"""
+
+import BaseHTTPServer
+import SocketServer
+import calendar
+import collections
+import fnmatch
+import json
+import re
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+# seconds in one unit of group/aggregate interval
+_UNIT_SECONDS = {'MILLISECOND': 0.001,
+                 'SECOND': 1,
+                 'MINUTE': 60,
+                 'HOUR': 60 * 60,
+                 'DAY': 24 * 60 * 60,
+                 'WEEK': 7 * 24 * 60 * 60}
+
+_CLAUSE_RE = re.compile(r"^\s*name\s*(like|=|in)\s*(.+?)\s*$", re.IGNORECASE)
+_STRING_RE = re.compile(r"'((?:[^']|'')*)'")
+_FIELD_RE = re.compile(r'(\w+):("(?:[^"]|"")*"|\S+)')
+
+
+def _match_expression(expression):
+    """compile subset of atsd expression language used by finders:
+    `name like 'a*'`, `name = 'a'`, `name in ('a', 'b')` joined with `or`
+
+    :param expression: `str` | None
+    :return: `.Function` name -> `bool`
+    """
+
+    if not expression:
+        return lambda name: True
+
+    matchers = []
+    for clause in re.split(r'\s+or\s+', expression, flags=re.IGNORECASE):
+        match = _CLAUSE_RE.match(clause)
+        if match is None:
+            raise ValueError('unsupported expression: ' + expression)
+
+        operator = match.group(1).lower()
+        values = [v.replace("''", "'").lower()
+                  for v in _STRING_RE.findall(match.group(2))]
+
+        if operator == 'like':
+            matchers.append(re.compile(fnmatch.translate(values[0])).match)
+        else:
+            matchers.append(frozenset(values).__contains__)
+
+    return lambda name: any(m(name.lower()) for m in matchers)
+
+
+def _min_insert_time(params):
+    """
+    :param params: `dict` query parameters
+    :return: `int` milliseconds of iso 8601 minInsertDate, 0 if not set
+    """
+
+    value = params.get('minInsertDate')
+    if not value:
+        return 0
+
+    seconds = calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+    fraction = value[19:].rstrip('Z').lstrip('.')
+    return seconds * 1000 + int((fraction + '000')[:3])
+
+
+def _aggregate(type_, values):
+    """
+    :param type_: `str` atsd statistic
+    :param values: `list` of `Number`, not empty
+    :return: `Number`
+    """
+
+    if type_ == 'MIN':
+        return min(values)
+    elif type_ == 'MAX':
+        return max(values)
+    elif type_ == 'SUM':
+        return sum(values)
+    elif type_ == 'COUNT':
+        return len(values)
+    elif type_ == 'FIRST':
+        return values[0]
+    elif type_ == 'LAST':
+        return values[-1]
+    elif type_ == 'DELTA':
+        return values[-1] - values[0]
+    else:  # AVG and everything not modelled here
+        return float(sum(values)) / len(values)
+
+
+def _period_ms(interval):
+    return int(interval['count'] * _UNIT_SECONDS[interval['unit'].upper()] * 1000)
+
+
+def _group(samples, spec):
+    """group samples into epoch aligned periods
+
+    :param samples: [{t, v}]
+    :param spec: {type, interval: {count, unit}}
+    :return: [{t, v}]
+    """
+
+    period = _period_ms(spec['interval'])
+    type_ = spec['type'].upper()
+
+    result = []
+    bucket_start = None
+    bucket = []
+
+    for sample in samples:
+        start = sample['t'] - sample['t'] % period
+        if start != bucket_start and bucket:
+            result.append({'t': bucket_start, 'v': _aggregate(type_, bucket)})
+            bucket = []
+        bucket_start = start
+        bucket.append(sample['v'])
+
+    if bucket:
+        result.append({'t': bucket_start, 'v': _aggregate(type_, bucket)})
+
+    return result
+
+
+class Dataset(object):
+    """synthetic metadata and data
+
+    every metric is collected by every entity with every tag value,
+    so number of series is metrics * entities * tag_values
+    """
+
+    TAG_NAME = 'tag'
+
+    def __init__(self, series=1000, metrics=10, tag_values=1, step=60, now=None,
+                 retention_days=0):
+        """
+        :param series: `int` approximate number of series
+        :param metrics: `int`
+        :param tag_values: `int` values of tag `Dataset.TAG_NAME`, 0 for untagged series
+        :param step: `Number` seconds between samples
+        :param now: `Number` seconds, last insert time
+        :param retention_days: `int` metric retention interval, 0 for unlimited
+        """
+
+        metrics = max(1, min(metrics, series))
+        combos = metrics * max(1, tag_values)
+        entities = max(1, series // combos)
+
+        #: `list` of `str`
+        self.metrics = ['metric%04d' % i for i in xrange(metrics)]
+        #: `list` of `str`
+        self.entities = ['entity%06d' % i for i in xrange(entities)]
+        #: `list` of `str`
+        self.tag_values = ['value%03d' % i for i in xrange(tag_values)]
+        #: `int` milliseconds
+        self.step = int(step * 1000)
+        #: `int` milliseconds
+        self.last_insert_time = int((time.time() if now is None else now) * 1000)
+        #: `int` days
+        self.retention_days = retention_days
+
+        self._metric_set = frozenset(self.metrics)
+        self._entity_set = frozenset(self.entities)
+
+    @property
+    def series_count(self):
+        return len(self.metrics) * len(self.entities) * max(1, len(self.tag_values))
+
+    def tag_combos(self):
+        if not self.tag_values:
+            return [{}]
+        return [{self.TAG_NAME: value} for value in self.tag_values]
+
+    def entity_json(self, name):
+        return {'name': name,
+                'enabled': True,
+                'lastInsertTime': self.last_insert_time}
+
+    def metric_json(self, name):
+        return {'name': name,
+                'enabled': True,
+                'dataType': 'FLOAT',
+                'retentionInterval': self.retention_days,
+                'lastInsertTime': self.last_insert_time}
+
+    def has_metric(self, name):
+        return name in self._metric_set
+
+    def has_entity(self, name):
+        return name in self._entity_set
+
+    def samples(self, entity, metric, tags, start, end):
+        """
+        :param start: `int` milliseconds, inclusive
+        :param end: `int` milliseconds, exclusive
+        :return: [{t, v}]
+        """
+
+        end = min(end, self.last_insert_time + 1)
+        first = -(-start // self.step) * self.step
+        key = u'|'.join([entity, metric, repr(sorted(tags.items()))])
+        seed = zlib.crc32(key.encode('utf8'))
+
+        return [{'t': t, 'v': float((seed + t // self.step) % 100)}
+                for t in xrange(first, end, self.step)]
+
+
+class FakeAtsd(object):
+    """threaded http server emulating atsd api/v1
+
+    usage::
+
+        server = FakeAtsd(Dataset(series=10000), latency=0.01).start()
+        settings.ATSD_CONF['url'] = server.url
+        ...
+        server.stop()
+    """
+
+    def __init__(self, dataset=None, latency=0, host='127.0.0.1', port=0, gzip=False):
+        """
+        :param dataset: :class:`.Dataset`
+        :param latency: `Number` seconds | `dict` endpoint -> seconds
+        :param gzip: `bool` compress responses if client accepts gzip
+        """
+
+        #: :class:`.Dataset`
+        self.dataset = dataset if dataset is not None else Dataset()
+        #: `Number` | `dict`
+        self.latency = latency
+        #: `bool`
+        self.gzip = gzip
+
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._connections = 0
+        #: (entity, metric) -> `int` points received by command endpoint
+        self.inserted = collections.Counter()
+
+        self._server = _Server((host, port), _Handler)
+        self._server.atsd = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='FakeAtsd')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def stats(self):
+        """
+        bytes_in and bytes_out are decoded body sizes, wire_in and wire_out
+        sizes sent over network, gzip_in and gzip_out count compressed bodies
+
+        :return: {endpoint: {requests, bytes_in, bytes_out, wire_in, wire_out,
+            gzip_in, gzip_out}, '_connections': `int`}
+        """
+
+        with self._lock:
+            stats = dict((k, dict(v)) for k, v in self._stats.items())
+            stats['_connections'] = self._connections
+            return stats
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+            self._connections = 0
+
+    def _record(self, endpoint, bytes_in, bytes_out, wire_in, wire_out):
+        with self._lock:
+            entry = self._stats.setdefault(endpoint, {'requests': 0,
+                                                      'bytes_in': 0,
+                                                      'bytes_out': 0,
+                                                      'wire_in': 0,
+                                                      'wire_out': 0,
+                                                      'gzip_in': 0,
+                                                      'gzip_out': 0})
+            entry['requests'] += 1
+            entry['bytes_in'] += bytes_in
+            entry['bytes_out'] += bytes_out
+            entry['wire_in'] += wire_in
+            entry['wire_out'] += wire_out
+            entry['gzip_in'] += wire_in != bytes_in
+            entry['gzip_out'] += wire_out != bytes_out
+
+    def _connected(self):
+        with self._lock:
+            self._connections += 1
+
+    def _delay(self, endpoint):
+        if isinstance(self.latency, dict):
+            delay = self.latency.get(endpoint, 0)
+        else:
+            delay = self.latency
+
+        if delay:
+            time.sleep(delay)
+
+    # endpoints
+
+    def get_entities(self, params):
+        match = _match_expression(params.get('expression'))
+        if _min_insert_time(params) > self.dataset.last_insert_time:
+            return []
+        return [self.dataset.entity_json(e) for e in self.dataset.entities if match(e)]
+
+    def get_metrics(self, params):
+        match = _match_expression(params.get('expression'))
+        if _min_insert_time(params) > self.dataset.last_insert_time:
+            return []
+        return [self.dataset.metric_json(m) for m in self.dataset.metrics if match(m)]
+
+    def get_entity(self, entity):
+        if not self.dataset.has_entity(entity):
+            return None
+        return self.dataset.entity_json(entity)
+
+    def get_metric(self, metric):
+        if not self.dataset.has_metric(metric):
+            return None
+        return self.dataset.metric_json(metric)
+
+    def get_entity_metrics(self, entity, params):
+        if not self.dataset.has_entity(entity):
+            return []
+        return self.get_metrics(params)
+
+    def get_entity_and_tags(self, metric, params):
+        if not self.dataset.has_metric(metric):
+            return []
+        if _min_insert_time(params) > self.dataset.last_insert_time:
+            return []
+
+        last_insert_time = self.dataset.last_insert_time
+        return [{'entity': entity, 'tags': tags, 'lastInsertTime': last_insert_time}
+                for entity in self.dataset.entities
+                for tags in self.dataset.tag_combos()]
+
+    def get_graphite(self, params):
+        """completer format: metric.entity[.tag_value]"""
+
+        dataset = self.dataset
+        tokens = params.get('query', '*').split('.')
+        series = params.get('series') == 'true'
+        limit = int(params['limit']) if 'limit' in params else None
+
+        levels = 3 if dataset.tag_values else 2
+        depth = min(len(tokens), levels)
+
+        level_names = (dataset.metrics, dataset.entities, dataset.tag_values)
+
+        paths = [[]]
+        for level in xrange(depth):
+            names = [n for n in level_names[level]
+                     if fnmatch.fnmatchcase(n, tokens[level])]
+            paths = [p + [n] for p in paths for n in names]
+            if limit is not None and len(paths) > limit:
+                paths = paths[:limit]
+
+        metrics = []
+        for p in paths:
+            is_leaf = len(p) == levels
+            node = {'path': '.'.join(p) + ('' if is_leaf else '.'),
+                    'name': p[-1],
+                    'is_leaf': 1 if is_leaf else 0}
+            if series and is_leaf:
+                tags = {Dataset.TAG_NAME: p[2]} if levels == 3 else {}
+                node['series'] = {'metric': p[0], 'entity': p[1], 'tags': tags}
+            metrics.append(node)
+
+        return {'metrics': metrics}
+
+    def post_series(self, body):
+        result = []
+        for query in body['queries']:
+            result.extend(self._query_series(query))
+        return {'series': result}
+
+    def post_command(self, body):
+        """network commands, only `series` is counted"""
+
+        inserted = collections.Counter()
+        total = 0
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            total += 1
+            fields = [(key, value[1:-1].replace('""', '"') if value.startswith('"') else value)
+                      for key, value in _FIELD_RE.findall(line)]
+            if not line.startswith('series '):
+                continue
+            entity = dict(fields).get('e')
+            for key, value in fields:
+                if key == 'm':
+                    inserted[(entity, value.rsplit('=', 1)[0])] += 1
+
+        with self._lock:
+            self.inserted.update(inserted)
+
+        return {'fail': 0, 'success': total, 'total': total}
+
+    def _query_series(self, query):
+        dataset = self.dataset
+        metric = query['metric']
+        if not dataset.has_metric(metric):
+            return []
+
+        if 'entities' in query:
+            patterns = query['entities']
+        else:
+            patterns = [query.get('entity', '*')]
+        entities = [e for e in dataset.entities
+                    if any(fnmatch.fnmatchcase(e, p) for p in patterns)]
+
+        tag_filter = query.get('tags') or {}
+        combos = [tags for tags in dataset.tag_combos()
+                  if all(name in tags and any(fnmatch.fnmatchcase(tags[name], v)
+                                              for v in values)
+                         for name, values in tag_filter.items())]
+
+        result = []
+        for entity in entities:
+            for tags in combos:
+                data = dataset.samples(entity, metric, tags,
+                                       query['startTime'], query['endTime'])
+                if 'group' in query:
+                    data = _group(data, query['group'])
+                if 'aggregate' in query:
+                    data = _group(data, query['aggregate'])
+
+                series = {'entity': entity,
+                          'metric': metric,
+                          'tags': tags,
+                          'data': data}
+                if 'requestId' in query:
+                    series['requestId'] = query['requestId']
+                result.append(series)
+
+        return result
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def process_request(self, request, client_address):
+        self.atsd._connected()
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # body must be consumed to keep connection usable
+        self._handle(self._read_body())
+
+    def do_POST(self):
+        self._handle(self._read_body())
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else None
+        #: `int` request body size before decoding
+        self.wire_in = length
+
+        if body is not None and self._encoding() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        return body
+
+    def _encoding(self):
+        return self.headers.get('Content-Encoding', 'identity').lower()
+
+    def _handle(self, body):
+        if self._encoding() not in ('identity', 'gzip'):
+            return self._reply('unknown', body, 415,
+                               {'error': 'unsupported encoding ' + self._encoding()})
+
+        atsd = self.server.atsd
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+
+        prefix = '/api/v1/'
+        if not url.path.startswith(prefix):
+            return self._reply('unknown', body, 404, {'error': 'not found'})
+
+        parts = [urllib.unquote(p).decode('utf8')
+                 for p in url.path[len(prefix):].split('/')]
+
+        if parts == ['command'] and self.command == 'POST':
+            endpoint, call = 'command', lambda: atsd.post_command(body)
+        elif parts == ['series'] and self.command == 'POST':
+            endpoint, call = 'series', lambda: atsd.post_series(json.loads(body))
+        elif parts == ['graphite']:
+            endpoint, call = 'graphite', lambda: atsd.get_graphite(params)
+        elif parts == ['entities']:
+            endpoint, call = 'entities', lambda: atsd.get_entities(params)
+        elif parts == ['metrics']:
+            endpoint, call = 'metrics', lambda: atsd.get_metrics(params)
+        elif len(parts) == 2 and parts[0] == 'entities':
+            endpoint, call = 'entity', lambda: atsd.get_entity(parts[1])
+        elif len(parts) == 2 and parts[0] == 'metrics':
+            endpoint, call = 'metric', lambda: atsd.get_metric(parts[1])
+        elif len(parts) == 3 and parts[0] == 'entities' and parts[2] == 'metrics':
+            endpoint, call = 'entity-metrics', lambda: atsd.get_entity_metrics(parts[1], params)
+        elif len(parts) == 3 and parts[0] == 'metrics' and parts[2] == 'entity-and-tags':
+            endpoint, call = 'entity-and-tags', lambda: atsd.get_entity_and_tags(parts[1], params)
+        else:
+            return self._reply('unknown', body, 404, {'error': 'not found'})
+
+        atsd._delay(endpoint)
+
+        try:
+            result = call()
+        except (ValueError, KeyError) as e:
+            return self._reply(endpoint, body, 400, {'error': unicode(e)})
+
+        if result is None:
+            return self._reply(endpoint, body, 404, {'error': 'not found'})
+
+        self._reply(endpoint, body, 200, result)
+
+    def _reply(self, endpoint, body, status, result):
+        content = json.dumps(result)
+        wire = content
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if self.server.atsd.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            wire = compressor.compress(content) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(wire)))
+        self.end_headers()
+        self.wfile.write(wire)
+
+        self.server.atsd._record(endpoint, len(body or ''), len(content),
+                                 self.wire_in, len(wire))
+
+
+class FakeLineListener(object):
+    """tcp listener counting graphite plaintext lines `metric value timestamp`
+
+    usage::
+
+        listener = FakeLineListener().start()
+        ... send to listener.address ...
+        listener.stop()
+        listener.points['a.b.c']
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._lock = threading.Condition()
+        self._active = 0
+        #: metric -> `int` points
+        self.points = collections.Counter()
+        self.bytes = 0
+        self.connections = 0
+
+        self._server = _LineServer((host, port), _LineHandler)
+        self._server.listener = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='FakeLineListener')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        """stop accepting connections, wait until open ones are closed by clients"""
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+        deadline = time.time() + timeout
+        with self._lock:
+            while self._active and time.time() < deadline:
+                self._lock.wait(0.1)
+
+    def _received(self, points, size):
+        with self._lock:
+            self.points.update(points)
+            self.bytes += size
+
+
+class _LineServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def process_request(self, request, client_address):
+        with self.listener._lock:
+            self.listener.connections += 1
+            self.listener._active += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+
+class _LineHandler(SocketServer.StreamRequestHandler):
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        finally:
+            listener = self.server.listener
+            with listener._lock:
+                listener._active -= 1
+                listener._lock.notify_all()
+
+    def handle(self):
+        points = collections.Counter()
+        size = 0
+        for line in self.rfile:
+            size += len(line)
+            fields = line.split()
+            if len(fields) == 3:
+                points[fields[0]] += 1
+            if size >= 1 << 20:
+                self.server.listener._received(points, size)
+                points = collections.Counter()
+                size = 0
+        self.server.listener._received(points, size)
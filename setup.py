@@ -6,5 +6,6 @@ except ImportError:
 setup(
     name='atsd_finder',
     install_requires=['requests'],
+    extras_require={'numpy': ['numpy']},
     packages=['atsd_finder']
 )
\ No newline at end of file
@@ -1,8 +1,30 @@
 import unittest
+import imp
+import json
+import os
+import shutil
+import signal
+import struct
+import tempfile
 import time
+import random
+import threading
+import zlib
+import requests
 import atsd_finder
+try:
+    import whisper
+except ImportError:
+    whisper = None
+from atsd_finder import metrics
+from atsd_finder import reader
 from atsd_finder.reader import Aggregator
-from atsd_finder.client import AtsdClient, Instance
+from atsd_finder.cache import TtlLruCache, MetadataRefresher
+from fake_atsd import FakeAtsd, Dataset, FakeLineListener
+from atsd_finder.index import MetadataIndex
+from atsd_finder.series_cache import SeriesCache
+from atsd_finder.pattern import GraphitePattern, narrow_like
+from atsd_finder.client import AtsdClient, Instance, QueryCollection, DeadlineExceeded
 
 
 class TestReaderFetch(unittest.TestCase):
@@ -158,6 +180,339 @@ class TestReader(unittest.TestCase):
         # self.assertEqual(aggregator.count, 1)
         # self.assertEqual(aggregator.unit, 'DAY')
 
+    def test_default_interval_is_not_changed(self):
+        interval = {'count': 1, 'unit': 'day'}
+        reader = atsd_finder.AtsdReader(Instance('e', 'm', {}, '', self.client), interval)
+
+        self.assertEqual(reader.default_interval, {'count': 1, 'unit': 'DAY'})
+        self.assertEqual(interval, {'count': 1, 'unit': 'day'})
+
+    def test_interval_schema_reload(self):
+        schema = atsd_finder.reader.IntervalSchema
+        saved = schema.CONF_NAME, schema.RELOAD_CHECK_INTERVAL, schema._compiled, schema._checked
+        directory = tempfile.mkdtemp()
+        conf_name = os.path.join(directory, 'interval-schema.conf')
+
+        def steps(path):
+            return sorted((interval[0], aggregator.count)
+                          for interval, aggregator in schema(path)._map.items())
+
+        try:
+            with open(conf_name, 'w') as conf:
+                conf.write('[cpu]\nmetric-pattern = cpu_*\nretentions = 1m:1d, 10m:30d\n'
+                           '[default]\nretentions = 1h:365d\n')
+            schema.CONF_NAME = conf_name
+            schema.RELOAD_CHECK_INTERVAL = 0.2
+            schema._compiled = atsd_finder.reader._SchemaConfig(conf_name)
+            schema._checked = time.time()
+
+            self.assertEqual(steps('cpu_busy'), [(24 * 60 * 60, 60), (30 * 24 * 60 * 60, 600)])
+            self.assertEqual(steps('memory'), [(365 * 24 * 60 * 60, 60 * 60)])
+            # resolution is memoized per path
+            self.assertIs(schema('cpu_busy')._map, schema('cpu_busy')._map)
+
+            # the first matching section wins
+            with open(conf_name, 'w') as conf:
+                conf.write('[default]\nretentions = 1h:365d\n'
+                           '[cpu]\nmetric-pattern = cpu_*\nretentions = 1m:1d\n')
+            mtime = os.stat(conf_name).st_mtime + 10
+            os.utime(conf_name, (mtime, mtime))
+
+            self.assertEqual(steps('cpu_busy'), [(24 * 60 * 60, 60), (30 * 24 * 60 * 60, 600)])
+            time.sleep(0.3)
+            self.assertEqual(steps('cpu_busy'), [(365 * 24 * 60 * 60, 60 * 60)])
+        finally:
+            schema.CONF_NAME, schema.RELOAD_CHECK_INTERVAL, schema._compiled, schema._checked = saved
+            shutil.rmtree(directory)
+
+    def test_group_step(self):
+        day = 24 * 60 * 60
+        self.assertEqual(reader._group_step(0, day, 1000), 2 * 60)
+        self.assertEqual(reader._group_step(100, 100 + day, 1000), 2 * 60)
+        self.assertEqual(reader._group_step(0, 60, 1000), 1)
+        self.assertEqual(reader._group_step(0, 100 * 365 * day, 1000), 28 * 2 * day)
+
+        aggregator = atsd_finder.AtsdReader._limit_points(0, day, {'maxDataPoints': 100})
+        self.assertEqual((aggregator.type, aggregator.count), ('AVG', 30 * 60))
+
+class TestRegularize(unittest.TestCase):
+
+    @staticmethod
+    def _series(deltas):
+        t = 1500000000000
+        series = []
+        for delta in deltas:
+            t += delta
+            series.append({'t': t, 'v': random.random()})
+        return series
+
+    @unittest.skipIf(reader.numpy is None, 'numpy is not installed')
+    def test_numpy_matches_python(self):
+        random.seed(0)
+        irregular = [random.choice([0, 1, 1000, 5000, 5000, 5000, 17000])
+                     for _ in xrange(1000)]
+
+        for series in (self._series([5000] * 1000), self._series(irregular)):
+            for step in (None, 5, 2.5):
+                self.assertEqual(reader._regularize_python(series, step),
+                                 reader._regularize_numpy(series, step))
+
+
+class TestCache(unittest.TestCase):
+
+    def test_ttl_lru(self):
+        cache = TtlLruCache(2)
+
+        self.assertEqual(cache.get('a', 60, lambda: 1), 1)
+        self.assertEqual(cache.get('a', 60, lambda: 2), 1)
+        cache.get('b', 60, lambda: 3)
+        cache.get('c', 60, lambda: 4)
+        self.assertEqual(cache.get('a', 60, lambda: 5), 5)
+        self.assertEqual(cache.get('d', -1, lambda: 6), 6)
+        self.assertEqual(cache.get('d', 60, lambda: 7), 7)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['size'], 2)
+
+    def test_single_flight(self):
+        cache = TtlLruCache(10)
+        calls = []
+        release = threading.Event()
+
+        def load():
+            calls.append(1)
+            release.wait()
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('k', 60, load)))
+                   for _ in xrange(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 5)
+
+
+    def test_refresher_budget(self):
+        release = threading.Event()
+
+        class Transport(object):
+            def get(self, url):
+                release.wait()
+                response = requests.Response()
+                response.status_code = 200
+                response._content = json.dumps(url)
+                return response
+
+        cache = TtlLruCache(10)
+        refresher = MetadataRefresher(cache, top=2, concurrency=1, rate=1, ahead=0.5)
+        for url, uses in (('a', 3), ('b', 2), ('c', 1), ('d', 5)):
+            for _ in xrange(uses):
+                refresher.touch(Transport(), url, 10)
+        cache.put('d', 'd', 10)
+
+        now = time.time()
+        self.assertEqual([url for url, _, _ in refresher.due(now)], ['a'])
+        self.assertEqual([url for url, _, _ in refresher.due(now + 6)], ['d', 'a'])
+
+        self.assertEqual(refresher.scan(now + 6), 1)
+        self.assertEqual(refresher.scan(now + 6), 0)
+        release.set()
+
+        for _ in xrange(100):
+            if not refresher.stats()['pending']:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(cache.lookup('d'), 'd')
+        self.assertGreater(cache.expires('d'), now + 9)
+        self.assertEqual(refresher.stats()['reloads'], 1)
+
+
+class TestLogger(unittest.TestCase):
+
+    def test_levels_and_sampling(self):
+        lines = []
+
+        class Backend(object):
+            info = exception = staticmethod(lambda msg, inst: lines.append(msg))
+
+        class Expensive(object):
+            formatted = 0
+
+            def __str__(self):
+                Expensive.formatted += 1
+                return 'expensive'
+
+        log = atsd_finder.utils.Logger(Backend(), 'info')
+
+        log.debug('skipped %s', None, Expensive())
+        self.assertEqual(Expensive.formatted, 0)
+        self.assertFalse(log.enabled('debug'))
+
+        log.info('value %s', None, Expensive())
+        for i in xrange(5):
+            log.warning('sampled %d', None, i, sample=2)
+
+        self.assertEqual(lines, ['value expensive', 'warning: sampled 0',
+                                 'warning: sampled 2', 'warning: sampled 4'])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_exposition(self):
+        registry = metrics.Registry()
+        requests_ = registry.counter('requests_total', 'requests', ('endpoint',))
+        latency = registry.histogram('latency_seconds', 'latency', (), (0.1, 1))
+
+        requests_.inc(1, 'series')
+        requests_.inc(2, 'series')
+        latency.observe(0.5)
+        latency.observe(5)
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['requests_total']['values'], {('series',): 3})
+        self.assertEqual(snapshot['latency_seconds']['values'][()]['count'], 2)
+
+        text = registry.exposition()
+        self.assertIn('requests_total{endpoint="series"} 3\n', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('latency_seconds_sum 5.5\n', text)
+
+
+class TestIndex(unittest.TestCase):
+
+    def test_incremental_refresh(self):
+        dataset = Dataset(series=8, metrics=2, tag_values=2)
+        server = FakeAtsd(dataset).start()
+        transport = atsd_finder.transport.Transport(server.url, 'user', 'password')
+        url_base = server.url + '/api/v1'
+        directory = tempfile.mkdtemp()
+
+        try:
+            index = MetadataIndex(directory + '/index.db')
+            self.assertIsNone(index.entities(['*']))
+
+            self.assertEqual(index.refresh(transport, url_base),
+                             {'entities': 2, 'metrics': 2, 'series': 8})
+            self.assertEqual(index.entities(['entity*']),
+                             [{'name': 'entity000000'}, {'name': 'entity000001'}])
+            self.assertEqual(index.entity_metrics('entity000001', ['*1']),
+                             [{'name': 'metric0001'}])
+            self.assertEqual(sorted(c['tags']['tag'] for c in index.entity_and_tags('metric0000')
+                                    if c['entity'] == 'entity000000'),
+                             ['value000', 'value001'])
+            self.assertIsNone(index.entity_and_tags('unknown'))
+
+            dataset.last_insert_time += 1000
+            self.assertEqual(index.refresh(transport, url_base)['metrics'], 2)
+            dataset.last_insert_time -= 2000
+            self.assertEqual(index.refresh(transport, url_base),
+                             {'entities': 0, 'metrics': 0, 'series': 0})
+
+            index.max_age = 0
+            index._checked = 0
+            self.assertIsNone(index.metrics(['*']))
+        finally:
+            server.stop()
+            shutil.rmtree(directory)
+
+
+class TestSeriesCache(unittest.TestCase):
+
+    def test_plan_requests_only_missing_blocks(self):
+        cache = SeriesCache(10 ** 6, block_size=60, settle=0)
+        query = {'entity': 'e', 'metric': 'm', 'tags': {},
+                 'startTime': 30000, 'endTime': 300000}
+
+        segments = cache.plan(query)
+        self.assertEqual(len(segments), 1)
+        _, start, end, blocks = segments[0]
+        self.assertEqual((start, end, len(blocks)), (30000, 300000, 4))
+
+        data = [{'t': t, 'v': t / 1000.0} for t in xrange(30000, 300000, 10000)]
+        cache.store(blocks[1:3], data)
+
+        segments = cache.plan(query)
+        self.assertEqual([s[0] for s in segments], ['request', 'cached', 'cached', 'request'])
+        self.assertEqual(segments[0][1:3], (30000, 120000))
+        self.assertEqual(segments[1][1], tuple(xrange(120000, 180000, 10000)))
+        self.assertEqual(segments[3][1:3], (240000, 300000))
+
+    def test_interpolated_group_is_not_cached(self):
+        cache = SeriesCache(10 ** 6, block_size=60, settle=0)
+        query = {'entity': 'e', 'metric': 'm', 'tags': {}, 'startTime': 0, 'endTime': 600000,
+                 'group': Aggregator('AVG', 60).json()}
+
+        self.assertIsNone(cache.plan(query))
+
+    def test_step_interpolation_is_filled_after_join(self):
+        query = {'entity': 'e', 'metric': 'm', 'tags': {}, 'startTime': 0, 'endTime': 600000,
+                 'group': Aggregator('AVG', 60).json()}
+
+        cache_query, fill = atsd_finder.series_cache.without_step_interpolation(query)
+
+        self.assertEqual((cache_query['group']['interpolate'], fill), ('NONE', 60))
+        self.assertEqual(query['group']['interpolate'], 'STEP')
+        self.assertEqual(atsd_finder.series_cache.fill_step(
+            [{'t': 0, 'v': 1}, {'t': 180000, 'v': 2}, {'t': 240000, 'v': 3}], 60),
+            [{'t': 0, 'v': 1}, {'t': 60000, 'v': 1}, {'t': 120000, 'v': 1},
+             {'t': 180000, 'v': 2}, {'t': 240000, 'v': 3}])
+
+    def test_aggregator_query_hits_cache(self):
+        server = FakeAtsd(Dataset(series=1, metrics=1)).start()
+        settings = atsd_finder.client.settings
+        conf = dict(settings.ATSD_CONF)
+        settings.ATSD_CONF.update(url=server.url, series_cache_bytes=10 ** 6)
+        atsd_finder.series_cache._cache = None
+
+        try:
+            client = AtsdClient()
+            instance = Instance('entity000000', 'metric0000', {}, 'metric0000.entity000000', client)
+            reader = atsd_finder.AtsdReader(instance, aggregator=Aggregator('AVG', 60))
+            now = server.dataset.last_insert_time / 1000.0
+
+            results = [reader.fetch(now - 3 * 60 * 60, now - 60 * 60).waitForResults()
+                       for _ in xrange(2)]
+
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(len(results[0][1]), 120)
+            self.assertGreater(atsd_finder.series_cache.series_cache().stats()['hits'], 0)
+        finally:
+            atsd_finder.series_cache._cache = None
+            settings.ATSD_CONF.clear()
+            settings.ATSD_CONF.update(conf)
+            server.stop()
+
+
+class TestPattern(unittest.TestCase):
+
+    def test_match(self):
+        pattern = GraphitePattern('metrics.cpu*.{nurswgvml006,nurswgvml007}.[!x]*')
+
+        self.assertTrue(pattern.match('metrics.cpu_busy.nurswgvml007.detail'))
+        self.assertFalse(pattern.match('metrics.cpu_busy.nurswgvml008.detail'))
+        self.assertFalse(pattern.match('metrics.cpu_busy.nurswgvml007.xdetail'))
+        self.assertFalse(pattern.match('metrics.cpu.busy.nurswgvml007.detail'))
+        self.assertFalse(pattern.is_literal(-1))
+
+    def test_prefix(self):
+        pattern = GraphitePattern('v.%5Bp%5D%20disk%3A*')
+
+        self.assertEqual(pattern.prefix(-1), u'[p] disk:')
+        self.assertEqual(pattern.name_prefix(-1, u'[p] '), u'disk:')
+        self.assertEqual(pattern.name_prefix(-1, u'[q] '), None)
+        self.assertTrue(pattern.may_match(-1, u'[p] disk:/'))
+        self.assertEqual(narrow_like('d*', u'disk:'), u'disk:*')
+        self.assertEqual(narrow_like('c*', u'disk:'), None)
+
 
 class TestFinder(unittest.TestCase):
 
@@ -167,6 +522,40 @@ class TestFinder(unittest.TestCase):
     def test_finderV(self):
         atsd_finder.AtsdFinderV()
 
+    def test_compile_view(self):
+        periods = [{'label': '1 min', 'count': 1, 'unit': 'minute'}, {'label': 'raw', 'count': 0}]
+        view = atsd_finder.finderV.compile_view('v', [
+            {'type': 'metric', 'value': ['*'], 'global': [{'type': 'tag', 'value': [{'a': '1'}]}]},
+            {'type': 'collection', 'value': [
+                {'type': 'aggregator', 'value': [{'max': 'Maximum'}], 'prefix': 'a'},
+                {'type': 'period', 'value': periods, 'is leaf': True, 'prefix': 'p'},
+            ]},
+        ])
+
+        self.assertEqual(view[0].global_scope.tags, {'a': '1'})
+        self.assertEqual(view[1].by_prefix['a'].labels, {'Maximum': 'max'})
+        self.assertEqual(view[1].by_prefix['p'].labels,
+                         {'1 min': {'label': '1 min', 'count': 1, 'unit': 'MINUTE'}, 'raw': None})
+        self.assertEqual(periods[0]['unit'], 'minute')
+        self.assertEqual(view[1].leaf_by_prefix.keys(), ['p'])
+
+        for levels in ({}, [{'type': 'unknown', 'value': []}],
+                       [{'type': 'aggregator', 'value': ['max']}],
+                       [{'type': 'period', 'value': [{'label': '1 min', 'count': 1}]}],
+                       [{'type': 'interval', 'value': [{'label': '1 min', 'count': 1, 'unit': 'minutes'}]}],
+                       [{'type': 'metric', 'value': ['*'], 'local': [{'type': 'entity'}]}]):
+            with self.assertRaises(ValueError):
+                atsd_finder.finderV.compile_view('v', levels)
+
+    def test_info_copy_on_write(self):
+        info = atsd_finder.finderV._Info({'tags': {'a': '1'}, 'metric': 'm'})
+        changed = info.set('entity', 'e').with_tags({'b': '2'})
+
+        self.assertNotIn('entity', info)
+        self.assertEqual(info['tags'], {'a': '1'})
+        self.assertEqual(changed['tags'], {'a': '1', 'b': '2'})
+        self.assertEqual(changed['entity'], 'e')
+
     def test_finderG(self):
         atsd_finder.AtsdFinderG()
 
@@ -182,3 +571,381 @@ class TestClient(unittest.TestCase):
         resp = client.request('GET', 'metrics',
                               params={'expression': "name='cpu_busy'"})
         self.assertEqual(resp[0]['name'], 'cpu_busy')
+
+    def test_identical_queries_sent_once(self):
+        storage = QueryCollection()
+        query = {'entity': 'nurswgvml006', 'metric': 'cpu_busy', 'tags': {},
+                 'startTime': 0, 'endTime': 1000}
+
+        first = dict(query)
+        second = dict(query)
+        storage.add_query(first, len)
+        storage.add_query(second)
+
+        self.assertEqual(storage.get_waiting_queries(), [first])
+        self.assertTrue(storage.is_dispatched(second))
+
+        storage.add_response({'requestId': first['requestId'], 'data': [{'t': 1, 'v': 2}]})
+        storage.finish([first])
+
+        self.assertEqual(storage.wait_response(first), 1)
+        self.assertEqual(storage.wait_response(second)['data'], [{'t': 1, 'v': 2}])
+        self.assertEqual(storage.stats()['saved'], 1)
+        self.assertEqual(storage.get_waiting_queries(), [])
+
+    def test_deadline_cancels_query(self):
+        storage = QueryCollection()
+        query = {'entity': 'nurswgvml006', 'metric': 'cpu_busy', 'tags': {},
+                 'startTime': 0, 'endTime': 1000}
+        storage.add_query(query)
+
+        with self.assertRaises(DeadlineExceeded):
+            storage.wait_response(query, time.time() + 0.01)
+
+        self.assertEqual(storage.get_waiting_queries(), [])
+        self.assertFalse(storage.add_response({'requestId': query['requestId'], 'data': []}))
+
+    def test_cancelled_query_passes_response_to_identical_one(self):
+        query = {'entity': 'nurswgvml006', 'metric': 'cpu_busy', 'tags': {},
+                 'startTime': 0, 'endTime': 1000}
+
+        # cancelled after it was sent
+        storage = QueryCollection()
+        first, second, third = dict(query), dict(query), dict(query)
+        storage.add_query(first, len)
+        storage.add_query(second, len)
+        sent = storage.get_waiting_queries()
+
+        with self.assertRaises(DeadlineExceeded):
+            storage.wait_response(first, time.time() - 1)
+
+        self.assertTrue(storage.is_dispatched(second))
+        storage.add_query(third)
+        self.assertEqual(storage.get_waiting_queries(), [])
+
+        self.assertTrue(storage.add_response({'requestId': first['requestId'],
+                                              'data': [{'t': 1, 'v': 2}]}))
+        storage.finish(sent)
+
+        self.assertEqual(storage.wait_response(second, time.time() + 1), 1)
+        self.assertEqual(storage.wait_response(third, time.time() + 1)['data'], [{'t': 1, 'v': 2}])
+
+        # cancelled before it was sent
+        storage = QueryCollection()
+        first, second = dict(query), dict(query)
+        storage.add_query(first, len)
+        storage.add_query(second, len)
+
+        with self.assertRaises(DeadlineExceeded):
+            storage.wait_response(first, time.time() - 1)
+
+        self.assertEqual(storage.get_waiting_queries(), [second])
+        storage.add_response({'requestId': second['requestId'], 'data': [{'t': 1, 'v': 2}]})
+        storage.finish([second])
+
+        self.assertEqual(storage.wait_response(second, time.time() + 1), 1)
+
+    def test_deadline_is_scoped_to_render(self):
+        server = FakeAtsd(Dataset(series=1, metrics=1)).start()
+        settings = atsd_finder.client.settings
+        conf = dict(settings.ATSD_CONF)
+        settings.ATSD_CONF.update(url=server.url, render_timeout=0.5)
+
+        try:
+            client = AtsdClient()
+            instance = Instance('entity000000', 'metric0000', {}, 'metric0000.entity000000', client)
+            reader = atsd_finder.AtsdReader(instance, aggregator=Aggregator('AVG', 60))
+            now = server.dataset.last_insert_time / 1000.0
+
+            def fetches():
+                values = metrics.registry.snapshot()['atsd_fetch_duration_seconds']['values']
+                return values[()]['count'] if () in values else 0
+
+            for _ in xrange(2):
+                observed = fetches()
+                _, values = reader.fetch(now - 60 * 60, now).waitForResults()
+                self.assertIsNone(client.deadline)
+                self.assertEqual(client.waiting_fetches, 0)
+                self.assertEqual(fetches(), observed + 1)
+                self.assertTrue(any(v is not None for v in values))
+                time.sleep(0.7)
+        finally:
+            settings.ATSD_CONF.clear()
+            settings.ATSD_CONF.update(conf)
+            server.stop()
+
+    def test_retention_skips_windows_without_data(self):
+        now = time.time()
+        server = FakeAtsd(Dataset(series=1, metrics=1, now=now - 60 * 60, retention_days=1)).start()
+        settings = atsd_finder.client.settings
+        conf = dict(settings.ATSD_CONF)
+        settings.ATSD_CONF.update(url=server.url)
+
+        try:
+            client = AtsdClient()
+            # names are case insensitive, a quoted name is requested by itself
+            instance = Instance('ENTITY000000', 'METRIC0000', {}, 'METRIC0000.ENTITY000000', client)
+            quoted = Instance('entity000000', "metric'0", {}, "metric'0.entity000000", client)
+            client.retentions.resolve(client)
+
+            self.assertEqual(server.stats()['metrics']['requests'], 1)
+            self.assertEqual(server.stats()['metric']['requests'], 1)
+            last_insert = server.dataset.last_insert_time / 1000.0
+            self.assertEqual(instance.get_retention_interval(),
+                             (last_insert - 24 * 60 * 60, last_insert))
+
+            # older than retention interval, after last insert
+            self.assertTrue(instance.has_no_data(now - 3 * 24 * 60 * 60, now - 2 * 24 * 60 * 60))
+            self.assertTrue(instance.has_no_data(now - 30 * 60, now - 1))
+            # overlaps last insert, ends after it was reported
+            self.assertFalse(instance.has_no_data(now - 2 * 60 * 60, now - 30 * 60))
+            self.assertFalse(instance.has_no_data(now - 30 * 60, now + 60 * 60))
+            self.assertFalse(quoted.has_no_data(now - 30 * 60, now - 1))
+
+            reader = atsd_finder.AtsdReader(instance, aggregator=Aggregator('AVG', 60))
+            _, values = reader.fetch(now - 30 * 60, now - 1).waitForResults()
+            self.assertTrue(all(v is None for v in values))
+            self.assertNotIn('series', server.stats())
+        finally:
+            settings.ATSD_CONF.clear()
+            settings.ATSD_CONF.update(conf)
+            server.stop()
+
+    def test_plan_merges_siblings(self):
+        base = {'metric': 'cpu_busy', 'startTime': 0, 'endTime': 1000}
+        queries = [dict(base, entity='a', tags={'t': ['x']}, requestId='1'),
+                   dict(base, entity='b', tags={'t': ['x']}, requestId='2'),
+                   dict(base, entity='c', tags={'t': ['x']}, requestId='3'),
+                   dict(base, entity='c', tags={'t': ['y']}, requestId='4'),
+                   dict(base, entity='*', tags={'t': ['x']}, requestId='5')]
+
+        planned, merged = atsd_finder.client._plan_queries(queries, 100)
+
+        self.assertEqual(len(planned), 3)
+        self.assertEqual(planned[0]['entities'], ['a', 'b', 'c'])
+        self.assertEqual(planned[1], queries[3])
+        self.assertEqual(planned[2], queries[4])
+
+        merged_query = merged[planned[0]['requestId']]
+        self.assertEqual(merged_query.split({'entity': 'B', 'tags': {'t': 'x'}}), ['2'])
+        self.assertEqual(merged_query.split({'entity': 'd', 'tags': {'t': 'x'}}), [])
+
+        planned, merged = atsd_finder.client._plan_queries(queries[2:4], 100)
+
+        self.assertEqual(len(planned), 1)
+        self.assertEqual(planned[0]['tags'], {'t': ['x', 'y']})
+        self.assertEqual(merged[planned[0]['requestId']].split({'entity': 'c', 'tags': {'t': 'y'}}),
+                         ['4'])
+
+        planned, _ = atsd_finder.client._plan_queries(queries, 0)
+        self.assertEqual(planned, queries)
+
+    def test_gzip_request_body(self):
+        transport = atsd_finder.transport.Transport('http://localhost', 'user', 'password',
+                                                    gzip_min_size=100)
+        body = json.dumps({'queries': [{'metric': 'cpu_busy'}] * 10})
+
+        for data, compressed in ((body, True), ('{}', False)):
+            request = transport.session.prepare_request(
+                requests.Request('POST', 'http://localhost/api/v1/series', data=data))
+            transfer = transport._compress(request)
+
+            self.assertEqual(transfer.bytes_out, len(data))
+            self.assertEqual('Content-Encoding' in request.headers, compressed)
+            self.assertEqual(zlib.decompress(request.body, 16 + zlib.MAX_WBITS)
+                             if compressed else request.body, data)
+
+    def test_iter_series_chunks(self):
+        body = '{"series": [{"requestId": "1", "data": [{"t": 1, "v": 2.5}]}, ' \
+               '{"requestId": "2", "data": []}]}'
+
+        for size in (1, 3, 16, len(body)):
+            chunks = [body[i:i + size] for i in xrange(0, len(body), size)]
+            series = list(atsd_finder.client._iter_series(chunks))
+            self.assertEqual(series, json.loads(body)['series'])
+
+        with self.assertRaises(ValueError):
+            list(atsd_finder.client._iter_series([body[:-5]]))
+
+    def test_chunk_sizer_split(self):
+        sizer = atsd_finder.client._ChunkSizer(3, 100, 1.0)
+        hour = {'startTime': 0, 'endTime': 60 * 60 * 1000,
+                'group': {'type': 'AVG', 'interval': {'count': 60, 'unit': 'SECOND'}}}
+        queries = [dict(hour) for _ in xrange(7)]
+
+        chunks = sizer.split(queries)
+
+        self.assertEqual([len(chunk) for chunk in chunks], [1] * 7)
+
+        sizer.max_points = 1000
+        chunks = sizer.split(queries)
+
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+
+
+@unittest.skipIf(whisper is None, 'whisper is not installed')
+class TestMigrate(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.migrate = imp.load_source('migrate', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                              'bin', 'migrate.py'))
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        now = int(time.time())
+        # recent points are in the minute archive only, old ones only in the 10 minute archive
+        start = (now - 30 * 60) // 600 * 600 + 600
+        self.recent = [(t, 1.0) for t in xrange(start, now - 120, 60)]
+        self.old = [(t, 2.0) for t in xrange(start - 20 * 60 * 60, start - 2 * 60 * 60, 600)]
+        self.paths = []
+        for name in ('host/cpu.wsp', 'host/memory.wsp'):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            whisper.create(path, [(60, 60), (600, 144)])
+            whisper.update_many(path, self.old)
+            whisper.update_many(path, self.recent)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_migration(self, checkpoint=None, merge=False, rollupName=None):
+        """
+        :return: (`bool` success, `collections.Counter` points received per metric)
+        """
+        listener = FakeLineListener().start()
+        handlers = signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)
+        try:
+            migration = self.migrate.Migration(list(self.paths),
+                                               {'address': listener.address,
+                                                'bufferSize': 1024,
+                                                'protocol': 'tcp'},
+                                               {'whisperRoot': self.root,
+                                                'merge': merge,
+                                                'rollupName': rollupName},
+                                               2, 0, checkpoint)
+            success = migration.run()
+        finally:
+            signal.signal(signal.SIGINT, handlers[0])
+            signal.signal(signal.SIGTERM, handlers[1])
+            listener.stop()
+        return success, listener.points
+
+    def test_migration_over_tcp(self):
+        success, points = self.run_migration()
+
+        self.assertTrue(success)
+        self.assertEqual(points, {'host.cpu': len(self.recent), 'host.memory': len(self.recent)})
+
+    def test_merged_archives_with_rollup_name(self):
+        success, points = self.run_migration(merge=True, rollupName='{metric}.rollup_{seconds}s')
+
+        self.assertTrue(success)
+        self.assertEqual(points, {'host.cpu': len(self.recent),
+                                  'host.cpu.rollup_600s': len(self.old),
+                                  'host.memory': len(self.recent),
+                                  'host.memory.rollup_600s': len(self.old)})
+
+    def test_state_rerun_sends_only_new_points(self):
+        state = self.migrate.StateStore(os.path.join(self.root, 'state.db'))
+        try:
+            self.assertEqual(self.run_migration(state)[1],
+                             {'host.cpu': len(self.recent), 'host.memory': len(self.recent)})
+
+            success, points = self.run_migration(state)
+            self.assertTrue(success)
+            self.assertEqual(points, {})
+
+            time.sleep(0.01)
+            whisper.update(self.paths[0], 3.0, self.recent[-1][0] + 60)
+            self.assertEqual(self.run_migration(state)[1], {'host.cpu': 1})
+        finally:
+            state.close()
+
+    def test_export_file_over_http(self):
+        server = FakeAtsd().start()
+        try:
+            sender = self.migrate.HttpSender(server._server.server_address[:2], 1024)
+            for path in self.paths:
+                self.assertEqual(self.migrate.export_file(path, self.root, sender)[0],
+                                 len(self.recent))
+            sender.close()
+        finally:
+            server.stop()
+
+        self.assertEqual(server.inserted, {('host', 'cpu'): len(self.recent),
+                                           ('host', 'memory'): len(self.recent)})
+
+    def test_decode_points_numpy_matches_struct(self):
+        # wrapped ring buffer with an empty slot and a duplicated timestamp
+        slots = [(400, 4.0), (500, 5.0), (0, 0.0), (100, 1.0), (200, 2.0), (200, 9.0)]
+        data = 'header' + ''.join(struct.pack(whisper.pointFormat, t, v) for t, v in slots)
+        expected = [(100, 1.0), (200, 2.0), (400, 4.0), (500, 5.0)]
+
+        numpy = self.migrate.numpy
+        try:
+            if numpy is not None:
+                self.assertEqual(self.migrate.decode_points(data, 6, len(slots)), expected)
+            self.migrate.numpy = None
+            self.assertEqual(self.migrate.decode_points(data, 6, len(slots)), expected)
+        finally:
+            self.migrate.numpy = numpy
+
+    def test_merge_archives_cuts_before_oldest_finer_point(self):
+        data = self.migrate.mmap_file(self.paths[0])
+        try:
+            coarse = self.migrate.read_archives(data, 2)[1]
+            segments = self.migrate.merge_archives(data)
+        finally:
+            data.close()
+
+        oldest = self.recent[0][0]
+        # aggregate of the first recent points shares their oldest timestamp
+        self.assertIn(oldest, [t for t, v in coarse])
+        self.assertEqual(segments, [(600, self.old), (60, self.recent)])
+
+    def test_state_store_skips_unchanged_file(self):
+        path = self.paths[0]
+        filename = os.path.join(self.root, 'state.db')
+
+        state = self.migrate.StateStore(filename)
+        self.assertEqual(state.start(path), (True, None))
+        state.advance(path, 100)
+        state.complete(path)
+        state.close()
+
+        state = self.migrate.StateStore(filename)
+        try:
+            self.assertEqual(state.start(path), (False, None))
+            mtime = os.stat(path).st_mtime + 10
+            os.utime(path, (mtime, mtime))
+            self.assertEqual(state.start(path), (True, 100))
+            self.assertEqual(state.start(os.path.join(self.root, 'removed.wsp')), (False, None))
+        finally:
+            state.close()
+
+    def test_journal_resumes_and_ignores_torn_record(self):
+        filename = os.path.join(self.root, 'journal')
+        with open(filename, 'w') as journal:
+            journal.write('P 100 a.wsp\n'
+                          'D b.wsp\n'
+                          'P 200 a.wsp\n'
+                          'P 150 dir/with space.wsp\n'
+                          'P 300 c.wsp\n'
+                          'D c.wsp\n'
+                          'P 400 a.w')
+
+        journal = self.migrate.Journal(filename)
+        self.assertEqual(journal.start('a.wsp'), (True, 200))
+        self.assertEqual(journal.start('b.wsp'), (False, None))
+        self.assertEqual(journal.start('c.wsp'), (False, None))
+        self.assertEqual(journal.start('dir/with space.wsp'), (True, 150))
+        self.assertEqual(journal.start('d.wsp'), (True, None))
+        journal.complete('a.wsp')
+        journal.close()
+
+        journal = self.migrate.Journal(filename)
+        self.assertEqual(journal.start('a.wsp'), (False, None))
+        journal.close()